@@ -8,15 +8,12 @@ Created on Wed Nov 24 11:28:01 2021
 # -------------- Load packages --------------------
 
 import dash
-import dash_html_components as html
-import dash_core_components as dcc
+from dash import html, dcc, dash_table
 import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output
-import dash_daq as daq
-import dash_table
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash import Patch
 
 import plotly.graph_objects as go
-from plotly.subplots import make_subplots
 # To render plots to browser
 # import plotly.io as pio
 # pio.renderers.default = "browser"
@@ -29,40 +26,160 @@ from pandas import Timestamp
 
 import datetime
 from datetime import date, timedelta
+import collections
+import functools
+import logging
+import os
+import tempfile
+import threading
+
+from functions.cache import get_frame, put_frame, prune_frames
+from functions.batch import get_batch_location, sweep_all_locations, sweep_current_R_eff
+from functions.refresh import start_refresher, load_snapshot, log_format
+from functions.table import filter_data, get_table_page
+from functions.downsample import decimate_series, zoom_series, relayout_x_range
+from functions.projection import scenario_R_eff_values, build_scenario_grid, project_scenarios
+from functions.projection import simulate_interval_multipliers, projection_intervals, R_eff_decay
+from functions.pipeline import process_data, smooth_data, estimate_R_eff, estimate_R_eff_renewal
+from functions.renewal import generation_interval_weights, simulate_renewal
+from functions.metrics import timed, init_metrics, instrument_callback, register_cache_gauges
+from functions.assumptions import secondary_github_data_web, assum_ingest_chunk_rows, assum_data_cache_dir
+from functions.assumptions import assum_mean_generation, assum_sd_generation, assum_rolling_window
+from functions.assumptions import assum_stable, assum_worse, assum_easing_half_life
+from functions.assumptions import assum_interval_quantiles, assum_simulation_paths, assum_R_eff_history_days
+
+logger = logging.getLogger(__name__)
 
 
 # -------------- Assumptions -----------------------
+# The data source and modelling assumptions are shared with 02_batch_projections.py (see functions/assumptions.py)
 
-secondary_github_data_web = 'https://raw.githubusercontent.com/M3IT/COVID-19_Data/master/Data/COVID_AU_state.csv'
+# How often (seconds) to check the data source for new data
+assum_refresh_interval = int(os.environ.get('COVID_REFRESH_INTERVAL', 3600))
 
-# Assumption for mean generation period
-assum_mean_generation = 5
+# How often (seconds) each worker checks for new data published by another worker (see functions/refresh.py)
+assum_snapshot_poll_interval = 5
 
-# Assumptions for R_eff for scenarios
-assum_stable = 1.02
-assum_worse = 1.35
+# Longest (seconds) a callback waits for the first data to load before skipping the request, e.g. when the source
+# can't be reached on a cold start with nothing cached on disk
+assum_snapshot_wait_seconds = 10
 
-# ---------- Load and process data ------------------
+# Longest projection (days) precomputed for every R_eff scenario - longer projections are computed directly
+assum_max_days_to_project = 365
 
-raw_covid_df = pd.read_csv(secondary_github_data_web)\
-    .sort_values(by = ['date'], ascending = False)
+# Rolling windows and mean generation periods (days) for the sensitivity of current R_eff to these assumptions
+assum_sweep_windows = [3, 5, 7, 10, 14]
+assum_sweep_generations = [3, 4, 5, 6, 7]
 
-# Compute max_date in data
-max_date = max(raw_covid_df["date"])
+# Number of processed locations to keep in memory
+assum_cache_size = 32
 
-# ------------- Initialize the app --------------------
+# Location selected when the page loads
+assum_default_location = os.environ.get('COVID_DEFAULT_LOCATION', 'NSW')
 
-app = dash.Dash(external_stylesheets=[
-    dbc.themes.BOOTSTRAP,
-    { # font-awesome
-            "href": "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.3/css/all.min.css",
-            "rel": "stylesheet",
-            "integrity": "sha512-iBBXm8fW90+nuLcSKlbmrPcLa0OT92xO1BIsZ+ywDWZCvqsWgccV3gFoRBv0z+8dLJgyAHIhR35VZc2oM/gI1w==",
-            "crossorigin": "anonymous",
-            "referrerpolicy": "no-referrer",
-        }
-])
-app.config.suppress_callback_exceptions = True
+# Most locations offered in the location dropdown at a time - options are searched on the server as the user types
+assum_location_search_limit = 50
+
+# Most locations in the sensitivity heatmap - with more locations than this, those with the most cases are shown
+assum_sensitivity_max_locations = 50
+
+# Maximum points per chart trace - longer histories are drawn with WebGL and downsampled
+assum_max_plot_points = 1000
+
+# Callback requests slower than this (seconds) are profiled and their most sampled stacks logged - set
+# COVID_PROFILE_SLOW_SECONDS to turn on. Profiling samples every callback request's stack while it runs
+assum_slow_request_seconds = float(os.environ['COVID_PROFILE_SLOW_SECONDS']) \
+    if 'COVID_PROFILE_SLOW_SECONDS' in os.environ else None
+
+# Directory for processed data shared between workers
+assum_cache_dir = os.environ.get('COVID_FRAME_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'covid_dashy_cache'))
+
+# ---------- Load and process data ------------------
+
+# Data is loaded by a background thread which polls the source and builds a new snapshot (series store,
+# batch results, data version and max date) each time the data changes. The snapshot is swapped in whole,
+# so callbacks should fetch it once with get_snapshot() and use that for the rest of the callback.
+# Functions memoised on the data version look their data up by that version with get_snapshot(p_data_version),
+# so what they cache under a version is always that version's data, even if the data changes while they run
+covid_snapshot = None
+snapshot_ready = threading.Event()
+
+# Latest snapshots by data version - the previous one is kept for callbacks still running when a new one is loaded
+assum_snapshots_kept = 2
+recent_snapshots = collections.OrderedDict()
+recent_snapshots_lock = threading.Lock()
+
+def set_snapshot(p_snapshot):
+    global covid_snapshot
+    # Added by version first, so any snapshot returned by get_snapshot() can be found by its version
+    with recent_snapshots_lock:
+        recent_snapshots[p_snapshot['data_version']] = p_snapshot
+        while len(recent_snapshots) > assum_snapshots_kept:
+            recent_snapshots.popitem(last=False)
+    covid_snapshot = p_snapshot
+    snapshot_ready.set()
+
+    # Cached results from older data won't be requested again
+    compute_location_data.cache_clear()
+    build_base_figure.cache_clear()
+    get_scenario_grid.cache_clear()
+    get_interval_multipliers.cache_clear()
+    get_easing_projection.cache_clear()
+    build_sensitivity_figure.cache_clear()
+    get_table_history.cache_clear()
+    prune_frames(assum_cache_dir, p_snapshot['data_version'])
+
+    logger.info("loaded data version %s (max date %s)", p_snapshot['data_version'], p_snapshot['max_date'])
+
+# Function: The latest snapshot, or the snapshot of data version p_data_version if given
+def get_snapshot(p_data_version=None):
+    # Only waits if the first load hasn't finished yet - and not for long, so requests don't pile up behind a load
+    # that's failing. They're skipped instead, and later requests try again
+    if not snapshot_ready.wait(assum_snapshot_wait_seconds):
+        raise dash.exceptions.PreventUpdate
+    if p_data_version is None:
+        return covid_snapshot
+
+    snapshot = recent_snapshots.get(p_data_version)
+    if snapshot is None:
+        # The data changed more than once while this request ran - skip it, the next request uses the new data
+        raise dash.exceptions.PreventUpdate
+    return snapshot
+
+# Function: Load the data now, in this process rather than in the background. For the master process of a
+# pre-forking server, so workers are forked with the data already loaded (see wsgi.py)
+def preload_data():
+    set_snapshot(load_snapshot(p_source=secondary_github_data_web
+                               , p_rolling_window=assum_rolling_window
+                               , p_assum_mean_generation=assum_mean_generation
+                               , p_assum_sd_generation=assum_sd_generation
+                               , p_cache_dir=assum_data_cache_dir
+                               , p_chunk_rows=assum_ingest_chunk_rows))
+
+# Threads don't survive a fork, so each process starts its own refresher (see create_app) - from the snapshot
+# inherited from the master if the data was preloaded there
+refresher_pid = None
+refresher_lock = threading.Lock()
+
+# Function: Start loading the data in the background and keep checking for new data, once per process.
+# Starts from the copy of the data cached on disk if there is one
+def start_data_refresher():
+    global refresher_pid
+    with refresher_lock:
+        if refresher_pid == os.getpid():
+            return
+        refresher_pid = os.getpid()
+
+    start_refresher(p_source=secondary_github_data_web
+                    , p_interval=assum_refresh_interval
+                    , p_on_snapshot=set_snapshot
+                    , p_rolling_window=assum_rolling_window
+                    , p_assum_mean_generation=assum_mean_generation
+                    , p_assum_sd_generation=assum_sd_generation
+                    , p_cache_dir=assum_data_cache_dir
+                    , p_chunk_rows=assum_ingest_chunk_rows
+                    , p_previous=covid_snapshot
+                    , p_poll_interval=assum_snapshot_poll_interval)
 
 # ------------- App layout ------------------------
 # In Shiny, I would move all this UI stuff into a ui.R script - investigate best practice in Dash
@@ -118,14 +235,17 @@ sidebar = html.Div(
     [
         html.P("Select inputs:"),
         html.Div([
-            html.Label(['State'], style={'font-weight': 'bold'}),
+            html.Label(['Location'], style={'font-weight': 'bold'}),
+            # Only the selected location is sent with the layout - the rest are searched on the server (see
+            # update_location_options), so the page stays small however many locations there are
             dcc.Dropdown(id='input_location',
                          options=[
-                             {'label': 'NSW', 'value': 'NSW'},
-                             {'label': 'VIC', 'value': 'VIC'}
+                             {'label': assum_default_location, 'value': assum_default_location}
                          ],
-                         value='NSW',
+                         value=assum_default_location,
                          searchable=True,
+                         clearable=False,
+                         placeholder='Type to search',
                          style={"margin-bottom": "10px", 'width': 180})
         ]),
         html.Div([
@@ -186,6 +306,16 @@ sidebar = html.Div(
                                        target="input_scenario_worse",
                                        placement="bottom"
                                    ),
+
+                                   html.Button('Easing',
+                                               id='input_scenario_easing',
+                                               style = {'background-color':"#2F4F4F", "color": "white"}),
+                                   dbc.Tooltip(
+                                       "Scenario where R_eff eases from its current estimate back toward 1, halving the gap every "
+                                       + str(assum_easing_half_life) + " days, with cases projected through the generation interval",
+                                       target="input_scenario_easing",
+                                       placement="bottom"
+                                   ),
                                    ]
                      , style = {"display":"none"})
         ]),
@@ -201,14 +331,20 @@ TAB_STYLE = {'padding': '0',
 TAB_SELECTED_STYLE = {'padding': '0',
                       'line-height': tab_height}
 
+# Columns of the Chart data table - numbers are shown as floats
+table_cols = ["report_date", "location", "daily_cases", "smooth_cases"
+              , "projected_cases", "projected_lower", "projected_upper"
+              , "R_eff", "projected_R_eff", "R_eff_renewal", "R_eff_renewal_lower", "R_eff_renewal_upper"]
+
 content = html.Div(
     id="page-content"
     , children = [
         dcc.Tabs( # Tabs go under here as a subset of content
+            id='tabs_content', value='tab_projected',
             style = {'width': '40%','height':tab_height},
             children = [
                 # Main tab
-                dcc.Tab(label = 'Projected cases'
+                dcc.Tab(label = 'Projected cases', value='tab_projected'
                     , style=TAB_STYLE, selected_style=TAB_SELECTED_STYLE
                     , children = [
                     html.P(""),
@@ -221,20 +357,54 @@ content = html.Div(
                 ]),
 
                 # Data table
-                dcc.Tab(label = 'Chart data'
+                dcc.Tab(label = 'Chart data', value='tab_table'
                         , style=TAB_STYLE, selected_style=TAB_SELECTED_STYLE
                         , children = [
                         html.P(""),
                         #html.P("Showing " + str(assum_days_to_show) + " days of data:", style={"width": "70vw"}),
                         html.P("Showing projection data in tabulated form:", style={"width": "77vw"}),
                         dbc.Spinner(
-                            children = [html.Div(id='tbl_projected')], # return from callback
+                            children = [html.Div(id='tbl_projected', children = [
+                                dash_table.DataTable(
+                                    id='tbl_projected_data', # data returned from callback
+                                    columns=[{"name": x, "id": x, "type": "text" if x in ["report_date", "location"] else "numeric"}
+                                             for x in table_cols],
+                                    # Filtering, sorting and paging are done on the server so only one page is sent
+                                    filter_action="custom",
+                                    filter_query="",
+                                    sort_action="custom",
+                                    sort_mode="multi",
+                                    sort_by=[],
+                                    page_action="custom",
+                                    page_current=0,
+                                    page_size=12,
+                                    style_header={'fontWeight': 'bold'},
+                                    style_cell={'font-family': 'Segoe UI'},
+                                    style_table={'overflowX': 'auto',
+                                                 "width": "77vw"},
+                                    # fix left-most column getting cut off
+                                    css=[{'selector': '.row', 'rule': 'margin: 0'}]
+                                )
+                            ])],
+                            spinner_style={"width": "3rem", "height": "3rem"}
+                        )
+                    ]),
+
+                # Sensitivity of current R_eff to the assumptions
+                dcc.Tab(label = 'Sensitivity', value='tab_sensitivity'
+                        , style=TAB_STYLE, selected_style=TAB_SELECTED_STYLE
+                        , children = [
+                        html.P(""),
+                        html.P("Current R_eff for each state, estimated with different rolling windows for the smoothed trend"
+                               + " and mean generation periods:", style={"width": "77vw"}),
+                        dbc.Spinner(
+                            children = [dcc.Graph(id='fig_sensitivity_heatmap')],
                             spinner_style={"width": "3rem", "height": "3rem"}
                         )
                     ]),
 
                 # About text tab
-                dcc.Tab(label = 'About'
+                dcc.Tab(label = 'About', value='tab_about'
                     , style=TAB_STYLE, selected_style=TAB_SELECTED_STYLE
                     , children = [
                         html.P(""),
@@ -280,161 +450,432 @@ content = html.Div(
 )
 
 ### Tie all together
-app.layout = html.Div([
+app_layout = html.Div([
     header,
     sidebar,
     content,
 
     # dcc.Store stores the intermediate data - some may be redundant
+    # intermediate_data only holds the key of the processed data, the data itself stays on the server
     dcc.Store(id='intermediate_data'),
     dcc.Store(id='est_curr_R_eff'),
-    dcc.Store(id='store_estcust_mode')
+    dcc.Store(id='store_estcust_mode'),
+    # Chart without projections, and the starting point for projections.
+    # Projections are added on top of these in the browser (assets/projection.js)
+    dcc.Store(id='store_fig_base'),
+    dcc.Store(id='store_projection_base'),
+    # R_eff and days used for projections, from the browser - used to add projected rows to the table
+    dcc.Store(id='store_projection'),
+    # Data key and projection for the table, only updated while the table's tab is showing
+    dcc.Store(id='store_table_input')
 
 ])
 
 
 # --------------- Functions used in callbacks -------------------
-# For later on - a cleaner way of doing this would be to move these functions into a functions folder like I would in R
-
-# Function: Collect required columns (report_date/location/daily_cases)
-def process_data(p_data, p_location):
-    processed_data = p_data
-
-    # Convert date to datetime format
-    processed_data['date'] = pd.to_datetime(processed_data['date'], format='%Y-%m-%d')
+# The pipeline for one location (process_data -> smooth_data -> estimate_R_eff -> estimate_R_eff_renewal) is in
+# functions/pipeline.py, shared with the batch projections (02_batch_projections.py). Both project from the
+# scenario grid and renewal simulations in functions/projection.py and functions/renewal.py
+# These functions must not modify their input frames - the inputs may be cached and shared between callbacks
+# running at the same time, so they work on a copy
+
+# Function: Process, smooth and estimate R_eff for a location, memoised as results only change with the data.
+# Loading new data changes p_data_version so old entries are never hit again and get evicted from the LRU.
+# Behind the in-process LRU, results are read from the batch results every worker shares, or for assumptions the
+# batch doesn't cover, shared with other workers through the cache directory
+@functools.lru_cache(maxsize=assum_cache_size)
+def compute_location_data(p_location, p_rolling_window, p_assum_mean_generation, p_data_version):
+
+    snapshot = get_snapshot(p_data_version)
+
+    # Already computed for all locations at load if using the default assumptions - read straight from the
+    # memory-mapped batch results, which is quicker than the cache directory and writes nothing
+    if (p_rolling_window == snapshot['batch']['rolling_window']) and \
+            (p_assum_mean_generation == snapshot['batch']['mean_generation']) and \
+            (p_location in snapshot['batch']['locations']):
+        with timed('batch_location'):
+            return get_batch_location(snapshot['batch'], p_location)
+
+    key = location_data_key(p_location, p_rolling_window, p_assum_mean_generation, p_data_version)
+    # The generation period sd is fixed for the app, but goes in the cache file name in case it's changed
+    key['sd_generation'] = assum_sd_generation
+
+    # Check whether another worker has already computed this
+    with timed('frame_cache_read'):
+        df = get_frame(assum_cache_dir, key)
+    if df is not None:
+        return df
 
-    # Filter to location and subset required cols
-    processed_data = (
-        processed_data.query("state_abbrev == @p_location") \
-            .filter(["date", "state_abbrev", "confirmed"])
-            .sort_values('date', ascending=1)
-    )
+    # Process data and fetch required cols (report_date/location/daily_cases)
+    with timed('process_data'):
+        df = process_data(p_data=snapshot['store']
+                          , p_location=p_location)
 
-    # Rename cols
-    req_cols = ["report_date", "location", "daily_cases"]
-    processed_data.columns = req_cols
+    # Add smoothed trend
+    with timed('smooth_data'):
+        df = smooth_data(p_data=df
+                         , p_rolling_window=p_rolling_window)
 
-    ## Fill in any missing values with 0
-    processed_data["daily_cases"] = processed_data["daily_cases"].fillna(0)
+    # Estimate current effective reproduction rate
+    with timed('estimate_R_eff'):
+        df = estimate_R_eff(p_data=df
+                            , p_assum_mean_generation=p_assum_mean_generation)
+
+    with timed('estimate_R_eff_renewal'):
+        df = estimate_R_eff_renewal(p_data=df
+                                    , p_rolling_window=p_rolling_window
+                                    , p_assum_mean_generation=p_assum_mean_generation
+                                    , p_assum_sd_generation=assum_sd_generation)
+
+    with timed('frame_cache_write'):
+        put_frame(assum_cache_dir, key, df)
+
+    return df
+
+# Function: Key identifying processed data - this is all that gets sent to the browser
+def location_data_key(p_location, p_rolling_window, p_assum_mean_generation, p_data_version):
+    return {
+        'location': p_location
+        , 'rolling_window': p_rolling_window
+        , 'mean_generation': p_assum_mean_generation
+        , 'data_version': p_data_version
+    }
 
-    return processed_data
+# Function: Base figure (history only, projections are added in the browser) and the starting point for projections
+# for a location - memoised like compute_location_data, as it only changes with the data
+@functools.lru_cache(maxsize=assum_cache_size)
+def build_base_figure(p_location, p_rolling_window, p_assum_mean_generation, p_data_version):
+
+    max_date = get_snapshot(p_data_version)['max_date']
+
+    covid_df = compute_location_data(p_location, p_rolling_window, p_assum_mean_generation, p_data_version)
+
+    # Nullable integer columns hold <NA> which can't be sent as JSON - convert to float so they become NaNs.
+    # This also makes a copy, so the cached frame isn't modified below
+    covid_df = covid_df.astype({'smooth_cases': float, 'lag_cases': float, 'R_eff': float})
+
+    # Projected columns are left empty here and filled in by the clientside projection callback
+    covid_df['projected_cases'] = np.NaN
+    covid_df['projected_R_eff'] = np.NaN
+    covid_df['projected_lower'] = np.NaN
+    covid_df['projected_upper'] = np.NaN
+
+    # Current date and cases - the starting point for projections
+    curr_date = max(covid_df["report_date"])
+    curr_cases = covid_df[covid_df["report_date"] == curr_date]["smooth_cases"].values[0]
+
+    projection_base = {
+        'location': p_location
+        , 'curr_date': curr_date.strftime('%Y-%m-%d')
+        , 'curr_cases': curr_cases
+        , 'mean_generation': p_assum_mean_generation
+        , 'assum_stable': assum_stable
+        , 'assum_worse': assum_worse
+        , 'max_date_text': str(datetime.datetime.strptime(max_date, '%Y-%m-%d').strftime('%d %B %Y'))
+        # Prediction interval relative to the projection, for each day ahead (see get_interval_multipliers)
+        , 'interval_multipliers': get_interval_multipliers(p_location, p_rolling_window, p_assum_mean_generation
+                                                           , p_data_version).tolist()
+    }
 
-# Function: Add smoothed trend column (smooth_cases)
-def smooth_data(p_data, p_rolling_window):
-    # Smooth data - compute 7 day average.
-    # We want to apply smoothing to remove effect of daily variability as well as the weekly Monday dip
+    # Easing scenario projection (see get_easing_projection) - picked from in the browser, like the multipliers
+    easing = get_easing_projection(p_location, p_rolling_window, p_assum_mean_generation, p_data_version)
+    if easing is not None:
+        projection_base['easing'] = {'R_eff': easing['R_eff'].tolist(), 'cases': easing['cases'].tolist()}
 
-    smoothed_data = p_data
+    # Generate plotly fig - as a dict, so the cached copy is sent as is
+    with timed('figure_build'):
+        fig = plot_projected_claims(p_data = covid_df, p_max_date = max_date
+                                    , p_max_points = assum_max_plot_points).to_dict()
 
-    smoothed_data["smooth_cases"] = smoothed_data["daily_cases"].rolling(p_rolling_window) \
-        .mean() \
-        .round(0)
+    return fig, projection_base
 
-    smoothed_data["smooth_cases"] = smoothed_data["smooth_cases"].astype('Int64')
+# Function: Projections for every R_eff scenario (0.01 to 10) up to assum_max_days_to_project days ahead for a location,
+# memoised so switching scenario or horizon is a lookup
+@functools.lru_cache(maxsize=assum_cache_size)
+def get_scenario_grid(p_location, p_rolling_window, p_assum_mean_generation, p_data_version):
 
-    return smoothed_data
+    covid_df = compute_location_data(p_location, p_rolling_window, p_assum_mean_generation, p_data_version)
 
-# Function - Simple estimate of current effective reproductive factor of the virus, based on the growth rate over the
-# last [assum_mean_generation = 5] days
-def estimate_R_eff(p_data, p_assum_mean_generation):
+    # Current date and cases
+    curr_date = max(covid_df["report_date"])
+    curr_cases = covid_df[covid_df["report_date"] == curr_date]["smooth_cases"].astype(float).values[0]
+
+    with timed('scenario_grid'):
+        return build_scenario_grid(p_curr_date=curr_date
+                                   , p_curr_cases=curr_cases
+                                   , p_max_days=assum_max_days_to_project
+                                   , p_assum_mean_generation=p_assum_mean_generation
+                                   , p_R_eff_values=scenario_R_eff_values())
+
+# Function: Prediction interval multipliers (lower and upper quantile x day ahead) for a location, simulated from
+# its recent R_eff estimates - the interval for any R_eff scenario is its projection times these.
+# Memoised like get_scenario_grid, as the simulation only changes with the data
+@functools.lru_cache(maxsize=assum_cache_size)
+def get_interval_multipliers(p_location, p_rolling_window, p_assum_mean_generation, p_data_version):
+
+    covid_df = compute_location_data(p_location, p_rolling_window, p_assum_mean_generation, p_data_version)
+
+    recent_R_eff = covid_df['R_eff'].astype(float).values[-assum_R_eff_history_days:]
+
+    with timed('interval_simulation'):
+        return simulate_interval_multipliers(p_recent_R_eff=recent_R_eff
+                                             , p_max_days=assum_max_days_to_project
+                                             , p_assum_mean_generation=p_assum_mean_generation
+                                             , p_quantiles=assum_interval_quantiles
+                                             , p_n_paths=assum_simulation_paths)
+
+# Function: Easing scenario for a location - R_eff decaying from its current estimate toward 1, with cases
+# projected up to assum_max_days_to_project days ahead through the renewal equation from the smoothed trend.
+# None if there is no current estimate of R_eff. Memoised like get_scenario_grid
+@functools.lru_cache(maxsize=assum_cache_size)
+def get_easing_projection(p_location, p_rolling_window, p_assum_mean_generation, p_data_version):
+
+    covid_df = compute_location_data(p_location, p_rolling_window, p_assum_mean_generation, p_data_version)
+
+    est_curr_R_eff = covid_df['R_eff'].astype(float).values[-1]
+    if not np.isfinite(est_curr_R_eff):
+        return None
+
+    R_eff = R_eff_decay(p_R_eff_start=est_curr_R_eff
+                        , p_days=assum_max_days_to_project
+                        , p_half_life=assum_easing_half_life)
+
+    with timed('easing_projection'):
+        proj_cases = simulate_renewal(p_recent_cases=covid_df['smooth_cases'].astype(float).values
+                                      , p_R_eff=R_eff
+                                      , p_weights=generation_interval_weights(p_assum_mean_generation
+                                                                              , assum_sd_generation))
+
+    easing = {
+        'curr_date': max(covid_df['report_date'])
+        , 'R_eff': np.round(R_eff, 2)
+        , 'cases': proj_cases
+    }
 
-    added_data = p_data
+    # Shared by every callback, nothing should modify it
+    easing['R_eff'].flags.writeable = False
+    easing['cases'].flags.writeable = False
 
-    added_data["lag_cases"] = added_data["smooth_cases"].shift(p_assum_mean_generation)
+    return easing
 
-    # If taking r = growth rate over 1 step, then r^5
-    #added_data["R_eff"] = (added_data["smooth_cases"] / added_data["lag_cases"]) ** p_assum_mean_generation
+# Function: Fetch processed data from its key, from the data in p_snapshot. Keys from older data (e.g. a browser
+# still holding a key from before a refresh) get the snapshot's data
+def get_location_data(p_key, p_snapshot):
+    return compute_location_data(p_location=p_key['location']
+                                 , p_rolling_window=p_key['rolling_window']
+                                 , p_assum_mean_generation=p_key['mean_generation']
+                                 , p_data_version=p_snapshot['data_version'])
 
-    # If taking r^5 = growth rate over 5 steps directly (applies more smoothing if 7d average wasn't good enough)
-    added_data["R_eff"] = (added_data["smooth_cases"] / added_data["lag_cases"])
+# Columns plotted, in the order of the traces in the figure
+plot_trace_cols = ['daily_cases', 'smooth_cases', 'projected_cases', 'R_eff', 'projected_R_eff'
+                   , 'projected_lower', 'projected_upper'
+                   , 'R_eff_renewal_lower', 'R_eff_renewal_upper', 'R_eff_renewal']
 
-    added_data["R_eff"] = round(added_data["R_eff"], 2)
+# Function - Project cases using the scenario grid for the location (see build_scenario_grid).
+# Same projected cases as project_cases_from_R_eff (functions/pipeline.py), but the projection is a lookup, and only
+# the projected rows are returned. Adds the prediction interval as well if given interval multipliers (see get_interval_multipliers)
+def project_cases_from_grid(p_days_to_project, p_location, p_scenario_grid, p_R_eff, p_interval_multipliers=None):
 
-    return added_data
+    proj_cases = project_scenarios(p_scenario_grid, [p_R_eff], p_days_to_project)[0]
 
-# Function - Project cases - projection is based on exponential growth with factor
-def project_cases_from_R_eff(p_days_to_project, p_data, p_R_eff, p_assum_mean_generation):
+    proj_date = p_scenario_grid['curr_date'] + pd.to_timedelta(np.arange(1, p_days_to_project + 1), unit='d')
 
-    # Convert to date (to be safe)
-    p_data['report_date'] = pd.to_datetime(p_data['report_date'], format='%Y-%m-%d')
+    # Collate into dataframe
+    projected_df = {
+        'report_date': proj_date.values
+        , 'location': np.repeat(p_location, p_days_to_project)
+        , 'daily_cases': np.repeat(np.NaN, p_days_to_project)
+        , 'smooth_cases': np.repeat(np.NaN, p_days_to_project)
+        , 'projected_cases': proj_cases
+        , 'projected_R_eff': np.repeat(p_R_eff, p_days_to_project)
+    }
+    if p_interval_multipliers is not None:
+        intervals = projection_intervals(p_curr_cases=p_scenario_grid['curr_cases']
+                                         , p_R_eff=p_R_eff
+                                         , p_days_to_project=p_days_to_project
+                                         , p_assum_mean_generation=p_scenario_grid['mean_generation']
+                                         , p_multipliers=p_interval_multipliers)
+        projected_df['projected_lower'] = intervals[0]
+        projected_df['projected_upper'] = intervals[-1]
+    projected_df = pd.DataFrame(projected_df)
 
-    # Current date and cases
-    curr_date = max(p_data["report_date"])
-    curr_cases = p_data[p_data["report_date"] == curr_date]["smooth_cases"].values[0]
+    return projected_df
 
-    # Projected date and cases -
-    proj_date = pd.Series(range(1, p_days_to_project + 1))
+# Function - Project cases for the easing scenario (see get_easing_projection), up to the days it was projected for.
+# Only the projected rows are returned. Adds the prediction interval as well if given interval multipliers
+# (see get_interval_multipliers)
+def project_cases_from_easing(p_days_to_project, p_location, p_easing, p_interval_multipliers=None):
 
-    proj_cases = curr_cases * p_R_eff ** (proj_date / p_assum_mean_generation)
-    proj_cases = round(proj_cases, 0).astype(int)
+    n_days = min(p_days_to_project, len(p_easing['cases']))
+    proj_cases = p_easing['cases'][:n_days]
 
-    proj_date = curr_date + pd.to_timedelta(proj_date, unit='d')
+    proj_date = p_easing['curr_date'] + pd.to_timedelta(np.arange(1, n_days + 1), unit='d')
 
     # Collate into dataframe
-    location = p_data["location"].unique()
-
     projected_df = {
         'report_date': proj_date.values
-        , 'location': np.repeat(location, p_days_to_project)
-        , 'daily_cases': np.repeat(np.NaN, p_days_to_project)
-        , 'smooth_cases': np.repeat(np.NaN, p_days_to_project)
-        , 'projected_cases': proj_cases.values
-        , 'projected_R_eff': np.repeat(p_R_eff, p_days_to_project)
+        , 'location': np.repeat(p_location, n_days)
+        , 'daily_cases': np.repeat(np.NaN, n_days)
+        , 'smooth_cases': np.repeat(np.NaN, n_days)
+        , 'projected_cases': np.round(proj_cases, 0)
+        , 'projected_R_eff': p_easing['R_eff'][:n_days]
     }
+    if p_interval_multipliers is not None:
+        projected_df['projected_lower'] = np.round(proj_cases * p_interval_multipliers[0, :n_days], 0)
+        projected_df['projected_upper'] = np.round(proj_cases * p_interval_multipliers[-1, :n_days], 0)
     projected_df = pd.DataFrame(projected_df)
 
-    new_data = pd.concat([p_data, projected_df])
+    return projected_df
+
+# Function: Rows in the Chart data table's columns and types
+def table_frame(p_data):
+    table_data = p_data.reindex(columns=table_cols)
+    to_float = {x: float for x in table_cols[2:] if table_data[x].dtype != float}
+
+    return table_data.astype(to_float) if to_float else table_data
+
+# Function: History rows of the Chart data table for a location, filtered by the table's filter query.
+# Memoised, so changing the projection only builds and filters the few projected rows, not the whole history
+@functools.lru_cache(maxsize=assum_cache_size)
+def get_table_history(p_location, p_rolling_window, p_assum_mean_generation, p_data_version, p_filter_query):
+
+    covid_df = compute_location_data(p_location=p_location
+                                     , p_rolling_window=p_rolling_window
+                                     , p_assum_mean_generation=p_assum_mean_generation
+                                     , p_data_version=p_data_version)
+
+    return filter_data(table_frame(covid_df), p_filter_query)
+
+### Function: x and y for each trace. Histories longer than p_max_points are downsampled to at most p_max_points
+# per trace over the whole history, plus up to p_max_points within p_x_range (the visible range, if zoomed in).
+# Returns (downsampled, trace data)
+def plot_trace_data(p_data, p_x_range=None, p_max_points=None, p_cols=plot_trace_cols):
+
+    report_date = pd.to_datetime(p_data['report_date'], format='%Y-%m-%d', utc = True)
+
+    downsample = (p_max_points is not None) and (len(p_data) > p_max_points)
+
+    trace_data = {}
+    for col in p_cols:
+        if downsample:
+            trace_data[col] = decimate_series(report_date, p_data[col], p_x_range, p_max_points)
+        else:
+            trace_data[col] = (report_date, p_data[col])
 
-    return new_data
+    return downsample, trace_data
 
 ### Function: Plot projected claiming
-def plot_projected_claims(p_data):
+# Long histories are drawn with WebGL (Scattergl) and downsampled - see plot_trace_data
+def plot_projected_claims(p_data, p_max_date, p_x_range=None, p_max_points=None):
 
-    plot_data = p_data
+    plot_data = p_data.copy()
 
     plot_data['report_date'] = pd.to_datetime(plot_data['report_date'], format='%Y-%m-%d', utc = True)
 
+    # x and y for each trace, downsampled if needed
+    downsample, trace_data = plot_trace_data(plot_data, p_x_range, p_max_points)
+    scatter = go.Scattergl if downsample else go.Scatter
+
     #fig = go.Figure()
-    # Create figure with secondary y-axis
+    # Create figure with secondary y-axis - plotly.subplots is only imported once a chart is first built
+    from plotly.subplots import make_subplots
     fig = make_subplots(specs=[[{"secondary_y": True}]])
 
     # Trace for daily cases
     fig.add_trace(
-        go.Scatter(x=plot_data['report_date']
-                   , y=plot_data['daily_cases']
-                   , mode="lines"
-                   , name="Reported cases"))
+        scatter(x=trace_data['daily_cases'][0]
+                , y=trace_data['daily_cases'][1]
+                , mode="lines"
+                , name="Reported cases"))
 
     # Trace for smoothed cases
     fig.add_trace(
-        go.Scatter(x=plot_data['report_date']
-                   , y=plot_data['smooth_cases']
-                   , mode="lines"
-                   , name="Smoothed trend (7-day average)"))
+        scatter(x=trace_data['smooth_cases'][0]
+                , y=trace_data['smooth_cases'][1]
+                , mode="lines"
+                , name="Smoothed trend (7-day average)"))
 
     # Trace for projected cases
     fig.add_trace(
-        go.Scatter(x=plot_data['report_date']
-                   , y=plot_data['projected_cases']
-                   , mode="lines"
-                   , line=dict(dash='dash')
-                   , name="Projected cases"))
+        scatter(x=trace_data['projected_cases'][0]
+                , y=trace_data['projected_cases'][1]
+                , mode="lines"
+                , line=dict(dash='dash')
+                , name="Projected cases"))
 
     # Trace for R_eff
     fig.add_trace(
-        go.Scatter(x=plot_data['report_date']
-                   , y=plot_data["R_eff"]
-                   , name="Estimated R_eff"
-                   , line=dict(color="grey")),
+        scatter(x=trace_data['R_eff'][0]
+                , y=trace_data['R_eff'][1]
+                , name="Estimated R_eff"
+                , line=dict(color="grey")),
         secondary_y=True,
     )
 
     # Trace for projected R_eff
     fig.add_trace(
-        go.Scatter(x=plot_data['report_date']
-                   , y=plot_data["projected_R_eff"]
-                   , name = "Projected R_eff"
-                   , line=dict(dash='dash', color="grey")),
+        scatter(x=trace_data['projected_R_eff'][0]
+                , y=trace_data['projected_R_eff'][1]
+                , name = "Projected R_eff"
+                , line=dict(dash='dash', color="grey")),
+        secondary_y=True,
+    )
+
+    # Traces for the prediction interval around projected cases - a band filled between the lower and upper
+    # quantiles. Filled in by the clientside projection callback, which finds them by meta
+    fig.add_trace(
+        go.Scatter(x=trace_data['projected_lower'][0]
+                   , y=trace_data['projected_lower'][1]
+                   , mode="lines"
+                   , line=dict(width=0)
+                   , meta="projected_lower"
+                   , name="Projected cases ({:.0%} quantile)".format(assum_interval_quantiles[0])
+                   , legendgroup="interval"
+                   , showlegend=False))
+
+    fig.add_trace(
+        go.Scatter(x=trace_data['projected_upper'][0]
+                   , y=trace_data['projected_upper'][1]
+                   , mode="lines"
+                   , line=dict(width=0)
+                   , fill="tonexty"
+                   , fillcolor="rgba(239, 85, 59, 0.2)"
+                   , meta="projected_upper"
+                   , name="{:.0%} prediction interval".format(assum_interval_quantiles[-1] - assum_interval_quantiles[0])
+                   , legendgroup="interval"))
+
+    # Traces for the renewal-equation R_eff, with its credible interval as a band
+    fig.add_trace(
+        scatter(x=trace_data['R_eff_renewal_lower'][0]
+                , y=trace_data['R_eff_renewal_lower'][1]
+                , mode="lines"
+                , line=dict(width=0)
+                , name="Renewal R_eff (2.5% quantile)"
+                , legendgroup="renewal"
+                , showlegend=False),
+        secondary_y=True,
+    )
+
+    fig.add_trace(
+        scatter(x=trace_data['R_eff_renewal_upper'][0]
+                , y=trace_data['R_eff_renewal_upper'][1]
+                , mode="lines"
+                , line=dict(width=0)
+                , fill="tonexty"
+                , fillcolor="rgba(47, 79, 79, 0.2)"
+                , name="Renewal R_eff (97.5% quantile)"
+                , legendgroup="renewal"
+                , showlegend=False),
+        secondary_y=True,
+    )
+
+    fig.add_trace(
+        scatter(x=trace_data['R_eff_renewal'][0]
+                , y=trace_data['R_eff_renewal'][1]
+                , mode="lines"
+                , name="Renewal R_eff (95% credible interval)"
+                , legendgroup="renewal"
+                , line=dict(color="darkslategrey")),
         secondary_y=True,
     )
 
@@ -449,6 +890,8 @@ def plot_projected_claims(p_data):
             xanchor="left",
             x=0.1)
         , margin={'t': 15}
+        # Keep the user's zoom when the figure is updated for the same location
+        , uirevision=str(plot_data['location'].iloc[0])
     )
     fig.update_yaxes(title_text="Daily cases", secondary_y=False)
     fig.update_yaxes(title_text="R_eff",
@@ -460,7 +903,7 @@ def plot_projected_claims(p_data):
 
     # Set default
     fig.update_xaxes(range = [
-        pd.to_datetime(max_date, format='%Y-%m-%d') - pd.to_timedelta(60, unit="d"),
+        pd.to_datetime(p_max_date, format='%Y-%m-%d') - pd.to_timedelta(60, unit="d"),
         plot_data["report_date"].max()
     ])
 
@@ -472,25 +915,25 @@ def plot_projected_claims(p_data):
                 direction = "left",
                 buttons = list([
                     dict(
-                        args=["xaxis.range", [pd.to_datetime(max_date, format='%Y-%m-%d') - pd.to_timedelta(30, unit="d"),
+                        args=["xaxis.range", [pd.to_datetime(p_max_date, format='%Y-%m-%d') - pd.to_timedelta(30, unit="d"),
                                         plot_data["report_date"].max()]],
                         label="1m",
                         method="relayout"
                     ),
                     dict(
-                        args=["xaxis.range", [pd.to_datetime(max_date, format='%Y-%m-%d') - pd.to_timedelta(60, unit="d"),
+                        args=["xaxis.range", [pd.to_datetime(p_max_date, format='%Y-%m-%d') - pd.to_timedelta(60, unit="d"),
                                         plot_data["report_date"].max()]],
                         label="2m",
                         method="relayout"
                     ),
                     dict(
-                        args=["xaxis.range", [pd.to_datetime(max_date, format='%Y-%m-%d') - pd.to_timedelta(90, unit="d"),
+                        args=["xaxis.range", [pd.to_datetime(p_max_date, format='%Y-%m-%d') - pd.to_timedelta(90, unit="d"),
                                         plot_data["report_date"].max()]],
                         label="3m",
                         method="relayout"
                     ),
                     dict(
-                        args=["xaxis.range", [pd.to_datetime(max_date, format='%Y-%m-%d') - pd.to_timedelta(180, unit="d"),
+                        args=["xaxis.range", [pd.to_datetime(p_max_date, format='%Y-%m-%d') - pd.to_timedelta(180, unit="d"),
                                         plot_data["report_date"].max()]],
                         label="6m",
                         method="relayout"
@@ -522,49 +965,135 @@ def plot_projected_claims(p_data):
     return fig
 
 
+# Function: Locations in the sensitivity heatmap - all of them, or the p_max_locations with the most cases
+# (latest smoothed cases) if there are more, in alphabetical order
+def sensitivity_locations(p_snapshot, p_max_locations):
+    batch = p_snapshot['batch']
+    if len(batch['locations']) <= p_max_locations:
+        return list(batch['locations'])
+
+    # Batch series are right-aligned, so the last column is each location's latest value
+    latest_cases = np.nan_to_num(batch['smooth_cases'][:, -1], nan=-1)
+    most_cases = np.sort(np.argsort(-latest_cases, kind='stable')[:p_max_locations])
+
+    return [batch['locations'][i] for i in most_cases]
+
+### Function: Heatmap of current R_eff for every state (rows) and each rolling window and mean generation period
+# (columns), from one sweep over all states (see sweep_all_locations). Memoised, as it only changes with the data.
+# With more than assum_sensitivity_max_locations locations, only those with the most cases are swept
+@functools.lru_cache(maxsize=assum_cache_size)
+def build_sensitivity_figure(p_data_version):
+
+    snapshot = get_snapshot(p_data_version)
+    locations = sensitivity_locations(p_snapshot=snapshot, p_max_locations=assum_sensitivity_max_locations)
+
+    with timed('sensitivity_sweep'):
+        sweep = sweep_all_locations(p_data={x: snapshot['store'][x] for x in locations}
+                                    , p_rolling_windows=assum_sweep_windows
+                                    , p_assum_mean_generations=assum_sweep_generations)
+    current_R_eff = sweep_current_R_eff(sweep)
+
+    current_R_eff['setting'] = current_R_eff['rolling_window'].astype(str) + 'd / ' \
+        + current_R_eff['mean_generation'].astype(str) + 'd'
+    heatmap_data = current_R_eff.pivot(index='location', columns='setting', values='R_eff')
+    # Keep the sweep's order for the columns - window, then generation
+    heatmap_data = heatmap_data[current_R_eff['setting'].unique()]
+
+    fig = go.Figure(
+        go.Heatmap(z=heatmap_data.values
+                   , x=heatmap_data.columns
+                   , y=heatmap_data.index
+                   , colorscale='RdBu_r'
+                   , zmid=1
+                   , texttemplate="%{z:.2f}"
+                   , colorbar=dict(title="R_eff")
+                   , hovertemplate="%{y}<br>Rolling window / mean generation: %{x}<br>R_eff: %{z:.2f}<extra></extra>"))
+
+    fig.update_layout(margin={'t': 15}
+                      , xaxis_title="Rolling window / mean generation"
+                      , yaxis=dict(autorange="reversed"))
+
+    return fig.to_dict()
+
+# Cache hits and misses are served on /metrics
+register_cache_gauges([compute_location_data, build_base_figure, get_scenario_grid, get_interval_multipliers
+                       , get_easing_projection, build_sensitivity_figure, get_table_history])
+
 # ------------- App callbacks --------------------
 # In Shiny, all this would go into a server.R script - investigate best practice in Dash
+# The app doesn't exist until create_app, so callbacks are collected here and registered on it there
+
+server_callbacks = []
+clientside_callbacks = []
+
+# Function: Decorator to use in place of app.callback
+def app_callback(*args, **kwargs):
+    def collect(p_func):
+        server_callbacks.append((args, kwargs, p_func))
+        return p_func
+    return collect
 
 # Callback for chart title
-@app.callback(
+@app_callback(
     Output('text_projected_chart_title', 'children'),
     [Input('input_location', 'value')]
 )
-
+@instrument_callback
 def print_chart_content_title(location):
     return 'Projected {} COVID-19 cases'.format(location)
 
+# Callback to search locations as the user types in the dropdown - prefix matches from the location index
+# (see SeriesStore.search), up to assum_location_search_limit of them. The selected location is always kept in the
+# options, otherwise the dropdown would show it as blank
+@app_callback(
+    Output('input_location', 'options'),
+    [Input('input_location', 'search_value')],
+    [State('input_location', 'value')]
+)
+@instrument_callback
+def update_location_options(search_value, location):
+    with timed('location_search'):
+        matches = get_snapshot()['store'].search(p_prefix=search_value or '', p_limit=assum_location_search_limit)
+
+    if (location is not None) and (location not in matches):
+        matches = [location] + matches
+
+    return [{'label': x, 'value': x} for x in matches]
+
 # First callback to process data and update dataframe
-@app.callback(
+@app_callback(
     [Output('intermediate_data', 'data'),
      Output('est_curr_R_eff', 'data')],
     [Input('input_location', 'value')]
 )
-
+@instrument_callback
 def update_data(input_location):
 
-    print("update_data")
-    print(input_location)
+    snapshot = get_snapshot()
 
-    # Process data and fetch required cols (report_date/location/daily_cases)
-    df = process_data(p_data=raw_covid_df
-                      , p_location=input_location)
+    # Not a location in the data, e.g. a default location the data doesn't have
+    if input_location not in snapshot['store']:
+        raise dash.exceptions.PreventUpdate
 
-    # Add smoothed trend
-    df = smooth_data(p_data=df
-                     , p_rolling_window=7)
+    # Process, smooth and estimate R_eff - served from memory if this location was requested before
+    key = location_data_key(p_location=input_location
+                            , p_rolling_window=assum_rolling_window
+                            , p_assum_mean_generation=assum_mean_generation
+                            , p_data_version=snapshot['data_version'])
+    df = get_location_data(key, snapshot)
 
-    # Estimate current effective reproduction rate
-    df = estimate_R_eff(p_data=df
-                        , p_assum_mean_generation=assum_mean_generation)
-
-    est_curr_R_eff = df[df['report_date'] == df["report_date"].max()]['R_eff'].values[0]
+    # As a plain float - missing (pd.NA) for short series, NaN or infinite when there were no lagged cases,
+    # none of which can go to the browser as JSON, so they're sent as no estimate (None)
+    est_curr_R_eff = float(df['R_eff'].astype(float).values[-1])
+    if not np.isfinite(est_curr_R_eff):
+        est_curr_R_eff = None
 
-    return df.to_json(date_format='iso', orient='split'), est_curr_R_eff
+    # Only the key goes to the browser
+    return key, est_curr_R_eff
 
 # Intermediate callback to change button (estimated or custom R_eff) colours on click
 # and store which button is clicked
-@app.callback(
+@app_callback(
     [Output("input_use_est", "style"), # Return styles of use estimated/custom R_eff buttons
      Output("input_use_cust", "style"),
      Output("store_estcust_mode", "value"), # Return value telling us which button user clicked
@@ -572,115 +1101,226 @@ def update_data(input_location):
     [Input("input_use_est", "n_clicks"),
      Input("input_use_cust", "n_clicks")]
 )
+@instrument_callback
 def set_active(est_clicks, cust_clicks): #*args
     ctx = dash.callback_context
 
     # get id of triggering button
     button_id = ctx.triggered[0]["prop_id"].split(".")[0]
 
-    print(button_id)
-    print(est_clicks)
-    print(cust_clicks)
-
     if (cust_clicks > 0) & (button_id == "input_use_cust"):
         return button_off_style, button_on_style, button_id, {"display":"block"}
     else:
         button_id = "input_use_est"
         return button_on_style, button_off_style, button_id, {"display":"none"}
 
-# Second callback to add projections and plot chart from processed data
-@app.callback(
+# Second callback to plot chart from processed data - runs only when the location (or data) changes,
+# or when the chart is zoomed and the history is long enough to be downsampled
+@app_callback(
+    [Output('store_fig_base', 'data'),
+     Output('store_projection_base', 'data')],
+    [Input('intermediate_data', 'data'),
+     Input('fig_projected_chart', 'relayoutData')]
+)
+@instrument_callback
+def update_plot(intermediate_data, relayout_data):
+
+    snapshot = get_snapshot()
+
+    ctx = dash.callback_context
+    if 'relayoutData' not in ctx.triggered[0]['prop_id']:
+        # New location or data - the base figure is cached, so this is only built once per location and data version
+        fig, projection_base = build_base_figure(p_location=intermediate_data['location']
+                                                 , p_rolling_window=intermediate_data['rolling_window']
+                                                 , p_assum_mean_generation=intermediate_data['mean_generation']
+                                                 , p_data_version=snapshot['data_version'])
+
+        return fig, projection_base
+
+    # Chart zoomed - the downsampled history traces get more detail within the visible range. Only those points are
+    # sent, for the traces they change, as a partial update of the base figure, and the browser draws them in place
+    # of the base figure's points in that range (assets/projection.js). Zooming back out removes them
+    x_range_changed, x_range = relayout_x_range(relayout_data)
+    if not x_range_changed:
+        raise dash.exceptions.PreventUpdate
+
+    covid_df = get_location_data(intermediate_data, snapshot)
+
+    # Zooming only changes anything if the history is downsampled
+    if len(covid_df) <= assum_max_plot_points:
+        raise dash.exceptions.PreventUpdate
+
+    fig_patch = Patch()
+    if x_range is None:
+        fig_patch['zoom_detail'] = None
+        return fig_patch, dash.no_update
+
+    covid_df = covid_df.astype({'smooth_cases': float, 'lag_cases': float, 'R_eff': float})
+
+    history_cols = ['daily_cases', 'smooth_cases', 'R_eff', 'R_eff_renewal_lower', 'R_eff_renewal_upper', 'R_eff_renewal']
+    with timed('figure_patch'):
+        report_date = pd.to_datetime(covid_df['report_date'], format='%Y-%m-%d', utc = True)
+
+        # Points to draw within the visible range, by trace index
+        zoom_detail = {}
+        for col in history_cols:
+            points = zoom_series(report_date, covid_df[col], x_range, assum_max_plot_points)
+            if points is not None:
+                zoom_detail[str(plot_trace_cols.index(col))] = {'x': points[0], 'y': points[1]}
+
+        fig_patch['zoom_detail'] = zoom_detail
+
+    return fig_patch, dash.no_update
+
+# Clientside callback to add projections to the chart (assets/projection.js).
+# Changing days to project or R_eff only reruns this in the browser, not the server callbacks above
+clientside_callbacks.append((
+    ClientsideFunction(namespace='projection', function_name='update_projection'),
     [Output('fig_projected_chart', 'figure'),
-     Output('tbl_projected', 'children'),
+     Output('store_projection', 'data'),
      Output('text_R_eff_print', 'children')],
-    [Input('intermediate_data', 'data'),
+    [Input('store_fig_base', 'data'),
+     Input('store_projection_base', 'data'),
      Input('est_curr_R_eff', 'data'),
      Input('input_days_to_project', 'value'),
      Input('store_estcust_mode', 'value'),
      Input('input_cust_R_eff', 'value'),
      Input('input_scenario_worse', 'n_clicks'),
-     Input('input_scenario_stable', 'n_clicks')]
+     Input('input_scenario_stable', 'n_clicks'),
+     Input('input_scenario_easing', 'n_clicks')]
+))
+
+# Callback for the sensitivity heatmap - the same for every location, so only rebuilt when the data changes
+@app_callback(
+    Output('fig_sensitivity_heatmap', 'figure'),
+    [Input('intermediate_data', 'data')]
 )
+@instrument_callback
+def update_sensitivity(intermediate_data):
 
-def update_plot(intermediate_data, est_curr_R_eff, input_days_to_project, store_estcust_mode,
-                input_cust_R_eff,input_scenario_worse, input_scenario_stable):
-
-    print("update_plot")
+    return build_sensitivity_figure(p_data_version=get_snapshot()['data_version'])
 
-    # Read back in intermediate data stored from previous callback
-    covid_df = pd.read_json(intermediate_data, orient='split')
-
-    # Get button clicked (scenarios)
-    ctx = dash.callback_context
-    changed_id = [p['prop_id'] for p in ctx.triggered][0]
-    print(changed_id)
-
-    # Define R_eff to use in projections
-    if (store_estcust_mode == "input_use_est") or (store_estcust_mode is None):
-        use_R_eff = est_curr_R_eff
-    elif 'input_scenario_worse' in changed_id:
-        use_R_eff = assum_worse
-    elif 'input_scenario_stable' in changed_id:
-        use_R_eff = assum_stable
-    else:
-        use_R_eff = input_cust_R_eff
-
-    print(use_R_eff)
-
-    # Add projections to covid_df
-    covid_df = project_cases_from_R_eff(
-        p_days_to_project=input_days_to_project
-        , p_data=covid_df
-        , p_R_eff=use_R_eff
-        , p_assum_mean_generation=assum_mean_generation
-    )
+# Clientside callback passing the data key and projection on to the table only while its tab is showing
+# (assets/projection.js), so changing R_eff or days to project on other tabs doesn't call the server
+clientside_callbacks.append((
+    ClientsideFunction(namespace='projection', function_name='update_table_input'),
+    Output('store_table_input', 'data'),
+    [Input('intermediate_data', 'data'),
+     Input('store_projection', 'data'),
+     Input('tabs_content', 'value')],
+    [State('store_table_input', 'data')]
+))
+
+# Callback for the Chart data table - filters, sorts and pages history plus projections on the server
+# and returns only the rows on the current page
+@app_callback(
+    [Output('tbl_projected_data', 'data'),
+     Output('tbl_projected_data', 'page_count')],
+    [Input('store_table_input', 'data'),
+     Input('tbl_projected_data', 'page_current'),
+     Input('tbl_projected_data', 'page_size'),
+     Input('tbl_projected_data', 'sort_by'),
+     Input('tbl_projected_data', 'filter_query')]
+)
+@instrument_callback
+def update_table(table_input, page_current, page_size, sort_by, filter_query):
+
+    if table_input is None:
+        raise dash.exceptions.PreventUpdate
+
+    intermediate_data = table_input['key']
+    store_projection = table_input['projection']
+    snapshot = get_snapshot()
+
+    # History rows are memoised - only the projected rows are built for each projection
+    with timed('table_history'):
+        history_df = get_table_history(p_location=intermediate_data['location']
+                                       , p_rolling_window=intermediate_data['rolling_window']
+                                       , p_assum_mean_generation=intermediate_data['mean_generation']
+                                       , p_data_version=snapshot['data_version']
+                                       , p_filter_query=filter_query or '')
+
+    # Projections and prediction intervals - same as those added to the chart in the browser
+    scenario_grid = get_scenario_grid(p_location=intermediate_data['location']
+                                      , p_rolling_window=intermediate_data['rolling_window']
+                                      , p_assum_mean_generation=intermediate_data['mean_generation']
+                                      , p_data_version=snapshot['data_version'])
+    interval_multipliers = get_interval_multipliers(p_location=intermediate_data['location']
+                                                    , p_rolling_window=intermediate_data['rolling_window']
+                                                    , p_assum_mean_generation=intermediate_data['mean_generation']
+                                                    , p_data_version=snapshot['data_version'])
+    easing = get_easing_projection(p_location=intermediate_data['location']
+                                   , p_rolling_window=intermediate_data['rolling_window']
+                                   , p_assum_mean_generation=intermediate_data['mean_generation']
+                                   , p_data_version=snapshot['data_version'])
+    with timed('projection'):
+        if store_projection['R_eff'] is None:
+            # Nothing projected in the browser (see update_projection) - history only
+            projected_df = table_frame(pd.DataFrame())
+        elif (store_projection.get('scenario') == 'easing') and (easing is not None):
+            projected_df = project_cases_from_easing(
+                p_days_to_project=store_projection['days_to_project']
+                , p_location=intermediate_data['location']
+                , p_easing=easing
+                , p_interval_multipliers=interval_multipliers
+            )
+        else:
+            projected_df = project_cases_from_grid(
+                p_days_to_project=store_projection['days_to_project']
+                , p_location=intermediate_data['location']
+                , p_scenario_grid=scenario_grid
+                , p_R_eff=store_projection['R_eff']
+                , p_interval_multipliers=interval_multipliers
+            )
+            projected_df = filter_data(table_frame(projected_df), filter_query)
 
-    # Generate plotly fig
-    fig = plot_projected_claims(p_data = covid_df)
-
-    print("fig ran")
-
-    ## Processing for table needs to be down here else doesn't run correctly (callback behaviour?)
-    # Convert dates read in as timestamps to just datetime
-    covid_df["report_date"] = pd.to_datetime(covid_df["report_date"]).apply(lambda x: x.date())
-    # Convert empty dicts {} read in from json to NaNs
-    covid_df = covid_df.explode('smooth_cases')
-    # Sort desc
-    covid_df = covid_df.sort_values(by='report_date', ascending=False)
-
-    # Generate table #["report_date", "location", "daily_cases", "smooth_cases", "R_eff"]
-    tbl_projected = html.Div([
-        dash_table.DataTable(
-            data=covid_df.to_dict('rows'),
-            columns=[{"name": x, "id": x} for x in ["report_date", "location", "daily_cases","smooth_cases",
-                                                    "projected_cases","R_eff", "projected_R_eff"]],
-            filter_action="native",
-            sort_action="native",
-            sort_mode="multi",
-            page_action="native",
-            page_current=0,
-            page_size=12,
-            style_header={'fontWeight': 'bold'},
-            style_cell={'font-family': 'Segoe UI'},
-            style_table={'overflowX': 'auto',
-                         "width": "77vw"},
-            # fix left-most column getting cut off
-            css=[{'selector': '.row', 'rule': 'margin: 0'}]
-        )
-    ])
-    print("table ran")
+    with timed('table_build'):
+        tbl_page, page_count = get_table_page(p_data=pd.concat([history_df, projected_df])
+                                              , p_filter_query=None
+                                              , p_sort_by=sort_by
+                                              , p_page_current=page_current
+                                              , p_page_size=page_size)
 
-    # Generate plot text
-    if store_estcust_mode == "input_use_est":
-        insert = 'an estimated current R_eff  of ' + str(est_curr_R_eff)
-    else:
-        insert = 'inputted R_eff of ' + str(use_R_eff)
+    return tbl_page, page_count
 
-    text = 'Projected cases are based on ' + insert + \
-            ' as at ' + str(datetime.datetime.strptime(max_date, '%Y-%m-%d').strftime('%d %B %Y')) + '.'
+# ------------- Initialize the app --------------------
 
-    return fig, tbl_projected, text
+# Function: Create the app - layout, callbacks and /metrics. The data isn't loaded here: each process starts loading
+# it in the background on its first request, or sooner with start_data_refresher, unless it was preloaded before the
+# process was forked (see wsgi.py)
+def create_app():
+    with timed('create_app'):
+        # Named, as otherwise Dash finds the name (for the assets folder) from the call stack, which is slow
+        app = dash.Dash(__name__, external_stylesheets=[
+            dbc.themes.BOOTSTRAP,
+            { # font-awesome
+                    "href": "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/5.15.3/css/all.min.css",
+                    "rel": "stylesheet",
+                    "integrity": "sha512-iBBXm8fW90+nuLcSKlbmrPcLa0OT92xO1BIsZ+ywDWZCvqsWgccV3gFoRBv0z+8dLJgyAHIhR35VZc2oM/gI1w==",
+                    "crossorigin": "anonymous",
+                    "referrerpolicy": "no-referrer",
+                }
+        ])
+        app.config.suppress_callback_exceptions = True
+        app.layout = app_layout
+
+        for args, kwargs, func in server_callbacks:
+            app.callback(*args, **kwargs)(func)
+        for args in clientside_callbacks:
+            app.clientside_callback(*args)
+
+        # Timings and payload sizes for every callback, served on /metrics
+        init_metrics(app.server, p_slow_request_seconds=assum_slow_request_seconds)
+
+        # A no-op once this process's refresher is running
+        app.server.before_request(start_data_refresher)
+
+    return app
 
 # ------------------ Run app -----------------------
+# For a multi-worker server, use the server in wsgi.py
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format=log_format)
+    app = create_app()
+    start_data_refresher()
     app.run_server(debug=False)
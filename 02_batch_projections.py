@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Batch projections - history and projections under every scenario for every location, written to one CSV or Parquet
+file without starting the dashboard, e.g. for a nightly reporting job:
+    python 02_batch_projections.py --output projections.csv --processes 4
+
+Runs the same pipeline as the dashboard (functions/pipeline.py) with the same assumptions (functions/assumptions.py),
+for chunks of locations across a process pool, writing each chunk as it finishes (see functions/reporting.py)
+"""
+
+# -------------- Load packages --------------------
+
+import argparse
+import importlib.util
+import os
+import time
+
+from functions.refresh import load_snapshot
+from functions.reporting import run_reports, write_report
+from functions.assumptions import secondary_github_data_web, assum_ingest_chunk_rows, assum_data_cache_dir
+from functions.assumptions import assum_mean_generation, assum_sd_generation, assum_rolling_window
+from functions.assumptions import assum_stable, assum_worse, assum_easing_half_life
+from functions.assumptions import assum_interval_quantiles, assum_simulation_paths, assum_R_eff_history_days
+
+
+# Function: Piecewise constant R_eff scenario from the command line - R_eff values and the days ahead each change
+# starts, alternately, e.g. '1.3:15:0.9' is 1.3 then 0.9 from day 15 ahead. Returns (R_eff values, change days),
+# raises ValueError if it isn't in that form
+def R_eff_steps(p_text):
+    parts = p_text.split(':')
+    values = [float(x) for x in parts[0::2]]
+    change_days = [int(x) for x in parts[1::2]]
+    if (len(values) != len(change_days) + 1) or any(not (x > 0) for x in values) \
+            or any(x < 1 for x in change_days) or any(x >= y for x, y in zip(change_days, change_days[1:])):
+        raise ValueError(p_text)
+
+    return values, change_days
+
+def main():
+    parser = argparse.ArgumentParser(description='Write history and projections under every scenario for every '
+                                                 'location to CSV or Parquet')
+    parser.add_argument('--output', required=True, help='file to write')
+    parser.add_argument('--format', choices=['csv', 'parquet']
+                        , help='output format (default from the output file extension, otherwise csv)')
+    parser.add_argument('--days-to-project', type=int, default=30, help='days projected (default %(default)s)')
+    parser.add_argument('--history-days', type=int
+                        , help='latest days of reported data included for each location (default all)')
+    parser.add_argument('--locations', help='comma-separated locations (default all)')
+    parser.add_argument('--R-eff', dest='R_eff'
+                        , help="comma-separated constant R_eff values projected as extra scenarios, e.g. 0.8,1.2 "
+                               "(reported as scenario 'R_eff=0.8' and so on)")
+    parser.add_argument('--R-eff-steps', dest='R_eff_steps', action='append', default=[]
+                        , help="piecewise constant R_eff projected as an extra scenario, as R_eff values and the "
+                               "days ahead each change starts, e.g. 1.3:15:0.9 for 1.3 then 0.9 from day 15 "
+                               "(reported as scenario 'R_eff=1.3:15:0.9'). Can be given more than once")
+    parser.add_argument('--processes', type=int, default=os.cpu_count()
+                        , help='processes computing projections (default %(default)s)')
+    parser.add_argument('--chunk-locations', type=int, default=50
+                        , help='locations computed and written at a time (default %(default)s)')
+    args = parser.parse_args()
+
+    output_format = args.format
+    if output_format is None:
+        output_format = 'parquet' if args.output.lower().endswith('.parquet') else 'csv'
+    # Checked before loading the data and computing every projection
+    if (output_format == 'parquet') and (importlib.util.find_spec('pyarrow') is None):
+        parser.error('writing Parquet needs pyarrow - install it, or write CSV instead')
+
+    scenarios = {'stable': assum_stable, 'worse': assum_worse}
+    if args.R_eff is not None:
+        try:
+            R_effs = [float(x) for x in args.R_eff.split(',')]
+        except ValueError:
+            parser.error('--R-eff must be comma-separated numbers')
+        if any(not (x > 0) for x in R_effs):
+            parser.error('--R-eff values must be positive')
+        scenarios.update(('R_eff={:g}'.format(x), x) for x in R_effs)
+
+    piecewise_scenarios = {}
+    for x in args.R_eff_steps:
+        try:
+            piecewise_scenarios['R_eff={}'.format(x)] = R_eff_steps(x)
+        except ValueError:
+            parser.error('--R-eff-steps must be positive R_eff values separated by increasing days ahead (at least 1)'
+                         ', e.g. 1.3:15:0.9')
+
+    start_time = time.perf_counter()
+
+    snapshot = load_snapshot(p_source=secondary_github_data_web
+                             , p_rolling_window=assum_rolling_window
+                             , p_assum_mean_generation=assum_mean_generation
+                             , p_assum_sd_generation=assum_sd_generation
+                             , p_cache_dir=assum_data_cache_dir
+                             , p_chunk_rows=assum_ingest_chunk_rows)
+
+    locations = sorted(snapshot['store'])
+    if args.locations is not None:
+        locations = [x.strip() for x in args.locations.split(',')]
+        unknown = [x for x in locations if x not in snapshot['store']]
+        if unknown:
+            parser.error('unknown locations: {}'.format(', '.join(unknown)))
+
+    settings = {
+        'p_days_to_project': args.days_to_project
+        , 'p_rolling_window': assum_rolling_window
+        , 'p_assum_mean_generation': assum_mean_generation
+        , 'p_assum_sd_generation': assum_sd_generation
+        , 'p_scenarios': scenarios
+        , 'p_piecewise_scenarios': piecewise_scenarios
+        , 'p_easing_half_life': assum_easing_half_life
+        , 'p_interval_quantiles': assum_interval_quantiles
+        , 'p_n_paths': assum_simulation_paths
+        , 'p_R_eff_history_days': assum_R_eff_history_days
+        , 'p_history_days': args.history_days
+    }
+
+    frames = run_reports(p_data=snapshot['store']
+                         , p_locations=locations
+                         , p_settings=settings
+                         , p_chunk_locations=args.chunk_locations
+                         , p_processes=args.processes)
+    n_rows = write_report(frames, args.output, output_format)
+
+    print('{} rows for {} locations (data to {}) written to {} in {:.1f}s'.format(
+        n_rows, len(locations), snapshot['max_date'], args.output, time.perf_counter() - start_time))
+
+if __name__ == '__main__':
+    main()
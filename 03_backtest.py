@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Backtest - replays the dashboard's projection from every historical date for every location, using the R_eff that
+would have been estimated then, and scores it against the cases reported afterwards, e.g.:
+    python 03_backtest.py --horizon 14 --rolling-windows 5,7,10 --output backtest.csv
+
+Prints MAE, MAPE and prediction interval coverage for each setting and horizon over all locations, and writes the
+scores for each location if given --output (see functions/backtest.py)
+"""
+
+# -------------- Load packages --------------------
+
+import argparse
+import os
+import time
+
+from functions.refresh import load_snapshot
+from functions.backtest import run_backtest, summarise_backtest
+from functions.assumptions import secondary_github_data_web, assum_ingest_chunk_rows, assum_data_cache_dir
+from functions.assumptions import assum_mean_generation, assum_sd_generation, assum_rolling_window
+from functions.assumptions import assum_interval_quantiles, assum_R_eff_history_days
+
+
+# Function: Comma-separated numbers from the command line as a list, e.g. '5,7' -> [5, 7]
+def number_list(p_text, p_type):
+    return [p_type(x) for x in p_text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Score projections from every historical date for every location')
+    parser.add_argument('--horizon', type=int, default=14, help='days ahead scored (default %(default)s)')
+    parser.add_argument('--rolling-windows', default=str(assum_rolling_window)
+                        , help='comma-separated rolling windows (days) backtested (default %(default)s)')
+    parser.add_argument('--mean-generations', default=str(assum_mean_generation)
+                        , help='comma-separated mean generation periods (whole days) backtested (default %(default)s)')
+    parser.add_argument('--target', choices=['daily_cases', 'smooth_cases'], default='daily_cases'
+                        , help='cases projections are scored against (default %(default)s)')
+    parser.add_argument('--locations', help='comma-separated locations (default all)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count()
+                        , help='processes backtesting settings and locations (default %(default)s)')
+    parser.add_argument('--chunk-locations', type=int, default=100
+                        , help='locations backtested at a time (default %(default)s)')
+    parser.add_argument('--output', help='CSV file for the scores for each location (default not written)')
+    args = parser.parse_args()
+
+    try:
+        rolling_windows = number_list(args.rolling_windows, int)
+        mean_generations = number_list(args.mean_generations, int)
+    except ValueError:
+        parser.error('--rolling-windows and --mean-generations must be comma-separated whole numbers')
+    if min([args.horizon] + rolling_windows + mean_generations) < 1:
+        parser.error('--horizon, --rolling-windows and --mean-generations must be at least 1')
+
+    start_time = time.perf_counter()
+
+    snapshot = load_snapshot(p_source=secondary_github_data_web
+                             , p_rolling_window=assum_rolling_window
+                             , p_assum_mean_generation=assum_mean_generation
+                             , p_assum_sd_generation=assum_sd_generation
+                             , p_cache_dir=assum_data_cache_dir
+                             , p_chunk_rows=assum_ingest_chunk_rows)
+
+    data = snapshot['store']
+    if args.locations is not None:
+        locations = [x.strip() for x in args.locations.split(',')]
+        unknown = [x for x in locations if x not in snapshot['store']]
+        if unknown:
+            parser.error('unknown locations: {}'.format(', '.join(unknown)))
+        data = {x: snapshot['store'][x] for x in locations}
+
+    results = run_backtest(p_data=data
+                           , p_settings=[(x, y) for x in rolling_windows for y in mean_generations]
+                           , p_assum_sd_generation=assum_sd_generation
+                           , p_horizon=args.horizon
+                           , p_quantiles=assum_interval_quantiles
+                           , p_history_days=assum_R_eff_history_days
+                           , p_target=args.target
+                           , p_chunk_locations=args.chunk_locations
+                           , p_processes=args.processes)
+
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+
+    print(summarise_backtest(results).to_string(index=False, float_format='{:.3f}'.format))
+    print('{} locations (data to {}) backtested in {:.1f}s{}'.format(
+        len(data), snapshot['max_date'], time.perf_counter() - start_time
+        , '' if args.output is None else ', scores for each location written to {}'.format(args.output)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+// Clientside callbacks for the dashy app - picked up automatically by Dash from the assets folder
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    projection: {
+        // Add projected cases and their prediction interval to the chart. Mirrors project_cases_from_R_eff:
+        // projected cases = current cases * R_eff ^ (t / mean generation), growing exponentially at a constant rate
+        update_projection: function(fig_base, projection_base, est_curr_R_eff, days_to_project,
+                                    store_estcust_mode, cust_R_eff, scenario_worse, scenario_stable,
+                                    scenario_easing) {
+
+            const no_update = window.dash_clientside.no_update;
+
+            if (!fig_base || !projection_base || !days_to_project) {
+                return [no_update, no_update, no_update];
+            }
+
+            // Get button clicked (scenarios)
+            const ctx = window.dash_clientside.callback_context;
+            const changed_id = ctx.triggered.length ? ctx.triggered[0].prop_id : '';
+
+            // Define R_eff to use in projections. The easing scenario starts from the estimated R_eff and follows
+            // the R_eff and cases projected on the server (see get_easing_projection)
+            let use_R_eff;
+            let easing = null;
+            let from_estimate = false;
+            if ((store_estcust_mode === 'input_use_est') || (store_estcust_mode == null)) {
+                use_R_eff = est_curr_R_eff;
+                from_estimate = true;
+            } else if (changed_id.includes('input_scenario_easing') && projection_base.easing) {
+                use_R_eff = est_curr_R_eff;
+                easing = projection_base.easing;
+                from_estimate = true;
+            } else if (changed_id.includes('input_scenario_worse')) {
+                use_R_eff = projection_base.assum_worse;
+            } else if (changed_id.includes('input_scenario_stable')) {
+                use_R_eff = projection_base.assum_stable;
+            } else {
+                use_R_eff = cust_R_eff;
+            }
+
+            // Points within the zoomed range for downsampled history traces, by trace index (see update_plot) -
+            // drawn in place of the base figure's points in that range. Dates are ISO strings, compared in order as
+            // text up to the seconds (the fraction and time zone may be written differently)
+            const zoom_detail = fig_base.zoom_detail || {};
+            const date_time = function(x) {
+                return String(x).slice(0, 19);
+            };
+            const add_zoom_detail = function(trace, detail) {
+                const first = date_time(detail.x[0]);
+                const last = date_time(detail.x[detail.x.length - 1]);
+                const x = [];
+                const y = [];
+                let i = 0;
+                for (; i < trace.x.length && date_time(trace.x[i]) < first; i++) {
+                    x.push(trace.x[i]);
+                    y.push(trace.y[i]);
+                }
+                Array.prototype.push.apply(x, detail.x);
+                Array.prototype.push.apply(y, detail.y);
+                for (; i < trace.x.length; i++) {
+                    if (date_time(trace.x[i]) > last) {
+                        x.push(trace.x[i]);
+                        y.push(trace.y[i]);
+                    }
+                }
+                return Object.assign({}, trace, {x: x, y: y});
+            };
+
+            // Nothing to project - too few reported days, no current estimate of R_eff (no cases to grow from, e.g.
+            // none at all or rising from none) or no custom R_eff entered. The history is shown alone, so nothing is
+            // left over from the previous location, and the table drops its projected rows
+            if ((use_R_eff == null) || (!easing && (projection_base.curr_cases == null))) {
+                let reason;
+                if (projection_base.curr_cases == null) {
+                    reason = 'There are too few reported days as at ' + projection_base.max_date_text
+                             + ' to project cases.';
+                } else if (from_estimate) {
+                    reason = 'There is no estimate of the current R_eff as at ' + projection_base.max_date_text
+                             + ' to project cases from.';
+                } else {
+                    reason = 'Enter an R_eff to project cases.';
+                }
+                const history = fig_base.data.map(function(trace, i) {
+                    return zoom_detail[i] ? add_zoom_detail(trace, zoom_detail[i]) : trace;
+                });
+                return [{data: history, layout: fig_base.layout}, {R_eff: null, days_to_project: days_to_project},
+                        reason];
+            }
+
+            // Projected date and cases - the easing scenario only goes as far as it was projected on the server
+            const n_days = easing ? Math.min(days_to_project, easing.cases.length) : days_to_project;
+            const projected = function(t) {
+                return easing ? easing.cases[t - 1]
+                              : projection_base.curr_cases * Math.pow(use_R_eff, t / projection_base.mean_generation);
+            };
+            const curr_time = Date.parse(projection_base.curr_date + 'T00:00:00Z');
+            const proj_date = [];
+            const proj_cases = [];
+            const proj_R_eff = [];
+            for (let t = 1; t <= n_days; t++) {
+                proj_date.push(new Date(curr_time + t * 86400000).toISOString().slice(0, 10));
+                proj_cases.push(Math.round(projected(t)));
+                proj_R_eff.push(easing ? easing.R_eff[t - 1] : use_R_eff);
+            }
+
+            // Prediction interval - the projection times the simulated lower and upper quantile multipliers for
+            // each day ahead (see projection_intervals), up to the number of days simulated
+            const multipliers = projection_base.interval_multipliers || [[], []];
+            const n_interval = Math.min(n_days, multipliers[0].length);
+            const proj_lower = [];
+            const proj_upper = [];
+            for (let t = 1; t <= n_interval; t++) {
+                const proj = projected(t);
+                proj_lower.push(Math.round(proj * multipliers[0][t - 1]));
+                proj_upper.push(Math.round(proj * multipliers[multipliers.length - 1][t - 1]));
+            }
+            const last_date = proj_date[proj_date.length - 1];
+
+            // Replace the (empty) projected traces
+            const data = fig_base.data.map(function(trace, i) {
+                if (zoom_detail[i]) {
+                    return add_zoom_detail(trace, zoom_detail[i]);
+                } else if (trace.name === 'Projected cases') {
+                    return Object.assign({}, trace, {x: proj_date, y: proj_cases});
+                } else if (trace.name === 'Projected R_eff') {
+                    return Object.assign({}, trace, {x: proj_date, y: proj_R_eff});
+                } else if (trace.meta === 'projected_lower') {
+                    return Object.assign({}, trace, {x: proj_date.slice(0, n_interval), y: proj_lower});
+                } else if (trace.meta === 'projected_upper') {
+                    return Object.assign({}, trace, {x: proj_date.slice(0, n_interval), y: proj_upper});
+                }
+                return trace;
+            });
+
+            // Extend the x-axis range and range buttons out to the end of the projection
+            const layout = Object.assign({}, fig_base.layout);
+            layout.xaxis = Object.assign({}, layout.xaxis, {range: [layout.xaxis.range[0], last_date]});
+            layout.updatemenus = layout.updatemenus.map(function(menu) {
+                return Object.assign({}, menu, {
+                    buttons: menu.buttons.map(function(button) {
+                        return Object.assign({}, button, {args: [button.args[0], [button.args[1][0], last_date]]});
+                    })
+                });
+            });
+
+            // Projected rows for the table are added on the server, which only needs the R_eff and days used
+            const projection = {R_eff: use_R_eff, days_to_project: days_to_project};
+            if (easing) {
+                projection.scenario = 'easing';
+            }
+
+            // Generate plot text
+            let insert;
+            if (store_estcust_mode === 'input_use_est') {
+                insert = 'an estimated current R_eff  of ' + est_curr_R_eff;
+            } else if (easing) {
+                insert = 'R_eff easing toward 1 from an estimated current R_eff of ' + est_curr_R_eff;
+            } else {
+                insert = 'inputted R_eff of ' + use_R_eff;
+            }
+            const text = 'Projected cases are based on ' + insert + ' as at ' + projection_base.max_date_text + '.';
+
+            return [{data: data, layout: layout}, projection, text];
+        },
+
+        // Pass the data key and projection on to the Chart data table, only while its tab is showing and only if
+        // they've changed - the table is built on the server, so this saves a request for every change made on
+        // other tabs. Switching to the tab brings the table up to date
+        update_table_input: function(intermediate_data, projection, tab, table_input) {
+
+            const no_update = window.dash_clientside.no_update;
+
+            if (tab !== 'tab_table' || !intermediate_data || !projection) {
+                return no_update;
+            }
+
+            const new_input = {key: intermediate_data, projection: projection};
+            if (JSON.stringify(new_input) === JSON.stringify(table_input)) {
+                return no_update;
+            }
+
+            return new_input;
+        }
+    }
+});
@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks for the data and callback pipeline - run with python -m benchmarks.run_benchmarks
+"""
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the data and callback pipeline - runs offline against synthetic stand-ins for the source
+(see synthetic_data.py), from 8 states x 2 years up to thousands of locations x 10 years. Reports time and peak
+memory for each stage and writes the results as JSON, so runs from different commits can be compared.
+
+Startup is timed in a fresh interpreter each run (see startup_probe.py), with a breakdown of the app's import time.
+
+Run from the repo root:
+    python -m benchmarks.run_benchmarks --scales 8x2,100x10 --output results.json
+    python -m benchmarks.run_benchmarks --compare results_before.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from functions.disk_cache import content_hash
+from functions.refresh import ingest_source, build_snapshot
+from functions.pipeline import process_data, smooth_data, estimate_R_eff, estimate_R_eff_renewal
+from functions.projection import R_eff_decay
+from functions.renewal import generation_interval_weights, simulate_renewal
+from benchmarks.synthetic_data import write_synthetic_source
+from benchmarks.startup_probe import callback_payload, import_start_marker, import_end_marker
+
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Locations x years
+default_scales = '8x2,8x10,100x10,1000x10'
+
+# Days projected in the projection stages
+assum_days_to_project = 30
+
+# Easing trajectories (R_eff decaying toward 1 from starting values spread over 0.5 to 2) projected for every
+# location at once in the renewal projection stage
+assum_renewal_trajectories = 100
+
+# Stages slower than this ratio to the compared results are flagged
+assum_regression_ratio = 1.2
+
+
+# Function: Time p_func over p_repeats runs (p_setup, if given, runs untimed before each), then run it once more
+# under tracemalloc for its peak memory. Returns (timings, result of the last run)
+def measure(p_func, p_repeats, p_setup=None, p_trace_memory=True):
+    times = []
+    for i in range(p_repeats):
+        if p_setup is not None:
+            p_setup()
+        start_time = time.perf_counter()
+        result = p_func()
+        times.append(time.perf_counter() - start_time)
+
+    peak_memory_mb = None
+    if p_trace_memory:
+        if p_setup is not None:
+            p_setup()
+        tracemalloc.start()
+        try:
+            result = p_func()
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peak_memory_mb = peak_memory / 2 ** 20
+
+    timings = {
+        'seconds_min': min(times)
+        , 'seconds_median': statistics.median(times)
+        , 'peak_memory_mb': peak_memory_mb
+    }
+
+    return timings, result
+
+# Function: Environment for the app with its data source set to p_source, caching under p_cache_dir
+def app_environ(p_source, p_cache_dir):
+    return dict(os.environ
+                , COVID_DATA_SOURCE=p_source
+                , COVID_DATA_CACHE_DIR=os.path.join(p_cache_dir, 'data')
+                , COVID_FRAME_CACHE_DIR=os.path.join(p_cache_dir, 'frames')
+                # Loaded once - each scale is swapped in directly below
+                , COVID_REFRESH_INTERVAL=str(10 ** 9))
+
+# Function: Import and create the app with its data source set to p_source, caching under p_cache_dir, and load
+# the data. Returns (app module, app)
+def load_app(p_source, p_cache_dir):
+    os.environ.update(app_environ(p_source, p_cache_dir))
+
+    spec = importlib.util.spec_from_file_location('dashy_app', os.path.join(repo_dir, '01_dashy_app.py'))
+    app_module = importlib.util.module_from_spec(spec)
+    sys.modules['dashy_app'] = app_module
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(app_module)
+        app = app_module.create_app()
+        app_module.preload_data()
+
+    return app_module, app
+
+# Function: Call a (multi-output) callback through the app's HTTP endpoint, as the browser does
+def post_callback(p_client, p_outputs, p_inputs, p_changed_prop_id):
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = p_client.post('/_dash-update-component'
+                                 , json=callback_payload(p_outputs, p_inputs, p_changed_prop_id))
+    if response.status_code != 200:
+        raise RuntimeError('callback failed with status {}'.format(response.status_code))
+
+    return response.get_json()
+
+# Function: Result for one stage at one scale
+def scale_result(p_n_locations, p_n_years, p_rows, p_stage, p_timings):
+    return dict({'scale': '{}x{}'.format(p_n_locations, p_n_years), 'n_locations': p_n_locations
+                 , 'n_years': p_n_years, 'rows': p_rows, 'stage': p_stage}, **p_timings)
+
+# Function: Import times of the modules the app imports directly, from the python -X importtime output of the
+# startup probe. Each module's time includes the modules it imports in turn - the rest of p_import_seconds is the
+# app module's own body
+def import_breakdown(p_importtime_output, p_import_seconds):
+    lines = p_importtime_output.splitlines()
+    lines = lines[lines.index(import_start_marker) + 1:lines.index(import_end_marker)]
+
+    breakdown = []
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        # Only modules imported directly, not those they import in turn (indented further)
+        if not name.startswith('  '):
+            breakdown.append({'module': name.strip(), 'seconds': int(cumulative) / 10 ** 6})
+
+    breakdown.append({'module': '01_dashy_app (module body)'
+                      , 'seconds': p_import_seconds - sum(x['seconds'] for x in breakdown)})
+
+    return sorted(breakdown, key=lambda x: -x['seconds'])
+
+# Function: Benchmark startup as a pre-forking server's master and worker processes see it - each run in a fresh
+# interpreter (see startup_probe.py), after a first run to fill the disk cache of the source data.
+# Returns (results, one per stage, import breakdown of the last run)
+def benchmark_startup(p_source, p_work_dir, p_n_locations, p_n_years, p_rows, p_repeats):
+    runs = []
+    for i in range(p_repeats + 1):
+        # Frames aren't cached from earlier runs, as for a location a worker hasn't served yet
+        cache_dir = os.path.join(p_work_dir, 'startup')
+        shutil.rmtree(os.path.join(cache_dir, 'frames'), ignore_errors=True)
+
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-W', 'ignore', '-m', 'benchmarks.startup_probe']
+                                 , cwd=repo_dir, env=app_environ(p_source, cache_dir), capture_output=True, text=True)
+        if process.returncode != 0:
+            raise RuntimeError('startup probe failed: {}'.format(process.stderr[-2000:]))
+        if i > 0:
+            runs.append(json.loads(process.stdout.splitlines()[-1]))
+
+    results = []
+    for stage in runs[0]:
+        times = [x[stage] for x in runs if x[stage] is not None]
+        if times:
+            results.append(scale_result(p_n_locations, p_n_years, p_rows, stage
+                                        , {'seconds_min': min(times), 'seconds_median': statistics.median(times)
+                                           , 'peak_memory_mb': None}))
+
+    return results, import_breakdown(process.stderr, runs[-1]['startup_import'])
+
+# Function: Benchmark each stage for one scale. Returns a list of results, one per stage
+def benchmark_scale(p_app, p_server, p_source, p_n_locations, p_n_years, p_rows, p_repeats):
+    results = []
+
+    def record(p_stage, p_timings):
+        results.append(scale_result(p_n_locations, p_n_years, p_rows, p_stage, p_timings))
+
+    # Load - ingest_source traces its own peak memory when asked to
+    timings, (series, meta) = measure(
+        lambda: ingest_source(p_source, content_hash(p_source), p_app.assum_ingest_chunk_rows, p_trace_memory=True)
+        , p_repeats, p_trace_memory=False)
+    timings['peak_memory_mb'] = meta['ingest_peak_memory_mb']
+    record('ingest_source', timings)
+
+    timings, snapshot = measure(
+        lambda: build_snapshot(series, meta, p_app.assum_rolling_window, p_app.assum_mean_generation
+                               , p_app.assum_sd_generation)
+        , p_repeats)
+    record('build_snapshot', timings)
+
+    # Refresh when the source gains a day - batch results updated from the snapshot of the data before it
+    latest = series['report_date'] == series['report_date'].max()
+    previous_series = dict(series, **{x: series[x][~latest] for x in ['report_date', 'location', 'daily_cases']})
+    previous = build_snapshot(previous_series, meta, p_app.assum_rolling_window, p_app.assum_mean_generation
+                              , p_app.assum_sd_generation)
+    timings, _ = measure(
+        lambda: build_snapshot(series, meta, p_app.assum_rolling_window, p_app.assum_mean_generation
+                               , p_app.assum_sd_generation, p_previous=previous)
+        , p_repeats)
+    record('update_snapshot', timings)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        p_app.set_snapshot(snapshot)
+
+    # Pandas pipeline for one location
+    store = snapshot['store']
+    location = 'NSW' if 'NSW' in store else sorted(store)[0]
+
+    timings, df = measure(lambda: process_data(p_data=store, p_location=location), p_repeats)
+    record('process_data', timings)
+
+    timings, df = measure(lambda: smooth_data(p_data=df, p_rolling_window=p_app.assum_rolling_window)
+                          , p_repeats)
+    record('smooth_data', timings)
+
+    timings, df = measure(lambda: estimate_R_eff(p_data=df, p_assum_mean_generation=p_app.assum_mean_generation)
+                          , p_repeats)
+    record('estimate_R_eff', timings)
+
+    timings, df = measure(lambda: estimate_R_eff_renewal(p_data=df
+                                                         , p_rolling_window=p_app.assum_rolling_window
+                                                         , p_assum_mean_generation=p_app.assum_mean_generation
+                                                         , p_assum_sd_generation=p_app.assum_sd_generation)
+                          , p_repeats)
+    record('estimate_R_eff_renewal', timings)
+
+    # As build_base_figure prepares the frame
+    df = df.astype({'smooth_cases': float, 'lag_cases': float, 'R_eff': float})
+    est_curr_R_eff = df['R_eff'].values[-1]
+
+    # Projection as the app makes it - the scenario grid for the location (see get_scenario_grid), then a lookup
+    # for one R_eff (see update_table)
+    timings, scenario_grid = measure(lambda: p_app.build_scenario_grid(p_curr_date=max(df['report_date'])
+                                                                       , p_curr_cases=df['smooth_cases'].values[-1]
+                                                                       , p_max_days=p_app.assum_max_days_to_project
+                                                                       , p_assum_mean_generation=p_app.assum_mean_generation
+                                                                       , p_R_eff_values=p_app.scenario_R_eff_values())
+                                     , p_repeats)
+    record('scenario_grid', timings)
+
+    timings, projected_df = measure(lambda: p_app.project_cases_from_grid(p_days_to_project=assum_days_to_project
+                                                                          , p_location=location
+                                                                          , p_scenario_grid=scenario_grid
+                                                                          , p_R_eff=est_curr_R_eff)
+                                    , p_repeats)
+    record('project_cases_from_grid', timings)
+    projected_df = pd.concat([df, projected_df], ignore_index=True)
+
+    # Renewal projection for every location against a library of easing trajectories at once (location x
+    # trajectory x days ahead), from each location's latest daily cases
+    weights = generation_interval_weights(p_app.assum_mean_generation, p_app.assum_sd_generation)
+    recent_cases = np.zeros((len(store), len(weights) - 1))
+    for i, x in enumerate(store):
+        values = store[x]['daily_cases'][-recent_cases.shape[1]:]
+        recent_cases[i, recent_cases.shape[1] - len(values):] = values
+    R_eff = R_eff_decay(p_R_eff_start=np.linspace(0.5, 2, assum_renewal_trajectories)
+                        , p_days=assum_days_to_project
+                        , p_half_life=p_app.assum_easing_half_life)
+
+    timings, proj_cases = measure(lambda: simulate_renewal(p_recent_cases=recent_cases[:, np.newaxis, :]
+                                                           , p_R_eff=R_eff
+                                                           , p_weights=weights)
+                                  , p_repeats)
+    record('simulate_renewal', timings)
+
+    projected_df = projected_df.assign(projected_lower=np.NaN, projected_upper=np.NaN)
+    timings, fig = measure(lambda: p_app.plot_projected_claims(p_data=projected_df
+                                                               , p_max_date=snapshot['max_date']
+                                                               , p_max_points=p_app.assum_max_plot_points)
+                           , p_repeats)
+    record('plot_projected_claims', timings)
+
+    # Callbacks end to end through the server - cold with every cache cleared, then warm
+    client = p_server.test_client()
+
+    def clear_caches():
+        with contextlib.redirect_stdout(io.StringIO()):
+            p_app.set_snapshot(p_app.get_snapshot())
+        shutil.rmtree(p_app.assum_cache_dir, ignore_errors=True)
+
+    def update_data():
+        return post_callback(client
+                             , [('intermediate_data', 'data'), ('est_curr_R_eff', 'data')]
+                             , [('input_location', 'value', location)]
+                             , 'input_location.value')
+
+    timings, response = measure(update_data, p_repeats, p_setup=clear_caches)
+    record('update_data_cold', timings)
+    timings, response = measure(update_data, p_repeats)
+    record('update_data_warm', timings)
+
+    key = response['response']['intermediate_data']['data']
+
+    def update_plot():
+        return post_callback(client
+                             , [('store_fig_base', 'data'), ('store_projection_base', 'data')]
+                             , [('intermediate_data', 'data', key), ('fig_projected_chart', 'relayoutData', None)]
+                             , 'intermediate_data.data')
+
+    timings, response = measure(update_plot, p_repeats, p_setup=clear_caches)
+    record('update_plot_cold', timings)
+    timings, response = measure(update_plot, p_repeats)
+    record('update_plot_warm', timings)
+
+    return results
+
+# Function: Commit and environment the benchmarks were run in
+def run_metadata(p_repeats):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True
+                                , check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds')
+        , 'commit': commit
+        , 'python': platform.python_version()
+        , 'numpy': np.__version__
+        , 'pandas': pd.__version__
+        , 'platform': platform.platform()
+        , 'cpu_count': os.cpu_count()
+        , 'repeats': p_repeats
+    }
+
+# Function: Median times against results from another run, flagging stages slower by more than
+# assum_regression_ratio
+def compare_results(p_results, p_previous):
+    current = pd.DataFrame(p_results).set_index(['scale', 'stage'])['seconds_median']
+    previous = pd.DataFrame(p_previous).set_index(['scale', 'stage'])['seconds_median']
+
+    comparison = pd.DataFrame({'seconds_before': previous, 'seconds_after': current}).dropna()
+    comparison['ratio'] = comparison['seconds_after'] / comparison['seconds_before']
+    comparison['regression'] = comparison['ratio'] > assum_regression_ratio
+
+    return comparison
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data and callback pipeline on synthetic data')
+    parser.add_argument('--scales', default=default_scales
+                        , help='comma-separated locations x years, e.g. 8x2,1000x10 (default %(default)s)')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs per stage (default %(default)s)')
+    parser.add_argument('--output', default='benchmark_results.json', help='results file (default %(default)s)')
+    parser.add_argument('--compare', help='results file from an earlier run to compare against')
+    args = parser.parse_args()
+
+    scales = [tuple(float(y) if '.' in y else int(y) for y in x.split('x')) for x in args.scales.split(',')]
+
+    work_dir = tempfile.mkdtemp(prefix='covid_dashy_benchmark_')
+    try:
+        results = []
+        app_module = None
+        for n_locations, n_years in scales:
+            source = os.path.join(work_dir, 'source_{}x{}.csv'.format(n_locations, n_years))
+            rows = write_synthetic_source(source, n_locations, n_years)
+            print('{} locations x {} years: {} rows'.format(n_locations, n_years, rows))
+
+            startup_results, breakdown = benchmark_startup(source, work_dir, n_locations, n_years, rows, args.repeats)
+            results += startup_results
+
+            if app_module is None:
+                app_module, app = load_app(source, work_dir)
+
+            results += benchmark_scale(app_module, app.server, source, n_locations, n_years, rows, args.repeats)
+            os.remove(source)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({'metadata': run_metadata(args.repeats), 'results': results, 'import_breakdown': breakdown}, f
+                  , indent=2)
+
+    summary = pd.DataFrame(results).set_index(['scale', 'stage'])[['seconds_median', 'peak_memory_mb']]
+    print(summary.to_string(float_format='{:.4f}'.format))
+    print('slowest imports at startup:')
+    print(pd.DataFrame(breakdown).head(10).to_string(index=False, float_format='{:.4f}'.format))
+    print('results written to {}'.format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+        print(compare_results(results, previous).to_string(float_format='{:.4f}'.format))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Startup probe - run in a fresh interpreter by run_benchmarks (python -X importtime -m benchmarks.startup_probe).
+Times importing the app, creating it and preloading the data as the master process of a pre-forking server does
+(see wsgi.py), then forks a worker and times it serving its first requests. Prints the timings as JSON.
+Only imports the standard library itself, so the import times are all the app's
+"""
+
+import contextlib
+import importlib
+import io
+import json
+import os
+import sys
+import time
+
+
+# Written to stderr around the app's import, to pick its imports out of the -X importtime output
+import_start_marker = 'startup_probe: importing app'
+import_end_marker = 'startup_probe: imported app'
+
+
+# Function: Body of a Dash callback request, as the browser sends it
+def callback_payload(p_outputs, p_inputs, p_changed_prop_id):
+    return {
+        'output': '..' + '...'.join('{}.{}'.format(*x) for x in p_outputs) + '..'
+        , 'outputs': [{'id': x[0], 'property': x[1]} for x in p_outputs]
+        , 'inputs': [{'id': x[0], 'property': x[1], 'value': x[2]} for x in p_inputs]
+        , 'changedPropIds': [p_changed_prop_id]
+        , 'state': []
+    }
+
+# Function: Serve the requests a new page load starts with - the layout, then the data for a location
+def first_requests(p_server, p_location):
+    client = p_server.test_client()
+    client.get('/_dash-layout')
+    response = client.post('/_dash-update-component'
+                           , json=callback_payload([('intermediate_data', 'data'), ('est_curr_R_eff', 'data')]
+                                                   , [('input_location', 'value', p_location)]
+                                                   , 'input_location.value'))
+    if response.status_code != 200:
+        raise RuntimeError('callback failed with status {}'.format(response.status_code))
+
+# Function: Fork a worker from this process and time it serving its first requests. Returns seconds from the fork
+# to the worker's first response, or None where fork isn't available
+def time_forked_worker(p_server, p_location):
+    if not hasattr(os, 'fork'):
+        return None
+
+    read_fd, write_fd = os.pipe()
+    start_time = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                first_requests(p_server, p_location)
+            os.write(write_fd, repr(time.perf_counter() - start_time).encode())
+            status = 0
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        seconds = f.read()
+    os.waitpid(pid, 0)
+
+    if not seconds:
+        raise RuntimeError('forked worker failed to serve its first requests')
+
+    return float(seconds)
+
+def main():
+    timings = {}
+
+    print(import_start_marker, file=sys.stderr, flush=True)
+    start_time = time.perf_counter()
+    dashy_app = importlib.import_module('01_dashy_app')
+    timings['startup_import'] = time.perf_counter() - start_time
+    print(import_end_marker, file=sys.stderr, flush=True)
+
+    start_time = time.perf_counter()
+    app = dashy_app.create_app()
+    timings['startup_create_app'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        dashy_app.preload_data()
+    timings['startup_preload_data'] = time.perf_counter() - start_time
+
+    location = sorted(dashy_app.get_snapshot()['store'])[0]
+    timings['startup_worker_first_response'] = time_forked_worker(app.server, location)
+
+    print(json.dumps(timings))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Stress test for concurrent callbacks - many threads call update_data, update_plot (new location and zoom) and
+update_table through the app's HTTP endpoint, as browsers do, while another thread keeps swapping the data between
+two snapshots, as a refresh does. Every response is checked against the response computed single-threaded for the
+data the callback ran on, so a callback that mixed data from both snapshots or from another request is caught.
+Runs offline against synthetic data (see synthetic_data.py), and exits with status 1 on any mismatch or failed
+request.
+
+Run from the repo root:
+    python -m benchmarks.stress_callbacks --threads 16 --requests 200
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from functions.refresh import load_snapshot
+from benchmarks.synthetic_data import write_synthetic_source
+from benchmarks.startup_probe import callback_payload
+from benchmarks.run_benchmarks import load_app
+
+
+# Projection the table is built with - fixed, so table responses only depend on the data
+assum_table_projection = {'R_eff': 1.1, 'days_to_project': 30}
+
+# Zoomed x-axis range, as the chart sends it - within the synthetic data's dates
+assum_zoom_range = {'xaxis.range[0]': '2020-06-01', 'xaxis.range[1]': '2020-09-01'}
+
+
+# Function: Call a callback through the app's HTTP endpoint. Returns the response JSON, or None if the callback
+# didn't update anything
+def post_callback(p_client, p_outputs, p_inputs, p_changed_prop_id):
+    response = p_client.post('/_dash-update-component'
+                             , json=callback_payload(p_outputs, p_inputs, p_changed_prop_id))
+    if response.status_code == 204:
+        return None
+    if response.status_code != 200:
+        raise RuntimeError('callback failed with status {}'.format(response.status_code))
+
+    return response.get_json()
+
+# Function: Responses to the callbacks a browser calls for p_location, in order - the data key, then the chart,
+# the zoomed chart and the table for that key. Returns {callback: response}
+def location_responses(p_client, p_location):
+    responses = {}
+    responses['update_data'] = post_callback(p_client
+                                             , [('intermediate_data', 'data'), ('est_curr_R_eff', 'data')]
+                                             , [('input_location', 'value', p_location)]
+                                             , 'input_location.value')
+    key = responses['update_data']['response']['intermediate_data']['data']
+
+    responses['update_plot'] = post_callback(p_client
+                                             , [('store_fig_base', 'data'), ('store_projection_base', 'data')]
+                                             , [('intermediate_data', 'data', key)
+                                                , ('fig_projected_chart', 'relayoutData', None)]
+                                             , 'intermediate_data.data')
+    responses['update_plot_zoom'] = post_callback(p_client
+                                                  , [('store_fig_base', 'data'), ('store_projection_base', 'data')]
+                                                  , [('intermediate_data', 'data', key)
+                                                     , ('fig_projected_chart', 'relayoutData', assum_zoom_range)]
+                                                  , 'fig_projected_chart.relayoutData')
+    responses['update_table'] = post_callback(p_client
+                                              , [('tbl_projected_data', 'data'), ('tbl_projected_data', 'page_count')]
+                                              , [('store_table_input', 'data'
+                                                  , {'key': key, 'projection': assum_table_projection})
+                                                 , ('tbl_projected_data', 'page_current', 0)
+                                                 , ('tbl_projected_data', 'page_size', 12)
+                                                 , ('tbl_projected_data', 'sort_by', [])
+                                                 , ('tbl_projected_data', 'filter_query', '')]
+                                              , 'store_table_input.data')
+
+    return responses
+
+# Function: Check the responses from one run of location_responses against the single-threaded references
+# (p_references: {data version: {location: responses}}). The data key must match the data for its version; every
+# other callback runs on whichever snapshot is current, so must match the reference of one version.
+# Returns a list of the callbacks that didn't match
+def check_responses(p_responses, p_location, p_references):
+    version = p_responses['update_data']['response']['intermediate_data']['data']['data_version']
+    mismatches = []
+    if p_responses['update_data'] != p_references[version][p_location]['update_data']:
+        mismatches.append('update_data')
+
+    for callback in ['update_plot', 'update_plot_zoom', 'update_table']:
+        if all(p_responses[callback] != x[p_location][callback] for x in p_references.values()):
+            mismatches.append(callback)
+
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser(description='Run callbacks from many threads while the data is swapped, and '
+                                                 'check every response')
+    parser.add_argument('--locations', type=int, default=8, help='synthetic locations (default %(default)s)')
+    parser.add_argument('--years', type=float, default=3, help='synthetic years of data (default %(default)s)')
+    parser.add_argument('--threads', type=int, default=16, help='threads calling callbacks (default %(default)s)')
+    parser.add_argument('--requests', type=int, default=200
+                        , help='locations requested in total, four callbacks each (default %(default)s)')
+    parser.add_argument('--swap-seconds', type=float, default=0.05
+                        , help='seconds between snapshot swaps (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the locations requested (default %(default)s)')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='covid_dashy_stress_')
+    try:
+        # Two versions of the data - the app loads the first, and the second is swapped in and out
+        sources = [os.path.join(work_dir, 'source_{}.csv'.format(i)) for i in range(2)]
+        for i, source in enumerate(sources):
+            write_synthetic_source(source, args.locations, args.years, p_seed=i)
+
+        app_module, app = load_app(sources[0], work_dir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            snapshots = [app_module.get_snapshot()
+                         , load_snapshot(p_source=sources[1]
+                                         , p_rolling_window=app_module.assum_rolling_window
+                                         , p_assum_mean_generation=app_module.assum_mean_generation
+                                         , p_assum_sd_generation=app_module.assum_sd_generation
+                                         , p_cache_dir=app_module.assum_data_cache_dir
+                                         , p_chunk_rows=app_module.assum_ingest_chunk_rows)]
+        locations = sorted(snapshots[0]['store'])
+
+        # The data is only swapped below, not reloaded by the app's refresher
+        app_module.refresher_pid = os.getpid()
+
+        # References, single-threaded and with the caches cleared for each version
+        client = app.server.test_client()
+        references = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for snapshot in snapshots:
+                app_module.set_snapshot(snapshot)
+                references[snapshot['data_version']] = {x: location_responses(client, x) for x in locations}
+
+        rng = random.Random(args.seed)
+        jobs = [rng.choice(locations) for _ in range(args.requests)]
+        clients = threading.local()
+        done = threading.Event()
+        n_swaps = [0]
+
+        def swap_snapshots():
+            while not done.wait(args.swap_seconds):
+                app_module.set_snapshot(snapshots[(n_swaps[0] + 1) % 2])
+                n_swaps[0] += 1
+
+        def run(p_location):
+            # A client per thread, as for separate browsers
+            if not hasattr(clients, 'client'):
+                clients.client = app.server.test_client()
+            try:
+                return check_responses(location_responses(clients.client, p_location), p_location, references)
+            except Exception as e:
+                return ['failed: {!r}'.format(e)]
+
+        start_time = time.perf_counter()
+        # Loading messages and slow request logs aren't wanted in the output
+        with contextlib.redirect_stdout(io.StringIO()):
+            swapper = threading.Thread(target=swap_snapshots, name='swap_snapshots', daemon=True)
+            swapper.start()
+            try:
+                with ThreadPoolExecutor(max_workers=args.threads) as executor:
+                    results = list(executor.map(run, jobs))
+            finally:
+                done.set()
+                swapper.join()
+        seconds = time.perf_counter() - start_time
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    failures = [(location, x) for location, result in zip(jobs, results) for x in result]
+    print('{} locations requested ({} callbacks) from {} threads in {:.1f}s, data swapped {} times: '
+          '{} mismatched or failed'.format(len(jobs), 4 * len(jobs), args.threads, seconds, n_swaps[0]
+                                           , len(failures)))
+    for location, failure in failures[:20]:
+        print('  {}: {}'.format(location, failure))
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic stand-in for COVID_AU_state.csv - same columns and layout (a row per location per date, dates in order),
+with any number of locations and years, so the pipeline can be benchmarked offline at scale
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Real state codes are used for the first locations, then made-up location codes
+source_states = ['ACT', 'NSW', 'NT', 'QLD', 'SA', 'TAS', 'VIC', 'WA']
+
+
+# Function: Location codes for p_n_locations locations
+def location_names(p_n_locations):
+    if p_n_locations <= len(source_states):
+        return source_states[:p_n_locations]
+
+    return source_states + ['L{:05d}'.format(i) for i in range(p_n_locations - len(source_states))]
+
+# Function: Write a synthetic source CSV to p_path with p_n_locations locations and p_n_years years of daily cases.
+# Cases are Poisson around a random walk in log cases for each location, with about 2% of values missing.
+# Written p_block_days dates at a time, so memory stays bounded however many locations there are.
+# Returns the number of rows written
+def write_synthetic_source(p_path, p_n_locations, p_n_years, p_seed=0, p_block_days=100):
+    rng = np.random.default_rng(p_seed)
+
+    locations = np.array(location_names(p_n_locations))
+    dates = pd.date_range('2020-01-25', periods=int(round(p_n_years * 365)))
+
+    log_level = np.log(rng.uniform(5, 200, p_n_locations))
+    n_rows = 0
+
+    for block_start in range(0, len(dates), p_block_days):
+        block_dates = dates[block_start:block_start + p_block_days]
+
+        # Random walk in log cases, carried on from the end of the previous block (dates x locations)
+        log_levels = log_level + np.cumsum(rng.normal(0, 0.05, (len(block_dates), p_n_locations)), axis=0)
+        log_level = log_levels[-1]
+
+        cases = rng.poisson(np.exp(np.clip(log_levels, None, 12))).astype(float)
+        cases[rng.random(cases.shape) < 0.02] = np.nan
+
+        block = pd.DataFrame({
+            'date': np.repeat(block_dates.strftime('%Y-%m-%d'), p_n_locations)
+            , 'state': np.tile(np.char.lower(locations), len(block_dates))
+            , 'state_abbrev': np.tile(locations, len(block_dates))
+            , 'confirmed': cases.ravel()
+            , 'deaths': 0
+            , 'tests': 0
+        })
+        block.to_csv(p_path, mode='w' if block_start == 0 else 'a', header=(block_start == 0), index=False)
+        n_rows += len(block)
+
+    return n_rows
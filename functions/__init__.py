@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+Functions used by the dashy app, split out of 01_dashy_app.py
+"""
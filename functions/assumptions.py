@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Assumptions - the data source and modelling assumptions shared by the dashboard (01_dashy_app.py) and the batch
+projections (02_batch_projections.py), so both always project from the same data with the same assumptions
+"""
+
+import os
+import tempfile
+
+
+# Data source - set COVID_DATA_SOURCE to use another URL or a local file instead
+secondary_github_data_web = os.environ.get('COVID_DATA_SOURCE',
+                                           'https://raw.githubusercontent.com/M3IT/COVID-19_Data/master/Data/COVID_AU_state.csv')
+
+# Rows read at a time when loading the data source
+assum_ingest_chunk_rows = 100000
+
+# Directory for the ingested source data and the batch results, so new processes can start without downloading and
+# parsing it again. Workers memory-map them from here and share one copy - point this at /dev/shm to keep them in
+# shared memory rather than on disk
+assum_data_cache_dir = os.environ.get('COVID_DATA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'covid_dashy_data'))
+
+# Assumption for mean generation period
+assum_mean_generation = 5
+
+# Assumption for standard deviation of the generation period - used with the mean for the generation interval
+# in the renewal-equation estimate of R_eff
+assum_sd_generation = 2.9
+
+# Rolling window (days) for smoothed trend
+assum_rolling_window = 7
+
+# Assumptions for R_eff for scenarios
+assum_stable = 1.02
+assum_worse = 1.35
+
+# Half-life (days) of the gap between R_eff and 1 in the easing scenario, where R_eff decays from its current
+# estimate toward 1
+assum_easing_half_life = 14
+
+# Prediction interval around projections - lower and upper quantiles of the simulated projections
+assum_interval_quantiles = (0.05, 0.95)
+
+# Number of simulated projections for the prediction interval
+assum_simulation_paths = 2000
+
+# Days of recent R_eff estimates used to simulate uncertainty in R_eff
+assum_R_eff_history_days = 28
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Backtesting - replays the projection from every historical date as the origin, using the R_eff that would have
+been estimated then, and scores it against the cases reported afterwards.
+Works on the batch (location x date) arrays, so every origin for every location is scored at once
+"""
+
+import itertools
+
+import pandas as pd
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from functions.batch import compute_all_locations
+
+
+# Function: Rolling quantiles of each row of p_values (location x date) over the p_window days ending on each date,
+# ignoring NaN - as np.nanquantile (linear interpolation) on each window. Windows at the start of a row use the
+# days available. Returns (quantile x location x date), NaN where a window has fewer than p_min_count values
+def rolling_quantiles(p_values, p_window, p_quantiles, p_min_count=1):
+    padded = np.concatenate([np.full((p_values.shape[0], p_window - 1), np.nan), p_values], axis=1)
+    windows = np.sort(sliding_window_view(padded, p_window, axis=1), axis=-1)
+
+    # NaN sort to the end, so the valid values of each window are its first n_valid
+    n_valid = np.sum(~np.isnan(windows), axis=-1)
+
+    quantiles = []
+    for q in p_quantiles:
+        position = q * np.maximum(n_valid - 1, 0)
+        below = np.floor(position).astype(int)
+        above = np.minimum(below + 1, np.maximum(n_valid - 1, 0))
+        value_below = np.take_along_axis(windows, below[..., np.newaxis], axis=-1)[..., 0]
+        value_above = np.take_along_axis(windows, above[..., np.newaxis], axis=-1)[..., 0]
+        quantiles.append(value_below + (position - below) * (value_above - value_below))
+
+    return np.where(n_valid >= p_min_count, np.array(quantiles), np.nan)
+
+# Function: Rolling mean of each row of p_values (location x date) over the p_window days ending on each date,
+# ignoring NaN - windows at the start of a row use the days available
+def rolling_nanmean(p_values, p_window):
+    cum_values = np.cumsum(np.nan_to_num(p_values), axis=1)
+    cum_counts = np.cumsum(~np.isnan(p_values), axis=1)
+
+    sums, counts = cum_values.copy(), cum_counts.copy()
+    sums[:, p_window:] -= cum_values[:, :-p_window]
+    counts[:, p_window:] -= cum_counts[:, :-p_window]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / counts
+
+# Function: Score projections from every origin date in batch results (see compute_all_locations) for horizons
+# 1 to p_horizon days ahead, against p_target ('daily_cases' or 'smooth_cases').
+# Projections are as project_cases_from_R_eff: the smoothed cases on the origin date grown at its estimated R_eff,
+# which only uses data up to the origin date (assuming reported data isn't revised later).
+# Prediction intervals follow simulate_interval_multipliers without simulating - R_eff off by the quantiles of the
+# log R_eff over the p_history_days up to the origin, relative to their mean.
+# Returns a frame of location, horizon, origins scored, MAE, MAPE (%) and interval coverage
+def backtest_batch(p_batch, p_horizon, p_quantiles=(0.05, 0.95), p_history_days=28, p_target='daily_cases'):
+    mean_generation = p_batch['mean_generation']
+    smooth_cases = p_batch['smooth_cases']
+    R_eff = p_batch['R_eff']
+    actuals = p_batch[p_target]
+
+    # Only finite, positive estimates - R_eff is infinite where cases rose from none
+    valid_R_eff = np.isfinite(R_eff) & (R_eff > 0)
+    log_R_eff = np.full(R_eff.shape, np.nan)
+    log_R_eff[valid_R_eff] = np.log(R_eff[valid_R_eff])
+
+    # Spread of recent log R_eff around its mean - no interval with fewer than 3 recent estimates, as in
+    # simulate_interval_multipliers
+    log_R_eff_quantiles = rolling_quantiles(log_R_eff, p_history_days, [p_quantiles[0], p_quantiles[-1]], p_min_count=3)
+    log_R_eff_quantiles = np.nan_to_num(log_R_eff_quantiles - rolling_nanmean(log_R_eff, p_history_days))
+
+    results = []
+    for horizon in range(1, min(p_horizon, R_eff.shape[1] - 1) + 1):
+        # Origins are every date with a date horizon days later. Projections from very large or infinite R_eff
+        # come out infinite or NaN, and aren't scored
+        with np.errstate(over='ignore', invalid='ignore'):
+            projected = smooth_cases[:, :-horizon] * R_eff[:, :-horizon] ** (horizon / mean_generation)
+            lower = np.round(projected * np.exp(log_R_eff_quantiles[0, :, :-horizon] * horizon / mean_generation), 0)
+            upper = np.round(projected * np.exp(log_R_eff_quantiles[1, :, :-horizon] * horizon / mean_generation), 0)
+        projected = np.round(projected, 0)
+        actual = actuals[:, horizon:]
+
+        scored = np.isfinite(projected) & np.isfinite(actual)
+        n_scored = scored.sum(axis=1)
+        abs_error = np.where(scored, np.abs(projected - actual), 0)
+
+        # Percentage errors are only defined where there were cases
+        pct_scored = scored & (actual > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pct_error = np.where(pct_scored, abs_error / np.where(pct_scored, actual, 1), 0)
+            covered = np.where(scored, (lower <= actual) & (actual <= upper), False)
+
+            results.append(pd.DataFrame({
+                'location': p_batch['locations']
+                , 'horizon': horizon
+                , 'n_origins': n_scored
+                , 'mae': abs_error.sum(axis=1) / n_scored
+                , 'mape': 100 * pct_error.sum(axis=1) / pct_scored.sum(axis=1)
+                , 'coverage': covered.sum(axis=1) / n_scored
+            }))
+
+    return pd.concat(results, ignore_index=True)
+
+# Function: Batch results then backtest for one parameter setting and set of locations - one task for run_backtest
+def backtest_task(p_data, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation, p_horizon, p_quantiles
+                  , p_history_days, p_target):
+    batch = compute_all_locations(p_data, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation)
+
+    results = backtest_batch(batch, p_horizon, p_quantiles, p_history_days, p_target)
+    results.insert(1, 'rolling_window', p_rolling_window)
+    results.insert(2, 'mean_generation', p_assum_mean_generation)
+
+    return results
+
+# Function: Backtest every location in the series store (see split_series) for each (rolling window, mean generation)
+# in p_settings. Locations are backtested p_chunk_locations at a time to bound memory, and with p_processes > 1
+# the (setting, location chunk) tasks run in parallel in a process pool
+def run_backtest(p_data, p_settings, p_assum_sd_generation, p_horizon, p_quantiles=(0.05, 0.95), p_history_days=28
+                 , p_target='daily_cases', p_chunk_locations=100, p_processes=None):
+    locations = sorted(p_data)
+    chunks = [{x: p_data[x] for x in locations[i:i + p_chunk_locations]}
+              for i in range(0, len(locations), p_chunk_locations)]
+
+    tasks = [(chunk, rolling_window, mean_generation, p_assum_sd_generation, p_horizon, p_quantiles, p_history_days
+              , p_target)
+             for (rolling_window, mean_generation), chunk in itertools.product(p_settings, chunks)]
+
+    if (p_processes is not None) and (p_processes > 1):
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=p_processes) as executor:
+            results = list(executor.map(backtest_task, *zip(*tasks)))
+    else:
+        results = [backtest_task(*x) for x in tasks]
+
+    return pd.concat(results, ignore_index=True)
+
+# Function: Summarise backtest results over locations for each setting and horizon - MAE and MAPE weighted by
+# origins scored, and overall coverage
+def summarise_backtest(p_results):
+    weighted = p_results.assign(mae=p_results['mae'] * p_results['n_origins']
+                                , mape=p_results['mape'] * p_results['n_origins']
+                                , coverage=p_results['coverage'] * p_results['n_origins'])
+    summary = weighted.groupby(['rolling_window', 'mean_generation', 'horizon'])[
+        ['n_origins', 'mae', 'mape', 'coverage']].sum(min_count=1)
+
+    for x in ['mae', 'mape', 'coverage']:
+        summary[x] = summary[x] / summary['n_origins']
+
+    return summary.reset_index()
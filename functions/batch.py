@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Batch engine - smoothing and R_eff for every location in one pass over a (location x date) array,
+rather than one pandas pipeline per location
+"""
+
+import pandas as pd
+import numpy as np
+
+from functions.renewal import generation_interval_weights, renewal_R_eff
+
+
+# Function: Stack 1D arrays of different lengths into a 2D array, right-aligned so the latest dates line up
+# in the last column, with p_fill padding at the start
+def right_align(p_rows, p_fill, p_dtype):
+    lengths = np.array([len(x) for x in p_rows], dtype=int)
+    n_dates = lengths.max() if len(lengths) else 0
+
+    stacked = np.full((len(p_rows), n_dates), p_fill, dtype=p_dtype)
+    for i, row in enumerate(p_rows):
+        stacked[i, n_dates - lengths[i]:] = row
+
+    return stacked, lengths
+
+# Function: Stack the per-location series from the series store into 2D (location x date) arrays
+def stack_series_store(p_data):
+    locations = sorted(p_data)
+
+    dates, lengths = right_align([p_data[x]['report_date'] for x in locations], np.datetime64('NaT'), 'datetime64[ns]')
+    cases, lengths = right_align([p_data[x]['daily_cases'] for x in locations], np.nan, float)
+
+    return locations, lengths, dates, cases
+
+# Function: Rolling mean along each row using a cumulative sum, NaN until a full window is available.
+# Same as pandas rolling(p_rolling_window).mean() on each row's series
+def rolling_mean(p_cases, p_lengths, p_rolling_window):
+    n_dates = p_cases.shape[1]
+
+    # Padding is zero in the cumulative sum, windows touching it are masked out below
+    cum_cases = np.cumsum(np.nan_to_num(p_cases), axis=1)
+    window_sums = cum_cases.copy()
+    window_sums[:, p_rolling_window:] -= cum_cases[:, :-p_rolling_window]
+
+    means = window_sums / p_rolling_window
+
+    # First full window for each row ends p_rolling_window - 1 places after the row's first date
+    first_full = (n_dates - p_lengths + p_rolling_window - 1)[:, np.newaxis]
+    means[np.arange(n_dates)[np.newaxis, :] < first_full] = np.nan
+
+    return means
+
+# Function: Smoothed cases, lagged cases and R_eff for every location at once - as smooth_data, estimate_R_eff
+# then estimate_R_eff_renewal
+def compute_all_locations(p_data, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation):
+    locations, lengths, dates, cases = stack_series_store(p_data)
+
+    # Smooth data - compute rolling average
+    smooth_cases = np.round(rolling_mean(cases, lengths, p_rolling_window), 0)
+
+    # Lag by the mean generation period
+    lag_cases = np.full(smooth_cases.shape, np.nan)
+    lag_cases[:, p_assum_mean_generation:] = smooth_cases[:, :-p_assum_mean_generation]
+
+    # R_eff as growth over the mean generation period
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R_eff = np.round(smooth_cases / lag_cases, 2)
+
+    batch = {
+        'rolling_window': p_rolling_window
+        , 'mean_generation': p_assum_mean_generation
+        , 'sd_generation': p_assum_sd_generation
+        , 'locations': tuple(locations)
+        , 'lengths': lengths
+        , 'report_date': dates
+        , 'daily_cases': cases
+        , 'smooth_cases': smooth_cases
+        , 'lag_cases': lag_cases
+        , 'R_eff': R_eff
+    }
+
+    return freeze_batch(add_renewal_R_eff(batch))
+
+# Function: Add the renewal-equation R_eff and its credible interval for every location to batch results.
+# One pass over the whole history
+def add_renewal_R_eff(p_batch):
+    weights = generation_interval_weights(p_batch['mean_generation'], p_batch['sd_generation'])
+    estimates = renewal_R_eff(p_batch['daily_cases'], p_batch['lengths'], weights, p_batch['rolling_window'])
+
+    p_batch['R_eff_renewal'] = estimates['mean']
+    p_batch['R_eff_renewal_lower'] = estimates['lower']
+    p_batch['R_eff_renewal_upper'] = estimates['upper']
+
+    return p_batch
+
+# Function: Smoothed cases and R_eff for every location over a grid of rolling windows and mean generation periods at
+# once - as compute_all_locations for each pair, but one cumulative sum serves every window.
+# Smoothed cases are (window x location x date) and R_eff (window x mean generation x location x date)
+def sweep_all_locations(p_data, p_rolling_windows, p_assum_mean_generations):
+    locations, lengths, dates, cases = stack_series_store(p_data)
+    n_dates = cases.shape[1]
+
+    # Padding is zero in the cumulative sum, windows touching it are masked out below
+    cum_cases = np.cumsum(np.nan_to_num(cases), axis=1)
+    positions = np.arange(n_dates)[np.newaxis, :]
+
+    smooth_cases = np.empty((len(p_rolling_windows),) + cases.shape)
+    for i, window in enumerate(p_rolling_windows):
+        window_sums = cum_cases.copy()
+        window_sums[:, window:] -= cum_cases[:, :-window]
+        smooth_cases[i] = np.where(positions < (n_dates - lengths + window - 1)[:, np.newaxis]
+                                   , np.nan
+                                   , np.round(window_sums / window, 0))
+
+    R_eff = np.full((len(p_rolling_windows), len(p_assum_mean_generations)) + cases.shape, np.nan)
+    for j, generation in enumerate(p_assum_mean_generations):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R_eff[:, j, :, generation:] = np.round(smooth_cases[..., generation:] / smooth_cases[..., :-generation], 2)
+
+    sweep = {
+        'rolling_windows': tuple(p_rolling_windows)
+        , 'mean_generations': tuple(p_assum_mean_generations)
+        , 'locations': tuple(locations)
+        , 'lengths': lengths
+        , 'report_date': dates
+        , 'smooth_cases': smooth_cases
+        , 'R_eff': R_eff
+    }
+
+    return freeze_batch(sweep)
+
+# Function: Current (latest) R_eff for each location and setting in sweep results, as a long frame of location,
+# rolling window, mean generation and R_eff
+def sweep_current_R_eff(p_sweep):
+    windows, generations, locations = np.meshgrid(p_sweep['rolling_windows'], p_sweep['mean_generations']
+                                                  , p_sweep['locations'], indexing='ij')
+
+    # Series are right-aligned, so the latest date for every location is the last column
+    return pd.DataFrame({
+        'location': locations.ravel()
+        , 'rolling_window': windows.ravel()
+        , 'mean_generation': generations.ravel()
+        , 'R_eff': p_sweep['R_eff'][..., -1].ravel()
+    })
+
+# Function: Previous (location x date) batch values lined up with the columns of new arrays p_n_dates wide. Row i
+# moves p_shifts[i] columns right - as much as its history grew less than the longest - and columns with no previous
+# value are p_fill
+def align_previous(p_values, p_shifts, p_n_dates, p_fill):
+    n_previous_dates = p_values.shape[1]
+    aligned = np.full((p_values.shape[0], p_n_dates), p_fill, dtype=p_values.dtype)
+
+    # Usually every location has gained the same days, and the previous columns stay where they are
+    if not p_shifts.any():
+        aligned[:, :n_previous_dates] = p_values
+        return aligned
+
+    columns = np.arange(p_n_dates)[np.newaxis, :] - p_shifts[:, np.newaxis]
+    inside = (columns >= 0) & (columns < n_previous_dates)
+    values = np.take_along_axis(p_values, np.clip(columns, 0, n_previous_dates - 1), axis=1)
+
+    return np.where(inside, values, aligned)
+
+# Function: Update batch results for new data (a series store) from p_batch, the results for the previous data with
+# the same assumptions. Only columns from the earliest changed date across every location are recomputed - the
+# end of the previous history if days have only been appended, or the earliest revised row - so a new day costs
+# O(window) per location rather than the whole history. Falls back to compute_all_locations if the locations differ
+def update_all_locations(p_batch, p_data):
+    locations, lengths, dates, cases = stack_series_store(p_data)
+    if tuple(locations) != p_batch['locations']:
+        return compute_all_locations(p_data, p_batch['rolling_window'], p_batch['mean_generation']
+                                     , p_batch['sd_generation'])
+
+    n_dates = cases.shape[1]
+    n_previous_dates = p_batch['report_date'].shape[1]
+    shifts = (n_dates - lengths) - (n_previous_dates - p_batch['lengths'])
+    if (shifts < 0).any() or (lengths < p_batch['lengths']).any():
+        # History added before the start of a location, or dropped from one
+        return compute_all_locations(p_data, p_batch['rolling_window'], p_batch['mean_generation']
+                                     , p_batch['sd_generation'])
+
+    # Earliest changed column - a revised date or count in the previous history, otherwise the first new day
+    previous_dates = align_previous(p_batch['report_date'], shifts, n_dates, np.datetime64('NaT'))
+    previous_cases = align_previous(p_batch['daily_cases'], shifts, n_dates, np.nan)
+    has_previous = ~np.isnat(previous_dates)
+    changed = has_previous & ((dates != previous_dates)
+                              | ((cases != previous_cases) & ~(np.isnan(cases) & np.isnan(previous_cases))))
+    # Columns the new history has and the previous didn't - appended days, or days padded before
+    changed |= ~np.isnat(dates) & ~has_previous
+    changed_columns = np.flatnonzero(changed.any(axis=0))
+    start = changed_columns[0] if len(changed_columns) else n_dates
+    if start == 0:
+        return compute_all_locations(p_data, p_batch['rolling_window'], p_batch['mean_generation']
+                                     , p_batch['sd_generation'])
+
+    rolling_window = p_batch['rolling_window']
+    mean_generation = p_batch['mean_generation']
+    batch = {
+        'rolling_window': rolling_window
+        , 'mean_generation': mean_generation
+        , 'sd_generation': p_batch['sd_generation']
+        , 'locations': tuple(locations)
+        , 'lengths': lengths
+        , 'report_date': dates
+        , 'daily_cases': cases
+    }
+    for x in ['smooth_cases', 'lag_cases', 'R_eff', 'R_eff_renewal', 'R_eff_renewal_lower', 'R_eff_renewal_upper']:
+        batch[x] = align_previous(p_batch[x], shifts, n_dates, np.nan)
+
+    # Smooth data from start, from the window of days ending there - rows beginning before the window have a full
+    # window from its end, so their lengths are capped at its width
+    window_start = max(start - rolling_window + 1, 0)
+    smooth_cases = rolling_mean(cases[:, window_start:], np.minimum(lengths, n_dates - window_start), rolling_window)
+    batch['smooth_cases'][:, start:] = np.round(smooth_cases[:, start - window_start:], 0)
+
+    # Lag by the mean generation period
+    lag_start = max(start, mean_generation)
+    batch['lag_cases'][:, start:lag_start] = np.nan
+    batch['lag_cases'][:, lag_start:] = batch['smooth_cases'][:, lag_start - mean_generation:-mean_generation]
+
+    # R_eff as growth over the mean generation period
+    with np.errstate(divide='ignore', invalid='ignore'):
+        batch['R_eff'][:, start:] = np.round(batch['smooth_cases'][:, start:] / batch['lag_cases'][:, start:], 2)
+
+    # Renewal R_eff from start, from the window ending there and the generation interval before it
+    weights = generation_interval_weights(mean_generation, p_batch['sd_generation'])
+    renewal_start = max(start - rolling_window + 1 - (len(weights) - 1), 0)
+    estimates = renewal_R_eff(cases[:, renewal_start:], np.minimum(lengths, n_dates - renewal_start), weights
+                              , rolling_window)
+    batch['R_eff_renewal'][:, start:] = estimates['mean'][:, start - renewal_start:]
+    batch['R_eff_renewal_lower'][:, start:] = estimates['lower'][:, start - renewal_start:]
+    batch['R_eff_renewal_upper'][:, start:] = estimates['upper'][:, start - renewal_start:]
+
+    return freeze_batch(batch)
+
+# Function: Make the batch arrays read-only - batch results are shared by every callback, nothing should modify them
+def freeze_batch(p_batch):
+    for value in p_batch.values():
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+
+    return p_batch
+
+# Function: Pull one location out of the batch results, in the same form as estimate_R_eff returns
+def get_batch_location(p_batch, p_location):
+    i = p_batch['locations'].index(p_location)
+    start = p_batch['report_date'].shape[1] - p_batch['lengths'][i]
+
+    location_data = pd.DataFrame({
+        'report_date': p_batch['report_date'][i, start:]
+        , 'location': p_location
+        , 'daily_cases': p_batch['daily_cases'][i, start:]
+        , 'smooth_cases': pd.array(p_batch['smooth_cases'][i, start:], dtype='Int64')
+        , 'lag_cases': pd.array(p_batch['lag_cases'][i, start:], dtype='Int64')
+        # Only missing where there is no lagged value - 0/0 stays as NaN, as in pandas
+        , 'R_eff': pd.arrays.FloatingArray(p_batch['R_eff'][i, start:].copy()
+                                           , mask=np.isnan(p_batch['lag_cases'][i, start:]))
+        , 'R_eff_renewal': p_batch['R_eff_renewal'][i, start:]
+        , 'R_eff_renewal_lower': p_batch['R_eff_renewal_lower'][i, start:]
+        , 'R_eff_renewal_upper': p_batch['R_eff_renewal_upper'][i, start:]
+    })
+
+    return location_data
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Shared cache - computed frames are kept server-side on disk so every worker can read them,
+and only a small key needs to be sent to the browser.
+Frames are saved as plain arrays (.npz, read without pickle) in a directory only this user can use, so nothing in
+the cache can run code or be planted by another user
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+import pandas as pd
+import numpy as np
+
+
+# Function: Make sure the cache directory exists and is private - only usable by this user, and refused if it's
+# owned by another user (e.g. created first by someone else under a shared temp directory)
+def check_cache_dir(p_cache_dir):
+    os.makedirs(p_cache_dir, mode=0o700, exist_ok=True)
+
+    if hasattr(os, 'getuid'):
+        info = os.stat(p_cache_dir)
+        if info.st_uid != os.getuid():
+            raise PermissionError('cache directory {} is owned by another user'.format(p_cache_dir))
+        # e.g. created by an earlier version without the mode
+        if info.st_mode & 0o077:
+            os.chmod(p_cache_dir, 0o700)
+
+# Function: File name for a cached frame - prefixed with the data version so old versions can be pruned
+def frame_path(p_cache_dir, p_key):
+    key_hash = hashlib.sha1(repr(sorted(p_key.items())).encode('utf-8')).hexdigest()
+
+    return os.path.join(p_cache_dir, '{}_{}.npz'.format(p_key['data_version'], key_hash))
+
+# Function: Arrays holding a frame's columns - values, and a mask of missing values for nullable (Int64/Float64)
+# columns - with the column names and types as JSON, all loadable without pickle
+def frame_arrays(p_data):
+    arrays = {}
+    columns = []
+    for i, (name, column) in enumerate(p_data.items()):
+        dtype = str(column.dtype)
+        columns.append([name, dtype])
+
+        if dtype in ('Int64', 'Float64'):
+            arrays['values_{}'.format(i)] = column.array.to_numpy(dtype=dtype.lower(), na_value=0)
+            arrays['mask_{}'.format(i)] = column.isna().values
+        elif dtype == 'object':
+            arrays['values_{}'.format(i)] = column.values.astype(str)
+        else:
+            arrays['values_{}'.format(i)] = column.values
+
+    arrays['columns'] = np.array(json.dumps(columns))
+
+    return arrays
+
+# Function: Frame from its arrays (see frame_arrays)
+def arrays_frame(p_arrays):
+    data = {}
+    for i, (name, dtype) in enumerate(json.loads(str(p_arrays['columns']))):
+        values = p_arrays['values_{}'.format(i)]
+
+        if dtype == 'Int64':
+            data[name] = pd.arrays.IntegerArray(values, p_arrays['mask_{}'.format(i)])
+        elif dtype == 'Float64':
+            data[name] = pd.arrays.FloatingArray(values, p_arrays['mask_{}'.format(i)])
+        elif dtype == 'object':
+            data[name] = values.astype(object)
+        else:
+            data[name] = values
+
+    return pd.DataFrame(data)
+
+# Function: Read a cached frame, returns None if no other worker has written it yet
+def get_frame(p_cache_dir, p_key):
+    check_cache_dir(p_cache_dir)
+
+    try:
+        with np.load(frame_path(p_cache_dir, p_key), allow_pickle=False) as arrays:
+            return arrays_frame(arrays)
+    except FileNotFoundError:
+        return None
+
+# Function: Write a frame to the cache. Written to a temp file then renamed so readers never see a partial file
+def put_frame(p_cache_dir, p_key, p_data):
+    check_cache_dir(p_cache_dir)
+
+    path = frame_path(p_cache_dir, p_key)
+    fd, tmp_path = tempfile.mkstemp(dir=p_cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, **frame_arrays(p_data))
+    os.replace(tmp_path, path)
+
+# Function: Remove cached frames from other data versions
+def prune_frames(p_cache_dir, p_data_version):
+    if not os.path.isdir(p_cache_dir):
+        return
+
+    for file_name in os.listdir(p_cache_dir):
+        # .pkl files are frames cached by earlier versions
+        if file_name.endswith(('.npz', '.pkl')) and not file_name.startswith(p_data_version + '_'):
+            try:
+                os.remove(os.path.join(p_cache_dir, file_name))
+            except FileNotFoundError:
+                pass # already removed by another worker
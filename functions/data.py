@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Data store - parse the raw data once at load so callbacks only need to do lookups
+"""
+
+import collections.abc
+
+import pandas as pd
+import numpy as np
+
+
+# Columns used from the source, everything else is skipped when reading
+source_columns = ['date', 'state_abbrev', 'confirmed']
+
+
+# Function: Sort typed columns by location then date so each location sits in one contiguous block.
+# Locations are integer codes into p_location_names, which is renumbered into alphabetical order
+def order_series(p_dates, p_location_codes, p_cases, p_location_names):
+    name_order = np.argsort(p_location_names)
+    new_codes = np.empty(len(name_order), dtype=np.int32)
+    new_codes[name_order] = np.arange(len(name_order), dtype=np.int32)
+    location_codes = new_codes[p_location_codes]
+
+    order = np.lexsort((p_dates, location_codes))
+
+    sorted_series = {
+        'report_date': p_dates[order]
+        , 'location': location_codes[order]
+        , 'daily_cases': p_cases[order]
+        , 'location_names': np.asarray(p_location_names, dtype=str)[name_order]
+    }
+
+    return sorted_series
+
+# Function: Typed, sorted columns from the raw data frame (see order_series)
+def sort_series(p_data):
+    # Parse dates once here rather than on every callback
+    dates = pd.to_datetime(p_data['date'], format='%Y-%m-%d').values
+    locations = pd.Categorical(p_data['state_abbrev'].astype(str))
+
+    ## Fill in any missing values with 0
+    cases = p_data['confirmed'].fillna(0).values.astype(np.int32)
+
+    return order_series(dates, locations.codes.astype(np.int32), cases, np.asarray(locations.categories))
+
+# Function: Stream the source CSV in chunks of p_chunk_rows, keeping only the columns used, in compact dtypes
+# (datetime64 dates, int32 location codes and int32 cases). Returns typed, sorted columns (see order_series)
+# and the data version token, the same as data_version_token on the full frame read with these dtypes
+def read_series(p_path, p_chunk_rows):
+    chunks = pd.read_csv(p_path
+                         , usecols=source_columns
+                         , dtype={'date': str, 'state_abbrev': 'category', 'confirmed': 'float64'}
+                         , chunksize=p_chunk_rows)
+
+    dates = []
+    location_codes = []
+    cases = []
+    location_index = {} # location name -> code
+    hashed_sum = 0
+
+    for chunk in chunks:
+        chunk = chunk[source_columns]
+        hashed_sum += int(pd.util.hash_pandas_object(chunk, index=False).sum())
+
+        # Rows without a location can't be shown
+        chunk = chunk[chunk['state_abbrev'].notna()]
+
+        # Map this chunk's categories onto codes shared by all chunks
+        chunk_codes = np.array([location_index.setdefault(x, len(location_index))
+                                for x in chunk['state_abbrev'].cat.categories], dtype=np.int32)
+
+        dates.append(pd.to_datetime(chunk['date'], format='%Y-%m-%d').values)
+        location_codes.append(chunk_codes[chunk['state_abbrev'].cat.codes.values])
+        ## Fill in any missing values with 0
+        cases.append(chunk['confirmed'].fillna(0).values.astype(np.int32))
+
+    sorted_series = order_series(np.concatenate(dates)
+                                 , np.concatenate(location_codes)
+                                 , np.concatenate(cases)
+                                 , np.array(list(location_index), dtype=str))
+
+    return sorted_series, format(hashed_sum & 0xFFFFFFFFFFFFFFFF, '016x')
+
+# Per-location store of the sorted columns (see order_series) - a read-only mapping of location name to its
+# series ({'report_date', 'daily_cases'}), in alphabetical order of location. A location's series is sliced from
+# the sorted columns when it's looked up, so nothing is copied, memory-mapped columns stay memory-mapped and the
+# store takes the same time to build however many locations there are. Also an index for searching locations
+# by prefix (see search)
+class SeriesStore(collections.abc.Mapping):
+
+    def __init__(self, p_series):
+        self.dates = p_series['report_date']
+        self.cases = p_series['daily_cases']
+
+        # Start/stop of each location block - locations are sorted, so found by binary search.
+        # Locations without rows aren't in the store
+        bounds = np.searchsorted(p_series['location'], np.arange(len(p_series['location_names']) + 1))
+        has_rows = bounds[1:] > bounds[:-1]
+        self.names = np.asarray(p_series['location_names'])[has_rows]
+        self.starts = bounds[:-1][has_rows]
+        self.stops = bounds[1:][has_rows]
+
+        # Case-insensitive search keys, in their own order - built on the first search
+        self.search_keys = None
+        self.search_order = None
+
+        # The store is shared by every callback, make sure nothing can modify it
+        self.dates.flags.writeable = False
+        self.cases.flags.writeable = False
+
+    # Position of p_location in the store, or None if it isn't in it
+    def position(self, p_location):
+        if not isinstance(p_location, str):
+            return None
+        i = int(np.searchsorted(self.names, p_location))
+        if (i < len(self.names)) and (self.names[i] == p_location):
+            return i
+        return None
+
+    def __getitem__(self, p_location):
+        i = self.position(p_location)
+        if i is None:
+            raise KeyError(p_location)
+
+        return {
+            'report_date': self.dates[self.starts[i]:self.stops[i]]
+            , 'daily_cases': self.cases[self.starts[i]:self.stops[i]]
+        }
+
+    def __contains__(self, p_location):
+        return self.position(p_location) is not None
+
+    def __iter__(self):
+        return (str(x) for x in self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    # Up to p_limit locations starting with p_prefix, ignoring case, in alphabetical order ignoring case.
+    # An empty prefix gives the first p_limit locations
+    def search(self, p_prefix, p_limit):
+        if self.search_keys is None:
+            keys = np.char.lower(self.names)
+            order = np.argsort(keys, kind='stable')
+            self.search_order = order
+            self.search_keys = keys[order]
+
+        prefix = p_prefix.lower()
+        start = int(np.searchsorted(self.search_keys, prefix, side='left'))
+        # Every key starting with the prefix sorts before the prefix followed by the highest character
+        stop = int(np.searchsorted(self.search_keys, prefix + '\U0010ffff', side='left'))
+
+        return [str(x) for x in self.names[self.search_order[start:min(stop, start + p_limit)]]]
+
+# Function: Split sorted columns (see order_series) into a per-location store (see SeriesStore)
+def split_series(p_series):
+    return SeriesStore(p_series)
+
+# Function: Build per-location store of date-sorted series from the raw data
+def build_series_store(p_data):
+    return split_series(sort_series(p_data))
+
+# Function: Latest date in sorted columns, as a string in the same format as the raw data
+def series_max_date(p_series):
+    return str(np.datetime_as_string(p_series['report_date'].max(), unit='D'))
+
+# Function: Token identifying a version of the raw data, changes whenever any row is added or revised
+def data_version_token(p_data):
+    hashed = pd.util.hash_pandas_object(p_data[source_columns], index=False)
+
+    return format(int(hashed.sum()) & 0xFFFFFFFFFFFFFFFF, '016x')
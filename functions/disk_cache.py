@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Disk cache of the ingested data - typed, sorted columns and the batch results computed from them, saved as .npy files
+keyed by a hash of the source contents. Processes memory-map them instead of downloading and parsing the CSV again,
+so workers serving the same version share one copy of the data in the page cache.
+One process builds each new version (see refresh_lock) and publishes it by replacing the pointer to the latest version.
+The cache directory is private to the user running the app, as for the frame cache (see functions/cache.py)
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import contextlib
+
+import numpy as np
+
+from functions.cache import check_cache_dir
+
+# File locks are only available on Unix - elsewhere every process builds new versions itself
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+series_columns = ['report_date', 'location', 'daily_cases', 'location_names']
+
+
+# Function: Hash of a file's contents - the cache key. Read in blocks so the whole file is never in memory
+def content_hash(p_path):
+    hashed = hashlib.sha1()
+    with open(p_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            hashed.update(block)
+
+    return hashed.hexdigest()
+
+# Function: Directory holding the cache for a source (URL or file path)
+def source_cache_dir(p_cache_dir, p_source):
+    return os.path.join(p_cache_dir, hashlib.sha1(p_source.encode('utf-8')).hexdigest()[:16])
+
+# Function: Directory holding the cache for a source, created if needed and checked to be private like the frame
+# cache (see check_cache_dir) - both it and p_cache_dir, usually under the shared temp directory - so another user
+# can't plant data in it to be served, or hold its refresh lock
+def checked_source_dir(p_cache_dir, p_source):
+    check_cache_dir(p_cache_dir)
+    cache_dir = source_cache_dir(p_cache_dir, p_source)
+    check_cache_dir(cache_dir)
+
+    return cache_dir
+
+# Function: Directory holding batch results for a cached version of a source, under the assumptions they used
+def batch_dir(p_cache_dir, p_source, p_content_hash, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation):
+    return os.path.join(source_cache_dir(p_cache_dir, p_source), p_content_hash
+                        , 'batch_{}_{}_{}'.format(p_rolling_window, p_assum_mean_generation, p_assum_sd_generation))
+
+# Function: Save batch results (see compute_all_locations) alongside a cached version of the series - arrays as .npy
+# files and everything else in batch.json, written to a temp directory which is then renamed into place
+def save_batch(p_cache_dir, p_source, p_content_hash, p_batch):
+    checked_source_dir(p_cache_dir, p_source)
+    target_dir = batch_dir(p_cache_dir, p_source, p_content_hash, p_batch['rolling_window']
+                           , p_batch['mean_generation'], p_batch['sd_generation'])
+    if os.path.isdir(target_dir):
+        return
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(target_dir), prefix='.tmp_')
+    info = {}
+    for name, value in p_batch.items():
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(tmp_dir, name + '.npy'), value)
+        else:
+            info[name] = list(value) if isinstance(value, tuple) else value
+    with open(os.path.join(tmp_dir, 'batch.json'), 'w') as f:
+        json.dump(info, f)
+
+    try:
+        os.rename(tmp_dir, target_dir)
+    except OSError:
+        # Another process saved the same results first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+# Function: Load batch results for a cached version of a source, memory-mapped read-only.
+# Returns None if they haven't been saved for these assumptions
+def load_batch(p_cache_dir, p_source, p_content_hash, p_rolling_window, p_assum_mean_generation
+               , p_assum_sd_generation):
+    checked_source_dir(p_cache_dir, p_source)
+    results_dir = batch_dir(p_cache_dir, p_source, p_content_hash, p_rolling_window, p_assum_mean_generation
+                            , p_assum_sd_generation)
+
+    try:
+        with open(os.path.join(results_dir, 'batch.json')) as f:
+            batch = json.load(f)
+        batch['locations'] = tuple(batch['locations'])
+
+        for file_name in os.listdir(results_dir):
+            if file_name.endswith('.npy'):
+                batch[file_name[:-4]] = np.load(os.path.join(results_dir, file_name), mmap_mode='r')
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+    return batch
+
+# Function: Save sorted columns (see order_series) and their metadata for a source, and the batch results computed
+# from them if given. Columns are written to a temp directory which is then renamed into place, and the pointer to
+# the latest version (current.json) is replaced last, so readers never see a partial cache
+def save_series(p_cache_dir, p_source, p_series, p_meta, p_batch=None):
+    cache_dir = checked_source_dir(p_cache_dir, p_source)
+
+    version_dir = os.path.join(cache_dir, p_meta['content_hash'])
+    if not os.path.isdir(version_dir):
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp_')
+        for column in series_columns:
+            np.save(os.path.join(tmp_dir, column + '.npy'), p_series[column])
+        try:
+            os.rename(tmp_dir, version_dir)
+        except OSError:
+            # Another process saved the same version first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if p_batch is not None:
+        save_batch(p_cache_dir, p_source, p_meta['content_hash'], p_batch)
+
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(p_meta, f)
+    os.replace(tmp_path, os.path.join(cache_dir, 'current.json'))
+
+    # Remove older versions - processes still using them keep their memory maps until they move on (on Unix)
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and (name != p_meta['content_hash']) and not name.startswith('.tmp_'):
+            shutil.rmtree(path, ignore_errors=True)
+
+# Function: Load the latest cached columns for a source, memory-mapped read-only.
+# Returns (series, meta), or None if nothing has been cached yet
+def load_series(p_cache_dir, p_source):
+    cache_dir = checked_source_dir(p_cache_dir, p_source)
+
+    try:
+        with open(os.path.join(cache_dir, 'current.json')) as f:
+            meta = json.load(f)
+
+        version_dir = os.path.join(cache_dir, meta['content_hash'])
+        series = {x: np.load(os.path.join(version_dir, x + '.npy'), mmap_mode='r') for x in series_columns}
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+    return series, meta
+
+# Function: Content hash of the latest cached version of a source, or None if nothing has been cached yet.
+# Cheap enough to poll, to notice versions published by other processes
+def cached_version(p_cache_dir, p_source):
+    try:
+        with open(os.path.join(checked_source_dir(p_cache_dir, p_source), 'current.json')) as f:
+            return json.load(f)['content_hash']
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+# Function: Context manager - take the lock on checking a source for new data, without waiting, so only one process
+# checks it and builds each new version. Yields whether the lock was taken. The lock is released if the process
+# dies, and is always taken where file locks aren't available
+@contextlib.contextmanager
+def refresh_lock(p_cache_dir, p_source):
+    if fcntl is None:
+        yield True
+        return
+
+    cache_dir = checked_source_dir(p_cache_dir, p_source)
+
+    with open(os.path.join(cache_dir, 'refresh.lock'), 'a') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            locked = True
+        except OSError:
+            # Another process is checking
+            locked = False
+
+        try:
+            yield locked
+        finally:
+            if locked:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+# Function: Seconds since any process last checked a source for new data (see mark_checked), infinite if never
+def seconds_since_checked(p_cache_dir, p_source):
+    try:
+        return time.time() - os.stat(os.path.join(checked_source_dir(p_cache_dir, p_source), 'checked')).st_mtime
+    except FileNotFoundError:
+        return float('inf')
+
+# Function: Record that a source has just been checked for new data
+def mark_checked(p_cache_dir, p_source):
+    cache_dir = checked_source_dir(p_cache_dir, p_source)
+
+    path = os.path.join(cache_dir, 'checked')
+    with open(path, 'a'):
+        pass
+    os.utime(path)
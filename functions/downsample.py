@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Downsampling for the chart - long histories are decimated with LTTB (largest triangle three buckets), which keeps
+the visual shape of the series, so the figure stays a bounded size however long the history gets
+"""
+
+import pandas as pd
+import numpy as np
+
+
+# Function: Indices of p_n_out points chosen by LTTB. Always keeps the first and last points.
+# Each bucket keeps the point forming the largest triangle with the previously kept point and the next bucket's mean
+def lttb(p_x, p_y, p_n_out):
+    n = len(p_x)
+    if (n <= p_n_out) or (p_n_out < 3):
+        return np.arange(n)
+
+    # Edges of the p_n_out - 2 buckets between the first and last points
+    edges = np.linspace(1, n - 1, p_n_out - 1).astype(int)
+
+    selected = np.empty(p_n_out, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    a = 0
+    for i in range(p_n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_stop = edges[i + 2] if i + 2 < len(edges) else n
+
+        mean_x = p_x[stop:next_stop].mean()
+        mean_y = p_y[stop:next_stop].mean()
+
+        areas = np.abs((p_x[a] - mean_x) * (p_y[start:stop] - p_y[a])
+                       - (p_x[a] - p_x[start:stop]) * (mean_y - p_y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+
+    return selected
+
+# Function: Points of a series to plot, without missing values. Returns (x, y, x as numbers for LTTB)
+def series_points(p_x, p_y):
+    keep = p_y.notna().values
+    x = p_x.values[keep]
+    y = p_y.values[keep].astype(float)
+
+    return x, y, x.view(np.int64).astype(float)
+
+# Function: Indices of at most p_max_points points chosen by LTTB within p_x_range, from the points' x as numbers.
+# Includes a point either side so lines run to the edges of the visible range
+def range_indices(p_x_num, p_y, p_x_range, p_max_points):
+    start, stop = np.searchsorted(p_x_num, [p_x_range[0].value, p_x_range[1].value])
+    start = max(start - 1, 0)
+    stop = min(stop + 1, len(p_x_num))
+
+    return start + lttb(p_x_num[start:stop], p_y[start:stop], p_max_points)
+
+# Function: Decimate a series for plotting to at most p_max_points over its whole length, plus at most p_max_points
+# within p_x_range (the visible range) so zooming in shows full resolution. Missing values are dropped.
+# Returns (x, y) arrays
+def decimate_series(p_x, p_y, p_x_range, p_max_points):
+    x, y, x_num = series_points(p_x, p_y)
+
+    selected = lttb(x_num, y, p_max_points)
+
+    if p_x_range is not None:
+        selected = np.union1d(selected, range_indices(x_num, y, p_x_range, p_max_points))
+
+    return x[selected], y[selected]
+
+# Function: Points of a series within p_x_range (the visible range) to show in place of those decimate_series keeps
+# there over the whole length, when zoomed in - at most p_max_points. Missing values are dropped.
+# Returns (x, y) arrays, or None if decimate_series already keeps all of them, so zooming doesn't change the trace
+def zoom_series(p_x, p_y, p_x_range, p_max_points):
+    x, y, x_num = series_points(p_x, p_y)
+
+    selected = range_indices(x_num, y, p_x_range, p_max_points)
+    if np.isin(selected, lttb(x_num, y, p_max_points)).all():
+        return None
+
+    return x[selected], y[selected]
+
+# Function: Visible x-axis range from a graph's relayoutData, as UTC timestamps.
+# Returns (changed, x_range) - changed is False if the event didn't change the x-axis, x_range is None for the full range
+def relayout_x_range(p_relayout_data):
+    if not p_relayout_data:
+        return False, None
+
+    if p_relayout_data.get('xaxis.autorange'):
+        return True, None
+
+    if 'xaxis.range[0]' in p_relayout_data:
+        x_range = [p_relayout_data['xaxis.range[0]'], p_relayout_data['xaxis.range[1]']]
+    elif 'xaxis.range' in p_relayout_data:
+        x_range = p_relayout_data['xaxis.range']
+    else:
+        return False, None
+
+    return True, [pd.to_datetime(x, utc=True) for x in x_range]
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation - timings per stage and per callback, and callback payload sizes, kept in fixed-bucket histograms
+(a lock and a counter increment per observation) and served in the Prometheus text format on /metrics.
+Slow requests can optionally be profiled by sampling the stack of the thread serving them
+"""
+
+import bisect
+import collections
+import contextlib
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+
+import flask
+
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds
+seconds_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+bytes_buckets = tuple(256 * 4 ** i for i in range(10)) # 256 bytes to 64MB
+
+
+# Histogram with one series per value of a single label
+class Histogram:
+
+    def __init__(self, p_name, p_help, p_label, p_buckets):
+        self.name = p_name
+        self.help = p_help
+        self.label = p_label
+        self.buckets = tuple(p_buckets)
+        self.series = {} # label value -> [bucket counts (last is +Inf), sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, p_label_value, p_value):
+        bucket = bisect.bisect_left(self.buckets, p_value)
+        with self.lock:
+            series = self.series.get(p_label_value)
+            if series is None:
+                series = self.series[p_label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bucket] += 1
+            series[1] += p_value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+
+        with self.lock:
+            series = {x: (list(y[0]), y[1], y[2]) for x, y in self.series.items()}
+
+        for label_value, (counts, total, count) in sorted(series.items()):
+            label = '{}="{}"'.format(self.label, escape_label(label_value))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                bound_text = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, bound_text, cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, label, repr(total)))
+            lines.append('{}_count{{{}}} {}'.format(self.name, label, count))
+
+        return lines
+
+
+stage_seconds = Histogram('dashy_stage_seconds', 'Time spent in each stage of the pipeline', 'stage', seconds_buckets)
+callback_seconds = Histogram('dashy_callback_seconds', 'Time to serve each callback request, including serialization'
+                             , 'callback', seconds_buckets)
+payload_bytes = Histogram('dashy_payload_bytes', 'Size of each callback response', 'callback', bytes_buckets)
+
+histograms = [stage_seconds, callback_seconds, payload_bytes]
+
+# Gauges read when /metrics is scraped - name -> (help, label, function returning {label value: value})
+gauges = collections.OrderedDict()
+
+
+# Function: Escape a Prometheus label value
+def escape_label(p_value):
+    return str(p_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Function: Record the time spent in p_stage
+def observe_stage(p_stage, p_seconds):
+    stage_seconds.observe(p_stage, p_seconds)
+
+# Function: Time the enclosed block as p_stage
+@contextlib.contextmanager
+def timed(p_stage):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(p_stage, time.perf_counter() - start_time)
+
+# Function: Add a gauge to /metrics, read from p_func when scraped
+def register_gauge(p_name, p_help, p_label, p_func):
+    gauges[p_name] = (p_help, p_label, p_func)
+
+# Function: Gauges for the hits, misses and size of lru_cache-decorated functions, labelled by function name
+def register_cache_gauges(p_cached_funcs):
+    def cache_stat(p_stat):
+        return lambda: {x.__name__: getattr(x.cache_info(), p_stat) for x in p_cached_funcs}
+
+    register_gauge('dashy_cache_hits', 'Hits of each in-memory cache since the data last changed', 'cache'
+                   , cache_stat('hits'))
+    register_gauge('dashy_cache_misses', 'Misses of each in-memory cache since the data last changed', 'cache'
+                   , cache_stat('misses'))
+    register_gauge('dashy_cache_size', 'Entries in each in-memory cache', 'cache', cache_stat('currsize'))
+
+# Function: All metrics in the Prometheus text format
+def render_metrics():
+    lines = []
+    for histogram in histograms:
+        lines += histogram.render()
+
+    for name, (help_text, label, func) in gauges.items():
+        lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} gauge'.format(name)]
+        for label_value, value in sorted(func().items()):
+            lines.append('{}{{{}="{}"}} {}'.format(name, label, escape_label(label_value), value))
+
+    return '\n'.join(lines) + '\n'
+
+
+# Sampling profiler for one thread - samples its stack every p_interval seconds from a background thread until
+# stopped, counting how often each stack was seen
+class StackSampler:
+
+    def __init__(self, p_thread_id, p_interval=0.005):
+        self.thread_id = p_thread_id
+        self.interval = p_interval
+        self.counts = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='stack_sampler', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append('{}:{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name
+                                               , frame.f_lineno))
+                frame = frame.f_back
+            self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.counts
+
+# Function: Default handler for slow requests - log a warning with the most sampled stacks
+def log_slow_request(p_path, p_seconds, p_counts):
+    logger.warning("slow request %s took %.3fs, most sampled stacks:%s", p_path, p_seconds
+                   , ''.join("\n  {} samples: {}".format(count, stack) for stack, count in p_counts.most_common(5)))
+
+# Function: Label for a Dash callback request - its outputs
+def callback_label(p_request):
+    body = p_request.get_json(silent=True) or {}
+    return str(body.get('output', 'unknown')).strip('.')
+
+# Function: Time and size every callback request to p_server (the app's Flask server) and serve /metrics.
+# Callback functions decorated with instrument_callback also record the time outside the function itself as the
+# 'serialization' stage (Dash's dispatch and JSON encoding). If p_slow_request_seconds is set, every callback
+# request is profiled by stack sampling and requests slower than that are passed to p_on_slow_request
+def init_metrics(p_server, p_slow_request_seconds=None, p_on_slow_request=log_slow_request):
+    @p_server.before_request
+    def start_request_timer():
+        if flask.request.path.endswith('/_dash-update-component'):
+            flask.g.metrics_start_time = time.perf_counter()
+            flask.g.metrics_callback_seconds = 0.0
+            if p_slow_request_seconds is not None:
+                flask.g.metrics_sampler = StackSampler(threading.get_ident())
+
+    @p_server.after_request
+    def record_request(p_response):
+        start_time = flask.g.pop('metrics_start_time', None)
+        if start_time is None:
+            return p_response
+
+        seconds = time.perf_counter() - start_time
+        label = callback_label(flask.request)
+        callback_seconds.observe(label, seconds)
+        payload_bytes.observe(label, p_response.calculate_content_length() or len(p_response.get_data()))
+
+        function_seconds = flask.g.pop('metrics_callback_seconds', 0.0)
+        if function_seconds > 0:
+            stage_seconds.observe('serialization', seconds - function_seconds)
+
+        sampler = flask.g.pop('metrics_sampler', None)
+        if sampler is not None:
+            counts = sampler.stop()
+            if seconds > p_slow_request_seconds:
+                p_on_slow_request(flask.request.path + ' ' + label, seconds, counts)
+
+        return p_response
+
+    # Requests that fail never reach after_request - make sure their sampler stops
+    @p_server.teardown_request
+    def stop_sampler(p_exception):
+        sampler = flask.g.pop('metrics_sampler', None)
+        if sampler is not None:
+            sampler.stop()
+
+    @p_server.route('/metrics')
+    def metrics():
+        return flask.Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Function: Decorator for callback functions - records the time spent in the function, so the rest of the request
+# can be recorded as serialization (see init_metrics)
+def instrument_callback(p_func):
+    @functools.wraps(p_func)
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return p_func(*args, **kwargs)
+        finally:
+            if flask.has_request_context():
+                flask.g.metrics_callback_seconds = flask.g.get('metrics_callback_seconds', 0.0) \
+                    + time.perf_counter() - start_time
+
+    return wrapper
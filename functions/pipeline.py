@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Pipeline for one location - series store -> processed -> smoothed -> R_eff, as pandas frames.
+Used by the dashboard for the location shown and by the batch projections (02_batch_projections.py), which run it
+for every location without the dashboard. Both project from the scenario grid in functions/projection.py rather
+than project_cases_from_R_eff, which is kept as the reference for those projections.
+These functions must not modify their input frames - the inputs may be cached and shared between callbacks
+running at the same time, so they work on a copy
+"""
+
+import pandas as pd
+import numpy as np
+
+from functions.renewal import generation_interval_weights, renewal_R_eff
+
+
+# Function: Collect required columns (report_date/location/daily_cases) from the series store
+def process_data(p_data, p_location):
+    # Dates are already parsed, sorted and missing values filled in build_series_store
+    series = p_data[p_location]
+
+    processed_data = pd.DataFrame({
+        'report_date': series['report_date']
+        , 'location': p_location
+        , 'daily_cases': series['daily_cases'].astype(float) # stored compactly as int32
+    })
+
+    return processed_data
+
+# Function: Add smoothed trend column (smooth_cases)
+def smooth_data(p_data, p_rolling_window):
+    # Smooth data - compute 7 day average.
+    # We want to apply smoothing to remove effect of daily variability as well as the weekly Monday dip
+
+    smoothed_data = p_data.copy()
+
+    smoothed_data["smooth_cases"] = smoothed_data["daily_cases"].rolling(p_rolling_window) \
+        .mean() \
+        .round(0)
+
+    smoothed_data["smooth_cases"] = smoothed_data["smooth_cases"].astype('Int64')
+
+    return smoothed_data
+
+# Function - Simple estimate of current effective reproductive factor of the virus, based on the growth rate over the
+# last [assum_mean_generation = 5] days
+def estimate_R_eff(p_data, p_assum_mean_generation):
+
+    added_data = p_data.copy()
+
+    added_data["lag_cases"] = added_data["smooth_cases"].shift(p_assum_mean_generation)
+
+    # If taking r = growth rate over 1 step, then r^5
+    #added_data["R_eff"] = (added_data["smooth_cases"] / added_data["lag_cases"]) ** p_assum_mean_generation
+
+    # If taking r^5 = growth rate over 5 steps directly (applies more smoothing if 7d average wasn't good enough)
+    added_data["R_eff"] = (added_data["smooth_cases"] / added_data["lag_cases"])
+
+    added_data["R_eff"] = round(added_data["R_eff"], 2)
+
+    return added_data
+
+# Function - Estimate R_eff with the renewal equation (Cori et al.) - daily cases against past cases weighted by a
+# gamma generation interval, over a rolling window, with a 95% credible interval
+def estimate_R_eff_renewal(p_data, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation):
+
+    added_data = p_data.copy()
+
+    weights = generation_interval_weights(p_assum_mean_generation, p_assum_sd_generation)
+    estimates = renewal_R_eff(p_cases=added_data["daily_cases"].astype(float).values[np.newaxis, :]
+                              , p_lengths=[len(added_data)]
+                              , p_weights=weights
+                              , p_window=p_rolling_window)
+
+    added_data["R_eff_renewal"] = estimates['mean'][0]
+    added_data["R_eff_renewal_lower"] = estimates['lower'][0]
+    added_data["R_eff_renewal_upper"] = estimates['upper'][0]
+
+    return added_data
+
+# Function - Project cases - projection is based on exponential growth with factor
+def project_cases_from_R_eff(p_days_to_project, p_data, p_R_eff, p_assum_mean_generation):
+
+    curr_data = p_data.copy()
+
+    # Convert to date (to be safe)
+    curr_data['report_date'] = pd.to_datetime(curr_data['report_date'], format='%Y-%m-%d')
+
+    # Current date and cases
+    curr_date = max(curr_data["report_date"])
+    curr_cases = curr_data[curr_data["report_date"] == curr_date]["smooth_cases"].values[0]
+
+    # Projected date and cases -
+    proj_date = pd.Series(range(1, p_days_to_project + 1))
+
+    proj_cases = curr_cases * p_R_eff ** (proj_date / p_assum_mean_generation)
+    proj_cases = round(proj_cases, 0).astype(int)
+
+    proj_date = curr_date + pd.to_timedelta(proj_date, unit='d')
+
+    # Collate into dataframe
+    location = curr_data["location"].unique()
+
+    projected_df = {
+        'report_date': proj_date.values
+        , 'location': np.repeat(location, p_days_to_project)
+        , 'daily_cases': np.repeat(np.NaN, p_days_to_project)
+        , 'smooth_cases': np.repeat(np.NaN, p_days_to_project)
+        , 'projected_cases': proj_cases.values
+        , 'projected_R_eff': np.repeat(p_R_eff, p_days_to_project)
+    }
+    projected_df = pd.DataFrame(projected_df)
+
+    new_data = pd.concat([curr_data, projected_df])
+
+    return new_data
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Projection functions - every R_eff scenario is precomputed for a location as one grid (R_eff x days ahead),
+so any scenario is a lookup rather than a new projection
+"""
+
+import pandas as pd
+import numpy as np
+
+
+# Function: R_eff values in the scenario grid - the values that can be input (0.01 to 10 in steps of 0.01)
+def scenario_R_eff_values(p_min=0.01, p_max=10, p_step=0.01):
+    n_steps = int(round((p_max - p_min) / p_step)) + 1
+    decimals = max(int(round(-np.log10(p_step))), 0)
+
+    return np.round(p_min + p_step * np.arange(n_steps), decimals)
+
+# Function: Projected cases for every R_eff in p_R_eff_values and days ahead 1 to p_max_days, in one broadcast.
+# Projection is based on exponential growth as in project_cases_from_R_eff: cases * R_eff ^ (t / mean generation)
+def build_scenario_grid(p_curr_date, p_curr_cases, p_max_days, p_assum_mean_generation, p_R_eff_values):
+    days_ahead = np.arange(1, p_max_days + 1)
+
+    cases = np.round(p_curr_cases * p_R_eff_values[:, np.newaxis] ** (days_ahead[np.newaxis, :] / p_assum_mean_generation), 0)
+    cases.flags.writeable = False
+
+    scenario_grid = {
+        'curr_date': pd.Timestamp(p_curr_date)
+        , 'curr_cases': p_curr_cases
+        , 'mean_generation': p_assum_mean_generation
+        , 'R_eff_values': p_R_eff_values
+        , 'cases': cases
+    }
+
+    return scenario_grid
+
+# Function: Row of the grid for each R_eff, -1 where the R_eff isn't in the grid
+def scenario_rows(p_scenario_grid, p_R_effs):
+    R_eff_values = p_scenario_grid['R_eff_values']
+    R_effs = np.atleast_1d(np.asarray(p_R_effs, dtype=float))
+
+    rows = np.clip(np.searchsorted(R_eff_values, R_effs), 0, len(R_eff_values) - 1)
+    rows[~np.isclose(R_eff_values[rows], R_effs, rtol=0, atol=1e-9)] = -1
+
+    return rows
+
+# Function: Projected cases for many scenarios at once - array of (scenario x days ahead).
+# R_eff values or horizons outside the grid are computed directly
+def project_scenarios(p_scenario_grid, p_R_effs, p_days_to_project):
+    rows = scenario_rows(p_scenario_grid, p_R_effs)
+    max_days = p_scenario_grid['cases'].shape[1]
+
+    if (rows >= 0).all() and (p_days_to_project <= max_days):
+        return p_scenario_grid['cases'][rows, :p_days_to_project]
+
+    off_grid = build_scenario_grid(p_scenario_grid['curr_date'], p_scenario_grid['curr_cases'], p_days_to_project
+                                   , p_scenario_grid['mean_generation'], np.atleast_1d(np.asarray(p_R_effs, dtype=float)))
+    return off_grid['cases']
+
+# Function: Projections for many scenarios as a long table (scenario R_eff, report_date, projected_cases) for reporting
+def scenario_table(p_scenario_grid, p_R_effs, p_days_to_project):
+    R_effs = np.atleast_1d(np.asarray(p_R_effs, dtype=float))
+    cases = project_scenarios(p_scenario_grid, R_effs, p_days_to_project)
+
+    proj_date = p_scenario_grid['curr_date'] + pd.to_timedelta(np.arange(1, p_days_to_project + 1), unit='d')
+
+    scenarios = pd.DataFrame({
+        'projected_R_eff': np.repeat(R_effs, p_days_to_project)
+        , 'report_date': np.tile(proj_date.values, len(R_effs))
+        , 'projected_cases': cases.ravel()
+    })
+
+    return scenarios
+
+# Function: Simulate uncertainty in R_eff and return quantiles of the projected cases relative to the constant-R_eff
+# projection, as an array of (quantile x days ahead 1 to p_max_days).
+# Each of p_n_paths paths projects with an R_eff off from the one used by a log ratio resampled from the recent
+# estimates p_recent_R_eff (relative to their mean). In log space this just adds to t * log(R_eff), so a path's
+# projected cases are the constant-R_eff projection times a multiplier that doesn't depend on R_eff - one
+# simulation per location gives intervals for every scenario
+def simulate_interval_multipliers(p_recent_R_eff, p_max_days, p_assum_mean_generation, p_quantiles=(0.05, 0.95)
+                                  , p_n_paths=2000, p_seed=0):
+    recent_R_eff = np.asarray(p_recent_R_eff, dtype=float)
+    log_recent = np.log(recent_R_eff[np.isfinite(recent_R_eff) & (recent_R_eff > 0)])
+
+    # Not enough history to estimate any uncertainty
+    if len(log_recent) < 3:
+        return np.ones((len(p_quantiles), p_max_days))
+
+    rng = np.random.default_rng(p_seed)
+    log_R_eff_noise = rng.choice(log_recent - log_recent.mean(), size=(p_n_paths, 1))
+
+    # Paths x days ahead - growth over t days is t * log R_eff / mean generation
+    days_ahead = np.arange(1, p_max_days + 1)
+    multipliers = np.exp(log_R_eff_noise * days_ahead[np.newaxis, :] / p_assum_mean_generation)
+
+    return np.quantile(multipliers, p_quantiles, axis=0)
+
+# Function: Prediction interval for a projection - array of (quantile x days ahead), from
+# simulate_interval_multipliers. Horizons beyond the simulated days are NaN
+def projection_intervals(p_curr_cases, p_R_eff, p_days_to_project, p_assum_mean_generation, p_multipliers):
+    days_ahead = np.arange(1, p_days_to_project + 1)
+    proj_cases = p_curr_cases * p_R_eff ** (days_ahead / p_assum_mean_generation)
+
+    multipliers = np.full((p_multipliers.shape[0], p_days_to_project), np.nan)
+    n_days = min(p_days_to_project, p_multipliers.shape[1])
+    multipliers[:, :n_days] = p_multipliers[:, :n_days]
+
+    return np.round(proj_cases[np.newaxis, :] * multipliers, 0)
+
+# Function: Piecewise constant R_eff trajectories for days ahead 1 to p_days - p_values[..., 0] until the first of
+# p_change_days (days ahead), then each following value from its change day on. Leading dimensions of p_values
+# give one trajectory each
+def R_eff_piecewise(p_values, p_change_days, p_days):
+    segment = np.searchsorted(np.asarray(p_change_days), np.arange(1, p_days + 1), side='right')
+
+    return np.asarray(p_values, dtype=float)[..., segment]
+
+# Function: R_eff trajectories for days ahead 1 to p_days, decaying from p_R_eff_start toward p_R_eff_end and
+# halving the gap every p_half_life days. p_R_eff_start can be an array, with one trajectory per value
+def R_eff_decay(p_R_eff_start, p_days, p_R_eff_end=1, p_half_life=14):
+    R_eff_start = np.asarray(p_R_eff_start, dtype=float)[..., np.newaxis]
+    days_ahead = np.arange(1, p_days + 1)
+
+    return p_R_eff_end + (R_eff_start - p_R_eff_end) * 0.5 ** (days_ahead / p_half_life)
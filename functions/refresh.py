@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Data refresh - poll the data source in a background thread and build a new snapshot of everything derived
+from it off the request path. Callbacks only ever see a complete snapshot.
+With a disk cache, each new snapshot is built once, in a short-lived process, and published there for every server
+process to memory-map
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import contextlib
+import shutil
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+import urllib.request
+
+from functions.data import read_series, split_series, series_max_date
+from functions.batch import compute_all_locations, update_all_locations
+from functions.disk_cache import content_hash, save_series, load_series, save_batch, load_batch, cached_version
+from functions.disk_cache import refresh_lock, seconds_since_checked, mark_checked
+from functions.metrics import timed, observe_stage
+
+
+# Named, not __name__, so it's the same logger when this module is run as a refresh process
+logger = logging.getLogger('functions.refresh')
+
+# Log line format when the app or a refresh process is run directly - other deployments configure logging themselves
+log_format = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# Longest wait (seconds) for the data source to respond when it's fetched from a URL
+fetch_timeout_seconds = 60
+
+# Longest (seconds) a refresh process may take to fetch the source and publish a new snapshot (see
+# publish_snapshot_in_process) - it's stopped after this, so a hung fetch can't hold up refreshes for every process
+publish_timeout_seconds = 600
+
+
+# Function: Signature of a local source file (modified time and size) to skip re-reading unchanged files.
+# Returns None for URLs, which are always re-read
+def source_signature(p_source):
+    if os.path.isfile(p_source):
+        stat = os.stat(p_source)
+        return stat.st_mtime_ns, stat.st_size
+    return None
+
+# Function: Local path to the source contents - the file itself, or for a URL, a temp file it is streamed to.
+# Returns (path, is_temp), temp files should be removed by the caller
+def fetch_source(p_source):
+    if os.path.isfile(p_source):
+        return p_source, False
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.csv')
+    try:
+        with os.fdopen(fd, 'wb') as f, urllib.request.urlopen(p_source, timeout=fetch_timeout_seconds) as response:
+            shutil.copyfileobj(response, f)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return tmp_path, True
+
+# Function: Whether to trace the peak memory used while ingesting the source - set COVID_TRACE_INGEST_MEMORY=1 to.
+# Off by default, as tracing slows ingesting down several times. Read when ingesting, so the refresh process
+# (see publish_snapshot_in_process) follows the setting too
+def trace_ingest_memory():
+    return os.environ.get('COVID_TRACE_INGEST_MEMORY', '0') not in ('', '0')
+
+# Function: Stream the source file into sorted columns (see order_series) and metadata about them.
+# With p_trace_memory, this includes the peak memory used while reading (None otherwise)
+def ingest_source(p_path, p_content_hash, p_chunk_rows, p_trace_memory=False):
+    start_time = time.perf_counter()
+    peak_memory = None
+    if p_trace_memory:
+        tracemalloc.start()
+        try:
+            series, data_version = read_series(p_path, p_chunk_rows)
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    else:
+        series, data_version = read_series(p_path, p_chunk_rows)
+
+    meta = {
+        'content_hash': p_content_hash
+        , 'data_version': data_version
+        , 'max_date': series_max_date(series)
+        , 'rows': len(series['report_date'])
+        , 'ingest_seconds': time.perf_counter() - start_time
+        , 'ingest_peak_memory_mb': None if peak_memory is None else peak_memory / 2 ** 20
+    }
+
+    return series, meta
+
+# Function: Snapshot of the data - series store, batch results, data version and max date
+def make_snapshot(p_meta, p_series_store, p_batch):
+    snapshot = {
+        'content_hash': p_meta['content_hash']
+        , 'data_version': p_meta['data_version']
+        , 'max_date': p_meta['max_date']
+        , 'store': p_series_store
+        , 'batch': p_batch
+    }
+
+    return snapshot
+
+# Function: Build a snapshot of the data from sorted columns (see order_series). When there is a previous snapshot
+# with the same assumptions, the batch results are updated from its results (see update_all_locations), otherwise
+# computed in full
+def build_snapshot(p_series, p_meta, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation
+                   , p_previous=None):
+    series_store = split_series(p_series)
+
+    if (p_previous is not None) and \
+            (p_previous['batch']['rolling_window'] == p_rolling_window) and \
+            (p_previous['batch']['mean_generation'] == p_assum_mean_generation) and \
+            (p_previous['batch']['sd_generation'] == p_assum_sd_generation):
+        batch = update_all_locations(p_previous['batch'], series_store)
+    else:
+        batch = compute_all_locations(series_store, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation)
+
+    return make_snapshot(p_meta, series_store, batch)
+
+# Function: Snapshot of the latest data cached on disk, or None if there is no copy of p_source there.
+# The series and batch results are memory-mapped, so every process loading the same version shares one copy.
+# Batch results are computed and cached first if this version doesn't have them for these assumptions yet
+def load_cached_snapshot(p_source, p_cache_dir, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation):
+    cached = load_series(p_cache_dir, p_source)
+    if cached is None:
+        return None
+    series, meta = cached
+
+    batch = load_batch(p_cache_dir, p_source, meta['content_hash'], p_rolling_window, p_assum_mean_generation
+                       , p_assum_sd_generation)
+    if batch is None:
+        with timed('snapshot_build'):
+            snapshot = build_snapshot(series, meta, p_rolling_window, p_assum_mean_generation
+                                      , p_assum_sd_generation)
+        save_batch(p_cache_dir, p_source, meta['content_hash'], snapshot['batch'])
+
+        batch = load_batch(p_cache_dir, p_source, meta['content_hash'], p_rolling_window, p_assum_mean_generation
+                           , p_assum_sd_generation)
+        if batch is None:
+            # Replaced by a newer version in the meantime
+            return snapshot
+
+    return make_snapshot(meta, split_series(series), batch)
+
+# Function: Read the source and build a new snapshot if its contents differ from p_previous (or there is no previous
+# snapshot). Returns the new snapshot, or None if the contents haven't changed. If p_cache_dir is given, the new
+# data is published there for other processes
+def refresh_snapshot(p_source, p_previous, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation
+                     , p_cache_dir=None, p_chunk_rows=100000):
+    path, is_temp = fetch_source(p_source)
+    try:
+        # Only parse the CSV if the contents have actually changed
+        source_hash = content_hash(path)
+        if (p_previous is not None) and (source_hash == p_previous['content_hash']):
+            return None
+
+        series, meta = ingest_source(path, source_hash, p_chunk_rows, trace_ingest_memory())
+        logger.info("ingested %s rows in %.2fs%s", meta['rows'], meta['ingest_seconds']
+                    , '' if meta['ingest_peak_memory_mb'] is None
+                    else ', peak memory {:.1f} MB'.format(meta['ingest_peak_memory_mb']))
+        observe_stage('ingest', meta['ingest_seconds'])
+
+        with timed('snapshot_build'):
+            snapshot = build_snapshot(series, meta, p_rolling_window, p_assum_mean_generation
+                                      , p_assum_sd_generation, p_previous)
+
+        if p_cache_dir is not None:
+            save_series(p_cache_dir, p_source, series, meta, snapshot['batch'])
+    finally:
+        if is_temp:
+            os.remove(path)
+
+    return snapshot
+
+# Function: Check the source and publish any new data to the disk cache, updating the version cached there.
+# Returns whether new data was published. Run in its own process - see publish_snapshot_in_process
+def publish_snapshot(p_source, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation, p_cache_dir
+                     , p_chunk_rows):
+    previous = load_cached_snapshot(p_source, p_cache_dir, p_rolling_window, p_assum_mean_generation
+                                    , p_assum_sd_generation)
+
+    return refresh_snapshot(p_source, previous, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation
+                            , p_cache_dir, p_chunk_rows) is not None
+
+# Function: publish_snapshot in a new Python process (see the end of this module), so the memory used to build
+# a snapshot goes back to the system when it's done rather than staying with a server process.
+# A fresh interpreter rather than a fork, as the server process has other threads running. The process is killed if
+# it takes longer than publish_timeout_seconds, raising subprocess.TimeoutExpired - callers holding the refresh lock
+# release it as the error passes (see refresh_lock)
+def publish_snapshot_in_process(p_source, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation
+                                , p_cache_dir, p_chunk_rows):
+    args = [p_source, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation, p_cache_dir, p_chunk_rows]
+
+    # The process logs at this process's level, so it's filtered or silenced along with it
+    subprocess.run([sys.executable, '-m', 'functions.refresh', json.dumps(args), str(logger.getEffectiveLevel())]
+                   , cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+                   , check=True
+                   , timeout=publish_timeout_seconds)
+
+# Function: Latest snapshot published to the disk cache, or None if it's the version of p_previous (or nothing has
+# been published)
+def load_published_snapshot(p_source, p_previous, p_cache_dir, p_rolling_window, p_assum_mean_generation
+                            , p_assum_sd_generation):
+    version = cached_version(p_cache_dir, p_source)
+    if (version is None) or ((p_previous is not None) and (version == p_previous['content_hash'])):
+        return None
+
+    with timed('snapshot_load'):
+        return load_cached_snapshot(p_source, p_cache_dir, p_rolling_window, p_assum_mean_generation
+                                    , p_assum_sd_generation)
+
+# Function: Snapshot of the data straight away - from the disk cache if p_cache_dir has a copy, otherwise read from
+# the source (and published to the disk cache)
+def load_snapshot(p_source, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation, p_cache_dir=None
+                  , p_chunk_rows=100000):
+    if p_cache_dir is None:
+        return refresh_snapshot(p_source, None, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation
+                                , None, p_chunk_rows)
+
+    snapshot = load_cached_snapshot(p_source, p_cache_dir, p_rolling_window, p_assum_mean_generation
+                                    , p_assum_sd_generation)
+    if snapshot is None:
+        publish_snapshot_in_process(p_source, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation
+                                    , p_cache_dir, p_chunk_rows)
+        snapshot = load_cached_snapshot(p_source, p_cache_dir, p_rolling_window, p_assum_mean_generation
+                                        , p_assum_sd_generation)
+
+    return snapshot
+
+# Function: Poll the source and pass each new snapshot to p_on_snapshot. Runs forever - see start_refresher.
+# Starts from p_previous if given (e.g. a snapshot loaded before the process forked).
+# If p_cache_dir is given, processes share the work through it: every p_poll_interval seconds each process picks up
+# the latest version published there (at startup, the data cached by a previous process), and every p_interval
+# seconds one of them checks the source and publishes any new data (see publish_snapshot_in_process)
+def refresh_loop(p_source, p_interval, p_on_snapshot, p_rolling_window, p_assum_mean_generation, p_assum_sd_generation
+                 , p_cache_dir=None, p_chunk_rows=100000, p_previous=None, p_poll_interval=5):
+    previous = p_previous
+    previous_signature = None
+    next_check = 0
+
+    while True:
+        try:
+            # Pick up data published by another process
+            if p_cache_dir is not None:
+                snapshot = load_published_snapshot(p_source, previous, p_cache_dir, p_rolling_window
+                                                   , p_assum_mean_generation, p_assum_sd_generation)
+                if snapshot is not None:
+                    p_on_snapshot(snapshot)
+                    previous = snapshot
+
+            if time.time() >= next_check:
+                lock = refresh_lock(p_cache_dir, p_source) if p_cache_dir is not None \
+                    else contextlib.nullcontext(True)
+                with lock as locked:
+                    # Skipped if another process is checking or has checked within the interval
+                    due = locked and ((p_cache_dir is None) or (previous is None)
+                                      or (seconds_since_checked(p_cache_dir, p_source) >= p_interval))
+                    if due:
+                        if p_cache_dir is not None:
+                            mark_checked(p_cache_dir, p_source)
+
+                        signature = source_signature(p_source)
+                        if (signature is None) or (signature != previous_signature):
+                            if p_cache_dir is None:
+                                snapshot = refresh_snapshot(p_source, previous, p_rolling_window
+                                                            , p_assum_mean_generation, p_assum_sd_generation
+                                                            , None, p_chunk_rows)
+                            else:
+                                # Published for every process, then picked up by this one straight away
+                                with timed('snapshot_publish'):
+                                    publish_snapshot_in_process(p_source, p_rolling_window
+                                                                , p_assum_mean_generation, p_assum_sd_generation
+                                                                , p_cache_dir, p_chunk_rows)
+                                snapshot = load_published_snapshot(p_source, previous, p_cache_dir
+                                                                   , p_rolling_window, p_assum_mean_generation
+                                                                   , p_assum_sd_generation)
+                            if snapshot is not None:
+                                p_on_snapshot(snapshot)
+                                previous = snapshot
+
+                            previous_signature = signature
+
+                next_check = time.time() + p_interval
+        except Exception:
+            # Keep serving the current snapshot and try again next time
+            logger.exception("data refresh failed")
+
+        time.sleep(min(p_poll_interval, p_interval) if p_cache_dir is not None else p_interval)
+
+# Function: Start polling the source in a background (daemon) thread
+def start_refresher(p_source, p_interval, p_on_snapshot, p_rolling_window, p_assum_mean_generation
+                    , p_assum_sd_generation, p_cache_dir=None, p_chunk_rows=100000, p_previous=None
+                    , p_poll_interval=5):
+    thread = threading.Thread(target=refresh_loop
+                              , args=(p_source, p_interval, p_on_snapshot, p_rolling_window, p_assum_mean_generation
+                                      , p_assum_sd_generation, p_cache_dir, p_chunk_rows, p_previous
+                                      , p_poll_interval)
+                              , name='data_refresher'
+                              , daemon=True)
+    thread.start()
+
+    return thread
+
+# Run by publish_snapshot_in_process, with publish_snapshot's arguments as a JSON list
+if __name__ == '__main__':
+    logging.basicConfig(level=int(sys.argv[2]), format=log_format)
+    publish_snapshot(*json.loads(sys.argv[1]))
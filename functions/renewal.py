@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Renewal-equation estimate of R_eff (Cori et al. 2013) - cases on each day are R_eff times the infection pressure,
+past cases weighted by the generation interval. With a gamma prior on R_eff over a sliding window the posterior
+is gamma, so estimates and credible intervals come from window sums over (location x date) arrays in one pass
+"""
+
+import numpy as np
+from statistics import NormalDist
+
+
+# Function: Discretised gamma generation interval - weights for lags 0 to p_max_days (lag 0 has no weight),
+# summing to 1. Defaults to covering the mean plus 5 standard deviations
+def generation_interval_weights(p_mean, p_sd, p_max_days=None):
+    if p_max_days is None:
+        p_max_days = int(np.ceil(p_mean + 5 * p_sd))
+
+    shape = (p_mean / p_sd) ** 2
+    scale = p_sd ** 2 / p_mean
+
+    days = np.arange(1, p_max_days + 1)
+    log_density = (shape - 1) * np.log(days) - days / scale
+
+    weights = np.zeros(p_max_days + 1)
+    weights[1:] = np.exp(log_density - log_density.max())
+
+    return weights / weights.sum()
+
+# Function: Infection pressure along each row of p_cases (location x date) - sum over lags of the weight times
+# cases that many days before. The kernel is short, so shifting and adding once per lag vectorises the
+# convolution over every location at once, and exactly (no FFT round-off, so zeros stay zero)
+def infection_pressure(p_cases, p_weights):
+    pressure = np.zeros(p_cases.shape)
+    for lag in range(1, min(len(p_weights), p_cases.shape[1])):
+        pressure[:, lag:] += p_weights[lag] * p_cases[:, :-lag]
+
+    return pressure
+
+# Function: Sum over the p_window days ending on each date, along each row
+def window_sum(p_values, p_window):
+    cum_values = np.cumsum(p_values, axis=1)
+    sums = cum_values.copy()
+    sums[:, p_window:] -= cum_values[:, :-p_window]
+
+    return sums
+
+# Function: Quantiles of a gamma distribution - Wilson-Hilferty approximation, close for the shapes here
+# (at least the prior shape plus the cases in the window)
+def gamma_quantile(p_q, p_shape, p_rate):
+    z = NormalDist().inv_cdf(p_q)
+    cube = np.maximum(1 - 1 / (9 * p_shape) + z * np.sqrt(1 / (9 * p_shape)), 0)
+
+    return p_shape * cube ** 3 / p_rate
+
+# Function: Posterior mean and credible interval of R_eff over the p_window days ending on each date, for each
+# row of p_cases (location x date, right-aligned with p_lengths dates in each row - see right_align).
+# The prior is gamma with shape p_prior_shape and scale p_prior_scale (Cori et al. default mean 5, sd 5).
+# Dates without a full window, or without any infection pressure in the window, are NaN
+def renewal_R_eff(p_cases, p_lengths, p_weights, p_window, p_quantiles=(0.025, 0.975), p_prior_shape=1
+                  , p_prior_scale=5):
+    n_dates = p_cases.shape[1]
+
+    # Padding and missing days count as no cases, as do negative corrections
+    cases = np.clip(np.nan_to_num(p_cases), 0, None)
+
+    case_sums = window_sum(cases, p_window)
+    pressure_sums = window_sum(infection_pressure(cases, p_weights), p_window)
+
+    shape = p_prior_shape + case_sums
+    rate = 1 / p_prior_scale + pressure_sums
+
+    # First full window for each row ends p_window - 1 places after the row's first date
+    first_full = (n_dates - np.asarray(p_lengths) + p_window - 1)[:, np.newaxis]
+    valid = (np.arange(n_dates)[np.newaxis, :] >= first_full) & (pressure_sums > 0)
+
+    estimates = {'mean': shape / rate}
+    estimates['lower'] = gamma_quantile(p_quantiles[0], shape, rate)
+    estimates['upper'] = gamma_quantile(p_quantiles[-1], shape, rate)
+
+    return {x: np.where(valid, np.round(y, 2), np.nan) for x, y in estimates.items()}
+
+# Function: Project expected daily cases through the renewal equation - each day's cases are that day's R_eff times
+# the infection pressure from earlier cases, so R_eff can change over the projection.
+# p_recent_cases holds the latest cases (..., days, oldest first) and p_R_eff the R_eff trajectories
+# (..., days ahead). Leading dimensions broadcast, so e.g. recent cases for each state (state x 1 x days) against a
+# library of trajectories (trajectory x days ahead) projects every trajectory for every state (state x trajectory x
+# days ahead) at once. Each day depends on the days before, so the loop is over days ahead; within each day every
+# state and trajectory is advanced together by one matrix product over a (day x state and trajectory) view.
+# History shorter than the generation interval is treated as no cases
+def simulate_renewal(p_recent_cases, p_R_eff, p_weights):
+    recent_cases = np.nan_to_num(np.asarray(p_recent_cases, dtype=float))
+    R_eff = np.asarray(p_R_eff, dtype=float)
+
+    n_lags = len(p_weights) - 1
+    n_days = R_eff.shape[-1]
+    shape = np.broadcast_shapes(recent_cases.shape[:-1], R_eff.shape[:-1])
+    R_eff = np.moveaxis(np.broadcast_to(R_eff, shape + (n_days,)), -1, 0)
+
+    # Latest n_lags days of history, then the projection - days first, so each day is a contiguous block
+    cases = np.zeros((n_lags + n_days,) + shape)
+    n_history = min(n_lags, recent_cases.shape[-1])
+    history = recent_cases[..., recent_cases.shape[-1] - n_history:]
+    cases[n_lags - n_history:n_lags] = np.moveaxis(np.broadcast_to(history, shape + (n_history,)), -1, 0)
+    flat_cases = cases.reshape(n_lags + n_days, -1)
+
+    # Weights for lags n_lags down to 1, to line up with the days before each projected day (oldest first)
+    kernel = p_weights[:0:-1]
+
+    for t in range(n_days):
+        np.multiply(R_eff[t], (kernel @ flat_cases[t:n_lags + t]).reshape(shape), out=cases[n_lags + t, ...])
+
+    return np.moveaxis(cases[n_lags:], 0, -1)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Reporting - history and projections under every scenario for many locations as one long table (a row per
+location per scenario per date), computed in chunks of locations across a process pool and streamed to CSV or
+Parquet, so memory stays bounded however many locations there are. Used by 02_batch_projections.py
+"""
+
+import collections
+import os
+
+import pandas as pd
+import numpy as np
+
+from functions.pipeline import process_data, smooth_data, estimate_R_eff, estimate_R_eff_renewal
+from functions.projection import build_scenario_grid, scenario_table
+from functions.projection import simulate_interval_multipliers, projection_intervals, R_eff_decay, R_eff_piecewise
+from functions.renewal import generation_interval_weights, simulate_renewal
+
+
+# Columns of the report and their types - fixed, so every chunk has the same columns in the same order and the
+# Parquet schema is the same for every chunk. scenario is 'history' for reported data
+report_columns = collections.OrderedDict([
+    ('report_date', 'datetime64[ns]')
+    , ('location', object)
+    , ('scenario', object)
+    , ('daily_cases', float)
+    , ('smooth_cases', float)
+    , ('lag_cases', float)
+    , ('R_eff', float)
+    , ('R_eff_renewal', float)
+    , ('R_eff_renewal_lower', float)
+    , ('R_eff_renewal_upper', float)
+    , ('projected_cases', float)
+    , ('projected_R_eff', float)
+    , ('projected_lower', float)
+    , ('projected_upper', float)
+])
+
+
+# Function: Give a frame the report's columns and types
+def conform_report(p_data):
+    return p_data.reindex(columns=list(report_columns)).astype(report_columns)
+
+# Function: History and projections for one location, as the dashboard shows them - the projections are
+# 'estimated' (current estimate of R_eff), one per fixed R_eff in p_scenarios ({name: R_eff}), 'easing'
+# (R_eff decaying from its current estimate toward 1) and one per piecewise constant R_eff in
+# p_piecewise_scenarios ({name: (R_eff values, change days)} - see R_eff_piecewise), each with its prediction
+# interval. p_history_days limits the history to the latest days (all of it if None).
+# There are no projections if the latest smoothed cases aren't known, and no 'estimated' or 'easing' projection
+# if the latest R_eff isn't
+def location_report(p_data, p_location, p_days_to_project, p_rolling_window, p_assum_mean_generation
+                    , p_assum_sd_generation, p_scenarios, p_easing_half_life=14, p_interval_quantiles=(0.05, 0.95)
+                    , p_n_paths=2000, p_R_eff_history_days=28, p_history_days=None, p_piecewise_scenarios=None):
+
+    df = process_data(p_data=p_data, p_location=p_location)
+    df = smooth_data(p_data=df, p_rolling_window=p_rolling_window)
+    df = estimate_R_eff(p_data=df, p_assum_mean_generation=p_assum_mean_generation)
+    df = estimate_R_eff_renewal(p_data=df
+                                , p_rolling_window=p_rolling_window
+                                , p_assum_mean_generation=p_assum_mean_generation
+                                , p_assum_sd_generation=p_assum_sd_generation)
+
+    history = df if p_history_days is None else df.iloc[-p_history_days:]
+    frames = [history.assign(scenario='history')]
+
+    curr_date = df['report_date'].values[-1]
+    curr_cases = df['smooth_cases'].astype(float).values[-1]
+    est_curr_R_eff = df['R_eff'].astype(float).values[-1]
+    if not np.isfinite(curr_cases):
+        return conform_report(pd.concat(frames))
+
+    multipliers = simulate_interval_multipliers(p_recent_R_eff=df['R_eff'].astype(float).values[-p_R_eff_history_days:]
+                                                , p_max_days=p_days_to_project
+                                                , p_assum_mean_generation=p_assum_mean_generation
+                                                , p_quantiles=p_interval_quantiles
+                                                , p_n_paths=p_n_paths)
+
+    # Constant R_eff scenarios - all projected at once, from a scenario grid of just their R_eff values
+    scenarios = [(x, R_eff) for x, R_eff in [('estimated', est_curr_R_eff)] + list(p_scenarios.items())
+                 if np.isfinite(R_eff)]
+    if scenarios:
+        R_effs = np.array([x[1] for x in scenarios], dtype=float)
+        scenario_grid = build_scenario_grid(p_curr_date=curr_date
+                                            , p_curr_cases=curr_cases
+                                            , p_max_days=p_days_to_project
+                                            , p_assum_mean_generation=p_assum_mean_generation
+                                            , p_R_eff_values=np.unique(R_effs))
+        intervals = [projection_intervals(p_curr_cases=curr_cases
+                                          , p_R_eff=R_eff
+                                          , p_days_to_project=p_days_to_project
+                                          , p_assum_mean_generation=p_assum_mean_generation
+                                          , p_multipliers=multipliers) for R_eff in R_effs]
+
+        frames.append(scenario_table(scenario_grid, R_effs, p_days_to_project).assign(
+            location=p_location
+            , scenario=np.repeat([x[0] for x in scenarios], p_days_to_project)
+            , projected_lower=np.concatenate([x[0] for x in intervals])
+            , projected_upper=np.concatenate([x[-1] for x in intervals])))
+
+    # Time-varying R_eff scenarios - easing, then the piecewise ones, all projected at once through the renewal
+    # equation from the smoothed trend
+    trajectories = [(x, R_eff_piecewise(values, change_days, p_days_to_project))
+                    for x, (values, change_days) in (p_piecewise_scenarios or {}).items()]
+    if np.isfinite(est_curr_R_eff):
+        trajectories.insert(0, ('easing', R_eff_decay(p_R_eff_start=est_curr_R_eff
+                                                      , p_days=p_days_to_project
+                                                      , p_half_life=p_easing_half_life)))
+    if trajectories:
+        R_eff = np.array([x[1] for x in trajectories])
+        proj_cases = simulate_renewal(p_recent_cases=df['smooth_cases'].astype(float).values
+                                      , p_R_eff=R_eff
+                                      , p_weights=generation_interval_weights(p_assum_mean_generation
+                                                                              , p_assum_sd_generation))
+
+        frames.append(pd.DataFrame({
+            'report_date': np.tile(curr_date + np.arange(1, p_days_to_project + 1).astype('timedelta64[D]')
+                                   , len(trajectories))
+            , 'location': p_location
+            , 'scenario': np.repeat([x[0] for x in trajectories], p_days_to_project)
+            , 'projected_cases': np.round(proj_cases, 0).ravel()
+            , 'projected_R_eff': np.round(R_eff, 2).ravel()
+            , 'projected_lower': np.round(proj_cases * multipliers[0], 0).ravel()
+            , 'projected_upper': np.round(proj_cases * multipliers[-1], 0).ravel()
+        }))
+
+    return conform_report(pd.concat(frames))
+
+# Function: Reports for every location in p_data (a series store, or part of one), one after another.
+# p_settings are the arguments to location_report after p_data and p_location
+def report_chunk(p_data, p_settings):
+    return pd.concat([location_report(p_data, x, **p_settings) for x in p_data], ignore_index=True)
+
+# Function: Reports for p_locations from the series store p_data, p_chunk_locations locations at a time, yielded
+# as a frame per chunk in the order of p_locations. With p_processes > 1 chunks are computed in parallel in a
+# process pool, with at most two chunks per process outstanding so finished chunks don't pile up in memory while
+# they're written
+def run_reports(p_data, p_locations, p_settings, p_chunk_locations=50, p_processes=None):
+    # Only each chunk's own series are sent to the process computing it
+    chunks = ({x: {k: np.asarray(v) for k, v in p_data[x].items()} for x in p_locations[i:i + p_chunk_locations]}
+              for i in range(0, len(p_locations), p_chunk_locations))
+
+    if (p_processes is None) or (p_processes <= 1):
+        for chunk in chunks:
+            yield report_chunk(chunk, p_settings)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=p_processes) as executor:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(report_chunk, chunk, p_settings))
+            if len(pending) >= 2 * p_processes:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+# Function: Write each frame from p_frames as it comes to a CSV file at p_path. Returns the rows written
+def write_csv_stream(p_frames, p_path):
+    n_rows = 0
+    for frame in p_frames:
+        frame.to_csv(p_path, mode='w' if n_rows == 0 else 'a', header=(n_rows == 0), index=False)
+        n_rows += len(frame)
+
+    return n_rows
+
+# Function: Write each frame from p_frames as it comes to a Parquet file at p_path, a row group per frame.
+# Needs pyarrow. Returns the rows written
+def write_parquet_stream(p_frames, p_path):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Writing Parquet needs pyarrow - install it, or write CSV instead')
+
+    n_rows = 0
+    writer = None
+    try:
+        for frame in p_frames:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(p_path, table.schema)
+            writer.write_table(table)
+            n_rows += len(frame)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return n_rows
+
+# Function: Write p_frames to p_path as p_format ('csv' or 'parquet'). Written to a temporary file next to p_path
+# and moved into place when complete, so p_path is never left half written. Returns the rows written
+def write_report(p_frames, p_path, p_format):
+    writers = {'csv': write_csv_stream, 'parquet': write_parquet_stream}
+    if p_format not in writers:
+        raise ValueError('unknown report format {!r}, expected one of {}'.format(p_format, sorted(writers)))
+
+    temp_path = '{}.{}.tmp'.format(p_path, os.getpid())
+    try:
+        n_rows = writers[p_format](p_frames, temp_path)
+        if n_rows == 0:
+            # No frames at all - still write the columns
+            n_rows = writers[p_format]([conform_report(pd.DataFrame())], temp_path)
+        os.replace(temp_path, p_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return n_rows
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Table functions - filtering, sorting and paging for the Chart data table on the server, so only the rows
+on the current page are sent to the browser
+"""
+
+import math
+
+import pandas as pd
+
+
+# Filter operators used in DataTable filter queries and the equivalent comparisons.
+# Word operators are checked first - the symbol forms (e.g. '=') also appear inside others (e.g. '>=')
+filter_operators = [
+    ('ge', ['ge ', '>=']),
+    ('le', ['le ', '<=']),
+    ('lt', ['lt ', '<']),
+    ('gt', ['gt ', '>']),
+    ('ne', ['ne ', '!=']),
+    ('eq', ['eq ', '=']),
+    ('contains', ['contains ']),
+    ('datestartswith', ['datestartswith ']),
+]
+
+
+# Function: Split one part of a DataTable filter query, e.g. '{daily_cases} s> 50', into (column, operator, value).
+# The value is left as text - filter_data converts it for numeric columns
+def split_filter_part(p_filter_part):
+    for operator, operator_strings in filter_operators:
+        for operator_string in operator_strings:
+            if operator_string in p_filter_part:
+                name_part, value_part = p_filter_part.split(operator_string, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+                value_part = value_part.strip()
+                quote = value_part[0] if value_part else ''
+                if quote in ("'", '"', '`') and value_part[-1] == quote:
+                    value = value_part[1: -1].replace('\\' + quote, quote)
+                else:
+                    value = value_part
+
+                return name, operator, value
+
+    return None, None, None
+
+# Function: Apply a DataTable filter query to the data
+def filter_data(p_data, p_filter_query):
+    filtered_data = p_data
+
+    for filter_part in (p_filter_query or '').split(' && '):
+        name, operator, value = split_filter_part(filter_part)
+        if name not in filtered_data.columns:
+            continue
+
+        column = filtered_data[name]
+        # Dates are shown and filtered as text, like location
+        if name == 'report_date':
+            column = column.dt.strftime('%Y-%m-%d')
+
+        if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+            # Compared as numbers for numeric columns only
+            if pd.api.types.is_numeric_dtype(column):
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+            # these operators match pandas series operator method names
+            try:
+                keep = getattr(column, operator)(value)
+            except TypeError:
+                # e.g. text typed into the filter for a numeric column - nothing matches
+                keep = pd.Series(False, index=column.index)
+        elif operator == 'contains':
+            # Ignoring case, so e.g. nsw matches NSW
+            keep = column.astype(str).str.contains(str(value), case=False, regex=False)
+        else:
+            keep = column.astype(str).str.startswith(str(value))
+
+        filtered_data = filtered_data.loc[keep.fillna(False).astype(bool)]
+
+    return filtered_data
+
+# Function: Filter, sort and page the data as the DataTable would. Returns (page rows, page count)
+def get_table_page(p_data, p_filter_query, p_sort_by, p_page_current, p_page_size):
+    table_data = filter_data(p_data, p_filter_query)
+
+    # Latest dates first unless the user has sorted
+    if p_sort_by:
+        table_data = table_data.sort_values([x['column_id'] for x in p_sort_by]
+                                            , ascending=[x['direction'] == 'asc' for x in p_sort_by]
+                                            , kind='mergesort'
+                                            , na_position='last')
+    else:
+        table_data = table_data.sort_values('report_date', ascending=False, kind='mergesort')
+
+    page_count = max(math.ceil(len(table_data) / p_page_size), 1)
+
+    page = table_data.iloc[p_page_current * p_page_size: (p_page_current + 1) * p_page_size].copy()
+    page['report_date'] = page['report_date'].dt.strftime('%Y-%m-%d')
+
+    return page.to_dict('records'), page_count
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Piecewise constant R_eff scenarios - the trajectories (functions/projection.py) and their projections in the batch
+report (functions/reporting.py). Run from the repo root:
+    python -m pytest tests
+"""
+
+import numpy as np
+
+from functions.projection import R_eff_piecewise
+from functions.reporting import location_report
+
+
+# Function: Series store with one location reporting the same cases every day
+def flat_store(p_cases, p_days):
+    return {'FLAT': {'report_date': np.datetime64('2021-01-01', 'ns') + np.arange(p_days).astype('timedelta64[D]')
+                     , 'daily_cases': np.full(p_days, p_cases, dtype=np.int32)}}
+
+def test_R_eff_piecewise_changes_on_change_days():
+    R_eff = R_eff_piecewise([1.3, 0.9, 1.1], [3, 5], 6)
+
+    np.testing.assert_array_equal(R_eff, [1.3, 1.3, 0.9, 0.9, 1.1, 1.1])
+
+def test_R_eff_piecewise_one_trajectory_per_row():
+    R_eff = R_eff_piecewise([[1.0, 2.0], [0.5, 0.8]], [2], 3)
+
+    np.testing.assert_array_equal(R_eff, [[1.0, 2.0, 2.0], [0.5, 0.8, 0.8]])
+
+def test_location_report_projects_piecewise_scenarios():
+    report = location_report(p_data=flat_store(100, 90)
+                             , p_location='FLAT'
+                             , p_days_to_project=20
+                             , p_rolling_window=7
+                             , p_assum_mean_generation=5
+                             , p_assum_sd_generation=2.9
+                             , p_scenarios={}
+                             , p_n_paths=200
+                             , p_piecewise_scenarios={'steps': ([1.0, 1.5], [11])})
+
+    steps = report[report['scenario'] == 'steps']
+    assert len(steps) == 20
+    np.testing.assert_array_equal(steps['projected_R_eff'], [1.0] * 10 + [1.5] * 10)
+
+    # Cases hold level while R_eff is 1, then grow
+    projected = steps['projected_cases'].values
+    np.testing.assert_array_equal(projected[:10], 100)
+    assert (np.diff(projected[10:]) > 0).all()
+    assert (steps['projected_lower'] <= steps['projected_cases']).all()
+    assert (steps['projected_cases'] <= steps['projected_upper']).all()
+
+    # Alongside the other scenarios, which are unchanged
+    easing = report[report['scenario'] == 'easing']
+    np.testing.assert_array_equal(easing['projected_cases'], 100)
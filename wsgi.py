@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI entry point for multi-worker servers, e.g.
+    gunicorn --preload --workers 4 wsgi:server
+
+With --preload the imports, the app and the data are loaded once in the master process and the workers are forked
+from it, so a new worker starts serving straight away rather than importing dash and pandas and loading the data
+itself. Each worker then keeps checking for new data in the background
+"""
+
+import importlib
+
+# The app module's name isn't a valid identifier, so it can't be imported with an import statement
+dashy_app = importlib.import_module('01_dashy_app')
+
+app = dashy_app.create_app()
+server = app.server
+
+dashy_app.preload_data()